@@ -0,0 +1,281 @@
+# CPU inference benchmark of the OBB model across inference size, batch size, threads and backend
+#
+# Every configuration runs in its own python process, so the thread settings of torch or
+# onnxruntime of one configuration do not leak into the next and the peak RSS is the one of that
+# configuration only. A configuration is timed on the same fixed set of images: a few warm-up
+# batches, then the latency of every batch (p50/p95/p99 per image of the batch) and the throughput.
+# The results are saved as json and can be compared to a stored baseline to catch regressions
+# after retraining or an update of the libraries.
+#
+# Usage:
+# python benchmark.py <image folder> --weights best.pt --onnx best.onnx [--int8 best.int8.onnx]
+#                     --imgsz 256 512 640 --batch 1 8 16 --threads 1 4 --output results.json
+#                     [--baseline baseline.json] [--save-baseline baseline.json]
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import itertools
+import subprocess
+import numpy as np
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'utils'))
+from crop import get_jpg_files_path
+from obb_metrics import load_images
+
+BACKENDS = ['pytorch', 'onnx', 'int8']
+
+
+def peak_rss_mb():
+    '''
+    Peak resident memory of this process in MB, None where the resource module does not exist (Windows).
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def make_predict_fn(backend, model_path, imgsz, threads):
+    '''
+    Load a model for one configuration.
+
+    Returns:
+    - callable: list of images -> list of (K, 7) detections
+    '''
+    if backend == 'pytorch':
+        import torch
+        from full_frame_inference import load_model, predict_tiles
+
+        torch.set_num_threads(threads)
+        model = load_model(model_path)
+        return lambda images: predict_tiles(model, images, imgsz=imgsz)
+
+    from onnx_backend import OnnxObbModel
+    return OnnxObbModel(model_path, imgsz, intra_op_threads=threads)
+
+
+def run_config(config):
+    '''
+    Benchmark one configuration in the current process.
+
+    Parameters:
+    - config (dict): 'backend', 'model', 'imgsz', 'batch', 'threads', 'images' (list of paths),
+      'warmup' (number of warm-up batches), 'iterations' (times the image set is run)
+
+    Returns:
+    - dict: the config (without the image list) and the measures
+    '''
+    start = time.perf_counter()
+    predict_fn = make_predict_fn(config['backend'], config['model'], config['imgsz'], config['threads'])
+    load_seconds = time.perf_counter() - start
+
+    images = load_images(config['images'])
+    batch_size = config['batch']
+    batches = [images[i:i + batch_size] for i in range(0, len(images), batch_size)]
+
+    warmup_ms = []
+    for i in range(config['warmup']):
+        begin = time.perf_counter()
+        predict_fn(batches[i % len(batches)])
+        warmup_ms.append((time.perf_counter() - begin) * 1000)
+
+    per_image_ms = []
+    total_images = 0
+    begin_all = time.perf_counter()
+    for _ in range(config['iterations']):
+        for batch in batches:
+            begin = time.perf_counter()
+            predict_fn(batch)
+            elapsed = (time.perf_counter() - begin) * 1000
+            per_image_ms.extend([elapsed / len(batch)] * len(batch))
+            total_images += len(batch)
+    seconds = time.perf_counter() - begin_all
+
+    p50, p95, p99 = np.percentile(per_image_ms, [50, 95, 99]).tolist()
+    result = {key: value for key, value in config.items() if key != 'images'}
+    result.update({
+        'load_seconds': load_seconds,
+        'warmup_first_ms': warmup_ms[0] if warmup_ms else None,
+        'warmup_mean_ms': float(np.mean(warmup_ms)) if warmup_ms else None,
+        'latency_ms_p50': p50,
+        'latency_ms_p95': p95,
+        'latency_ms_p99': p99,
+        'images_per_second': total_images / seconds if seconds > 0 else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+    })
+    return result
+
+
+def run_config_subprocess(config, timeout=None):
+    '''
+    Run run_config in a new python process, never raises.
+
+    Returns:
+    - dict: the result, or the config with an 'error'
+    '''
+    # the OpenMP pool is sized when torch is imported, the variable has to be set before
+    environment = dict(os.environ, OMP_NUM_THREADS=str(config['threads']))
+    result = {key: value for key, value in config.items() if key != 'images'}
+    try:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-config', '-'], input=json.dumps(config),
+                                 capture_output=True, text=True, timeout=timeout, env=environment)
+    except subprocess.TimeoutExpired:
+        result['error'] = f'timed out after {timeout} s'
+        return result
+    if process.returncode != 0:
+        result['error'] = process.stderr.strip().splitlines()[-1] if process.stderr.strip() else f'exit code {process.returncode}'
+        return result
+    # the result is the last line, the libraries may print before it
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def config_key(result):
+    return result['backend'], result['imgsz'], result['batch'], result['threads']
+
+
+def sweep(model_paths, image_paths, imgsz_values=(256, 512, 640), batch_sizes=(1, 8, 16), thread_counts=(1, 4),
+          warmup=3, iterations=3, timeout=None):
+    '''
+    Benchmark every combination of backend, inference size, batch size and threads.
+
+    Parameters:
+    - model_paths (dict): backend ('pytorch', 'onnx', 'int8') -> model path, the backends without a model are skipped
+    - image_paths (list): the fixed image set
+    - imgsz_values, batch_sizes, thread_counts: the values swept
+    - warmup (int): untimed batches before the measures
+    - iterations (int): times the image set is run
+    - timeout (float): seconds after which a configuration is abandoned
+
+    Returns:
+    - dict: 'machine' (description of the machine), 'images', 'results' (one dict per configuration)
+    '''
+    results = []
+    backends = [backend for backend in BACKENDS if model_paths.get(backend)]
+    for backend, imgsz, batch, threads in itertools.product(backends, imgsz_values, batch_sizes, thread_counts):
+        config = {
+            'backend': backend, 'model': str(model_paths[backend]), 'imgsz': imgsz, 'batch': batch, 'threads': threads,
+            'warmup': warmup, 'iterations': iterations, 'images': list(image_paths),
+        }
+        result = run_config_subprocess(config, timeout)
+        results.append(result)
+        print_result(result)
+    return {'machine': machine_info(), 'images': len(image_paths), 'results': results}
+
+
+def machine_info():
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+    }
+
+
+def print_result(result):
+    name = f"{result['backend']:<8} imgsz {result['imgsz']:<4} batch {result['batch']:<3} threads {result['threads']:<3}"
+    if 'error' in result:
+        print(f"{name} failed: {result['error']}")
+        return
+    rss = f"{result['peak_rss_mb']:.0f} MB" if result['peak_rss_mb'] is not None else 'n/a'
+    warmup = f"{result['warmup_first_ms']:.0f} ms" if result['warmup_first_ms'] is not None else 'n/a'
+    print(f"{name} {result['images_per_second']:8.1f} images/s  p50 {result['latency_ms_p50']:.2f}  "
+          f"p95 {result['latency_ms_p95']:.2f}  p99 {result['latency_ms_p99']:.2f} ms  "
+          f"warm-up {warmup}  peak RSS {rss}")
+
+
+def compare_to_baseline(results, baseline, tolerance=0.1):
+    '''
+    Compare the throughput and the p95 latency of every configuration to the baseline.
+
+    Parameters:
+    - results, baseline (dict): outputs of sweep
+    - tolerance (float): relative loss of throughput or gain of p95 latency counted as a regression
+
+    Returns:
+    - list: one dict per configuration found in both, with 'throughput_change', 'p95_change' and 'regression'
+    '''
+    baseline_results = {config_key(result): result for result in baseline['results'] if 'error' not in result}
+    comparison = []
+    for result in results['results']:
+        reference = baseline_results.get(config_key(result))
+        if reference is None or 'error' in result:
+            continue
+        throughput_change = result['images_per_second'] / reference['images_per_second'] - 1 if reference['images_per_second'] else 0.0
+        p95_change = result['latency_ms_p95'] / reference['latency_ms_p95'] - 1 if reference['latency_ms_p95'] else 0.0
+        comparison.append({
+            'backend': result['backend'], 'imgsz': result['imgsz'], 'batch': result['batch'], 'threads': result['threads'],
+            'throughput_change': throughput_change,
+            'p95_change': p95_change,
+            'regression': throughput_change < -tolerance or p95_change > tolerance,
+        })
+    return comparison
+
+
+def print_comparison(comparison):
+    for row in comparison:
+        flag = '  REGRESSION' if row['regression'] else ''
+        print(f"{row['backend']:<8} imgsz {row['imgsz']:<4} batch {row['batch']:<3} threads {row['threads']:<3} "
+              f"throughput {row['throughput_change']:+.1%}  p95 {row['p95_change']:+.1%}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU inference benchmark of the OBB model.')
+    parser.add_argument('images', nargs='?', help='folder of the fixed image set')
+    parser.add_argument('--weights', default=None, help='.pt model, benchmarked with the pytorch backend')
+    parser.add_argument('--onnx', default=None, help='.onnx model, benchmarked with onnxruntime')
+    parser.add_argument('--int8', default=None, help='quantized .onnx model')
+    parser.add_argument('--imgsz', type=int, nargs='+', default=[256, 512, 640])
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 8, 16])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--limit', type=int, default=64, help='number of images of the set')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=None, help='seconds after which a configuration is abandoned')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', default=None, help='results of a previous run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change counted as a regression')
+    parser.add_argument('--save-baseline', default=None, help='also save the results as the new baseline')
+    parser.add_argument('--run-config', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_config is not None:
+        # inside the process of one configuration
+        config = json.load(sys.stdin) if args.run_config == '-' else json.loads(args.run_config)
+        print(json.dumps(run_config(config)))
+        return
+
+    if args.images is None:
+        parser.error('the image folder is required')
+    image_paths = sorted(get_jpg_files_path(args.images))[:args.limit]
+    model_paths = {'pytorch': args.weights, 'onnx': args.onnx, 'int8': args.int8}
+    if not any(model_paths.values()):
+        parser.error('give at least one of --weights, --onnx, --int8')
+
+    results = sweep(model_paths, image_paths, args.imgsz, args.batch, args.threads, args.warmup, args.iterations, args.timeout)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Results saved to {args.output}')
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'Baseline saved to {args.save_baseline}')
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+        comparison = compare_to_baseline(results, baseline, args.tolerance)
+        print_comparison(comparison)
+        if any(row['regression'] for row in comparison):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+# script to detect waste on whole DJI frames with a model trained on 256*256 windows
+#
+# The frame is cut into overlapping windows, the windows are sent to the model in batches,
+# the detections are moved back to frame coordinates and the duplicates on the seams
+# between two windows are merged with rotated NMS or weighted boxes fusion.
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from pathlib import Path
+from PIL import Image
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'utils'))
+from crop import window_origins, get_jpg_files_path
+from miscellaneous import save_to_txt_file
+from geometry import xywhr_to_corners
+from obb_ops import rotated_nms, weighted_boxes_fusion
+
+
+def load_model(weights):
+    from ultralytics import YOLO
+    return YOLO(weights)
+
+
+def predict_tiles(model, tiles, imgsz=256, conf=0.25, iou=0.7):
+    '''
+    Run an ultralytics OBB model on a batch of tiles.
+
+    Parameters:
+    - model (ultralytics.YOLO): the OBB model
+    - tiles (np.ndarray): uint8 RGB tiles of shape (N, H, W, 3), or a list of (H, W, 3) images of any size
+    - imgsz (int): inference size
+    - conf (float): confidence threshold
+    - iou (float): NMS threshold inside a tile
+
+    Returns:
+    - list: one (K, 7) float32 array (cx, cy, w, h, r, conf, class_id) per tile, in tile pixels
+    '''
+    # ultralytics expects numpy images in BGR order
+    results = model.predict([tile[..., ::-1] for tile in tiles], imgsz=imgsz, conf=conf, iou=iou, verbose=False)
+    detections = []
+    for result in results:
+        obb = result.obb
+        if obb is None or len(obb) == 0:
+            detections.append(np.zeros((0, 7), dtype=np.float32))
+            continue
+        detections.append(np.concatenate([
+            obb.xywhr.cpu().numpy(),
+            obb.conf.cpu().numpy()[:, None],
+            obb.cls.cpu().numpy()[:, None],
+        ], axis=1).astype(np.float32))
+    return detections
+
+
+def predict_full_frame(predict_fn, frame, window_size=256, overlap=64, batch_size=16, merge='nms', iou_threshold=0.5):
+    '''
+    Detect on a whole frame by sliding a window over it.
+
+    Parameters:
+    - predict_fn (callable): takes (N, H, W, 3) uint8 tiles and returns one (K, 7) detection array
+      per tile, e.g. functools.partial(predict_tiles, model)
+    - frame (np.ndarray): uint8 RGB frame of shape (H, W, 3)
+    - window_size (int): side of the windows, the size the model was trained on
+    - overlap (int): overlap between two windows in pixels
+    - batch_size (int): number of windows sent to the model at a time
+    - merge (str): 'nms' or 'wbf', how duplicates across windows are merged
+    - iou_threshold (float): overlap above which two detections are the same object
+
+    Returns:
+    - detections (np.ndarray): (K, 7) cx, cy, w, h, r, conf, class_id in frame pixels
+    - stats (dict): 'tiles', 'seconds', 'tiles_per_second'
+    '''
+    start = time.perf_counter()
+    height, width = frame.shape[:2]
+    origins = window_origins(width, height, window_size, window_size - overlap, pad=True)
+    padded_width = max(x for x, _ in origins) + window_size
+    padded_height = max(y for _, y in origins) + window_size
+    if padded_width > width or padded_height > height:
+        frame = np.pad(frame, ((0, padded_height - height), (0, padded_width - width), (0, 0)))
+
+    frame_detections = []
+    for batch_start in range(0, len(origins), batch_size):
+        batch_origins = origins[batch_start:batch_start + batch_size]
+        tiles = np.stack([frame[y:y + window_size, x:x + window_size] for x, y in batch_origins])
+        for (x, y), detections in zip(batch_origins, predict_fn(tiles)):
+            if len(detections):
+                detections = np.array(detections, dtype=np.float64)
+                detections[:, 0] += x
+                detections[:, 1] += y
+                frame_detections.append(detections)
+
+    if frame_detections:
+        detections = np.concatenate(frame_detections)
+        # detections centred in the black padding are not on the frame
+        detections = detections[(detections[:, 0] < width) & (detections[:, 1] < height)]
+        if merge == 'wbf':
+            detections = weighted_boxes_fusion(detections, iou_threshold)
+        else:
+            detections = rotated_nms(detections, iou_threshold)
+    else:
+        detections = np.zeros((0, 7))
+
+    seconds = time.perf_counter() - start
+    stats = {
+        'tiles': len(origins),
+        'seconds': seconds,
+        'tiles_per_second': len(origins) / seconds if seconds > 0 else 0.0,
+    }
+    return detections, stats
+
+
+def detections_to_lines(detections, class_names):
+    '''
+    Format detections in the 8 corner format of the converters
+    (x1,y1,x2,y2,x3,y3,x4,y4,class_label,difficulty), so they can be plotted and re-cropped.
+    '''
+    lines = []
+    for corners, class_id in zip(xywhr_to_corners(detections, dtype=np.float64), detections[:, 6]):
+        coordinates = np.round(corners.reshape(-1), 3).tolist()
+        lines.append(','.join(map(str, coordinates)) + ',' + str(class_names.get(int(class_id), int(class_id))) + ',0')
+    return lines
+
+
+def predict_full_frames(predict_fn, image_paths, output_folder=None, class_names=None, **kwargs):
+    '''
+    Run predict_full_frame on many frames, print the latency of every frame and a summary.
+
+    Parameters:
+    - predict_fn (callable): see predict_full_frame
+    - image_paths (list): paths of the frames
+    - output_folder (str): optional folder where a label file is written per frame
+    - class_names (dict): class_id -> class name used in the label files
+    - kwargs: passed to predict_full_frame
+
+    Returns:
+    - results (dict): image_path -> (K, 7) detections
+    '''
+    class_names = class_names or {}
+    if output_folder is not None:
+        os.makedirs(output_folder, exist_ok=True)
+
+    results = {}
+    total_tiles = 0
+    total_seconds = 0.0
+    for image_path in image_paths:
+        with Image.open(image_path) as image:
+            frame = np.asarray(image.convert('RGB'))
+        detections, stats = predict_full_frame(predict_fn, frame, **kwargs)
+        results[image_path] = detections
+        total_tiles += stats['tiles']
+        total_seconds += stats['seconds']
+        print(f"{Path(image_path).name}: {len(detections)} detections, {stats['tiles']} tiles, "
+              f"{stats['seconds'] * 1000:.1f} ms, {stats['tiles_per_second']:.1f} tiles/s")
+        if output_folder is not None:
+            save_to_txt_file(detections_to_lines(detections, class_names), os.path.join(output_folder, Path(image_path).stem))
+
+    if results:
+        print(f"{len(results)} frames, {total_seconds / len(results) * 1000:.1f} ms/frame, "
+              f"{total_tiles / total_seconds if total_seconds > 0 else 0.0:.1f} tiles/s")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sliding window detection on full frames.')
+    parser.add_argument('weights', help='path of the trained OBB model, e.g. runs/obb/train/weights/best.pt')
+    parser.add_argument('source', help='a jpg frame or a folder of frames')
+    parser.add_argument('--output', default=None, help='folder where the labels of every frame are written')
+    parser.add_argument('--window-size', type=int, default=256)
+    parser.add_argument('--overlap', type=int, default=64)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--conf', type=float, default=0.25)
+    parser.add_argument('--merge', choices=['nms', 'wbf'], default='nms')
+    parser.add_argument('--iou', type=float, default=0.5, help='overlap threshold used to merge across windows')
+    args = parser.parse_args()
+
+    model = load_model(args.weights)
+
+    def predict_fn(tiles):
+        return predict_tiles(model, tiles, imgsz=args.window_size, conf=args.conf)
+
+    image_paths = get_jpg_files_path(args.source) if os.path.isdir(args.source) else [args.source]
+    predict_full_frames(predict_fn, image_paths, args.output, class_names=model.names,
+                        window_size=args.window_size, overlap=args.overlap, batch_size=args.batch_size,
+                        merge=args.merge, iou_threshold=args.iou)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+# local HTTP inference server that keeps the OBB model loaded
+#
+# Every request is put on a queue, a single thread takes the requests waiting on the queue as one
+# batch (up to --max-batch images, waiting at most --max-wait-ms after the first one) and runs
+# the model once for the whole batch. Concurrent uploads are therefore batched together while a
+# lone request only waits max_wait_ms.
+# An image larger than the window the model was trained on (a full DJI frame) is cut into
+# overlapping windows as in full_frame_inference.py, the windows go through the same queue and
+# the detections are merged back in frame pixels.
+#
+# POST /predict      body: a jpg or png image, returns {"detections": [...], "latency_ms": ...}
+# GET  /metrics      queue depth, batch sizes, p50/p95/p99 latency of the HTTP requests and of the images queued
+# GET  /health
+#
+# Usage:
+# python inference_server.py runs/obb/train/weights/best.pt --port 8000 --max-batch 16 --max-wait-ms 10
+# curl --data-binary @tile.jpg http://localhost:8000/predict
+
+import io
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+import numpy as np
+from collections import deque
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'utils'))
+from geometry import xywhr_to_corners
+from full_frame_inference import load_model, predict_tiles, predict_full_frame
+
+
+class _Request:
+
+    def __init__(self, image):
+        self.image = image
+        self.arrived = time.perf_counter()
+        self.done = threading.Event()
+        self.detections = None
+        self.error = None
+
+
+class MicroBatcher:
+    '''
+    Group the images submitted from many threads into batches for one predict_fn call.
+
+    Parameters:
+    - predict_fn (callable): takes a list of uint8 RGB images and returns one (K, 7) detection array per image
+    - max_batch_size (int): largest batch sent to predict_fn
+    - max_wait_ms (float): how long the first image of a batch waits for others
+    - window (int): number of recent requests (and images) the latency percentiles are computed on
+
+    The images of the queue (a request of a large frame queues all its windows) are counted in
+    images/image_latencies, the HTTP requests are counted by record_request so that the request
+    metrics stay the latency seen by the clients.
+    '''
+
+    def __init__(self, predict_fn, max_batch_size=16, max_wait_ms=10.0, window=1000):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.latencies = deque(maxlen=window)
+        self.image_latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.images = 0
+        self.image_errors = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, image, timeout=60.0):
+        '''
+        Detect on one image, blocks until its batch has run.
+
+        Returns:
+        - np.ndarray: (K, 7) cx, cy, w, h, r, conf, class_id
+        '''
+        return self.submit_many([image], timeout)[0]
+
+    def submit_many(self, images, timeout=60.0):
+        '''
+        Detect on several images (e.g. the windows of a frame), they are queued together and may
+        share batches with the other requests. Blocks until all of them have run.
+
+        Returns:
+        - list: one (K, 7) detection array per image
+        '''
+        requests = [_Request(image) for image in images]
+        for request in requests:
+            self.queue.put(request)
+        deadline = time.perf_counter() + timeout
+        for request in requests:
+            if not request.done.wait(max(deadline - time.perf_counter(), 0)):
+                raise TimeoutError('the model did not answer in time')
+            if request.error is not None:
+                raise RuntimeError(request.error)
+        return [request.detections for request in requests]
+
+    def record_request(self, seconds, failed=False):
+        '''
+        Count one HTTP request and its latency, however many images it queued.
+        '''
+        with self._lock:
+            self.latencies.append(seconds)
+            self.requests += 1
+            self.errors += failed
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = batch[0].arrived + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self.predict_fn([request.image for request in batch])
+                error = None
+            except Exception as e:
+                results = [None] * len(batch)
+                error = str(e)
+            now = time.perf_counter()
+            with self._lock:
+                self.batch_sizes.append(len(batch))
+                for request, detections in zip(batch, results):
+                    request.detections = detections
+                    request.error = error
+                    self.image_latencies.append(now - request.arrived)
+                    self.images += 1
+                    self.image_errors += error is not None
+            for request in batch:
+                request.done.set()
+
+    def metrics(self):
+        with self._lock:
+            latencies = np.array(self.latencies, dtype=np.float64) * 1000
+            image_latencies = np.array(self.image_latencies, dtype=np.float64) * 1000
+            batch_sizes = np.array(self.batch_sizes, dtype=np.float64)
+            requests, errors, images, image_errors = self.requests, self.errors, self.images, self.image_errors
+        percentiles = np.percentile(latencies, [50, 95, 99]).tolist() if len(latencies) else [0.0, 0.0, 0.0]
+        image_percentiles = np.percentile(image_latencies, [50, 95, 99]).tolist() if len(image_latencies) else [0.0, 0.0, 0.0]
+        return {
+            'queue_depth': self.queue.qsize(),
+            'requests': requests,
+            'errors': errors,
+            'images': images,
+            'image_errors': image_errors,
+            'uptime_s': time.time() - self.started,
+            'batch_size_mean': float(batch_sizes.mean()) if len(batch_sizes) else 0.0,
+            'batch_size_max': int(batch_sizes.max()) if len(batch_sizes) else 0,
+            'latency_ms_p50': percentiles[0],
+            'latency_ms_p95': percentiles[1],
+            'latency_ms_p99': percentiles[2],
+            # time an image (a tile or a window of a frame) waited in the queue and ran in its batch
+            'image_latency_ms_p50': image_percentiles[0],
+            'image_latency_ms_p95': image_percentiles[1],
+            'image_latency_ms_p99': image_percentiles[2],
+        }
+
+
+def detections_to_json(detections, class_names):
+    '''
+    Returns:
+    - list: one dict per detection with the xywhr box, the 4 corners, the confidence and the class
+    '''
+    detections = np.asarray(detections, dtype=np.float64).reshape(-1, 7)
+    corners = xywhr_to_corners(detections, dtype=np.float64)
+    return [{
+        'cx': cx, 'cy': cy, 'w': w, 'h': h, 'r': r, 'conf': conf,
+        'class_id': int(class_id),
+        'class_name': class_names.get(int(class_id), str(int(class_id))),
+        'corners': box_corners,
+    } for (cx, cy, w, h, r, conf, class_id), box_corners in zip(detections.tolist(), np.round(corners, 3).tolist())]
+
+
+def make_handler(batcher, class_names, window_size=256, overlap=64, merge='nms'):
+
+    class InferenceHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._send_json(200, batcher.metrics())
+            elif self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(404, {'error': f'unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send_json(404, {'error': f'unknown path {self.path}'})
+                return
+            start = time.perf_counter()
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                with Image.open(io.BytesIO(self.rfile.read(length))) as image:
+                    frame = np.asarray(image.convert('RGB'))
+            except Exception as e:
+                self._send_json(400, {'error': f'could not read the image: {e}'})
+                batcher.record_request(time.perf_counter() - start, failed=True)
+                return
+            try:
+                if frame.shape[0] > window_size or frame.shape[1] > window_size:
+                    detections, _ = predict_full_frame(batcher.submit_many, frame, window_size, overlap,
+                                                       batch_size=batcher.max_batch_size, merge=merge)
+                else:
+                    detections = batcher.submit(frame)
+            except Exception as e:
+                self._send_json(500, {'error': str(e)})
+                batcher.record_request(time.perf_counter() - start, failed=True)
+                return
+            self._send_json(200, {
+                'width': frame.shape[1],
+                'height': frame.shape[0],
+                'detections': detections_to_json(detections, class_names),
+                'latency_ms': (time.perf_counter() - start) * 1000,
+            })
+            batcher.record_request(time.perf_counter() - start)
+
+        def address_string(self):
+            # a unix socket has no client address
+            return self.client_address[0] if self.client_address else 'unix'
+
+        def log_message(self, format, *args):
+            pass
+
+    return InferenceHandler
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def serve(predict_fn, class_names=None, host='127.0.0.1', port=8000, unix_socket=None, max_batch_size=16, max_wait_ms=10.0,
+          window_size=256, overlap=64, merge='nms'):
+    '''
+    Serve predict_fn over HTTP until interrupted.
+
+    Parameters:
+    - predict_fn (callable): see MicroBatcher
+    - class_names (dict): class_id -> class name
+    - host, port: address of the TCP server, unused with unix_socket
+    - unix_socket (str): path of a unix socket to listen on instead of TCP
+    - max_batch_size, max_wait_ms: see MicroBatcher
+    - window_size (int): size the model was trained on, larger images are detected window by window
+    - overlap, merge: see full_frame_inference.predict_full_frame
+    '''
+    batcher = MicroBatcher(predict_fn, max_batch_size, max_wait_ms)
+    handler = make_handler(batcher, class_names or {}, window_size, overlap, merge)
+    server = UnixHTTPServer(unix_socket, handler) if unix_socket else ThreadingHTTPServer((host, port), handler)
+    print(f"Serving on {unix_socket or f'http://{host}:{port}'} (batches of up to {max_batch_size}, {max_wait_ms} ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-batching inference server for the OBB model.')
+    parser.add_argument('weights', help='path of the trained OBB model, e.g. runs/obb/train/weights/best.pt')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix-socket', default=None, help='listen on this unix socket instead of TCP')
+    parser.add_argument('--max-batch', type=int, default=16)
+    parser.add_argument('--max-wait-ms', type=float, default=10.0)
+    parser.add_argument('--imgsz', type=int, default=256, help='window size the model was trained on, larger images are tiled')
+    parser.add_argument('--overlap', type=int, default=64, help='overlap between the windows of a large image')
+    parser.add_argument('--merge', choices=['nms', 'wbf'], default='nms')
+    parser.add_argument('--conf', type=float, default=0.25)
+    args = parser.parse_args()
+
+    model = load_model(args.weights)
+    # the first call loads the weights on the device, it is not paid by the first request
+    predict_tiles(model, [np.zeros((args.imgsz, args.imgsz, 3), dtype=np.uint8)], imgsz=args.imgsz, conf=args.conf)
+
+    def predict_fn(images):
+        return predict_tiles(model, images, imgsz=args.imgsz, conf=args.conf)
+
+    serve(predict_fn, model.names, args.host, args.port, args.unix_socket, args.max_batch, args.max_wait_ms,
+          args.imgsz, args.overlap, args.merge)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,14 @@
 
 from ultralytics import YOLO
+from training_cache import CachedDetectionTrainer
 
 # Load a model
 model = YOLO("yolov8n.yaml")  # build a new model from scratch
 # model = YOLO("yolov8n.pt")  # load a pretrained model (recommended for training)
 
 # Use the model
-model.train(data="config.yaml", epochs=4)  # train the model
+# the images are decoded once into a memory-mapped cache next to the images folder (see training_cache.py)
+model.train(data="config.yaml", epochs=4, trainer=CachedDetectionTrainer)  # train the model
 # metrics = model.val()  # evaluate model performance on the validation set
 # results = model("https://ultralytics.com/images/bus.jpg")  # predict on an image
 # path = model.export(format="onnx")  # export the model to ONNX format
\ No newline at end of file
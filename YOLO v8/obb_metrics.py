@@ -0,0 +1,138 @@
+# evaluation of an OBB predict function on labeled tiles: AP50 per class, mAP50 and speed
+#
+# The ground truth are label files in the 8 corner format of the converters
+# (x1,y1,x2,y2,x3,y3,x4,y4,class_label,difficulty), the IoU between a detection and a box is the
+# exact area of their intersection (polygon clipping of geometry.py). Any predict function of this
+# folder can be evaluated (predict_tiles of ultralytics, the ONNX or INT8 backends) so that the
+# backends are compared on the same numbers.
+
+import sys
+import time
+import numpy as np
+from pathlib import Path
+from PIL import Image
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'utils'))
+from geometry import obb_iou, xywhr_to_corners
+from miscellaneous import read_obb_label_file
+
+
+def match_detections(corners, confidences, gt_corners, iou_threshold=0.5):
+    '''
+    Greedy matching of the detections of one class on one image, highest confidence first.
+
+    Returns:
+    - np.ndarray: (N,) bool, True for the detections matched to a box not matched before
+    '''
+    true_positives = np.zeros(len(corners), dtype=bool)
+    if len(corners) == 0 or len(gt_corners) == 0:
+        return true_positives
+    iou = obb_iou(corners, gt_corners)
+    matched = np.zeros(len(gt_corners), dtype=bool)
+    for i in np.argsort(-confidences, kind='stable'):
+        candidates = np.where(matched, -1.0, iou[i])
+        best = int(np.argmax(candidates))
+        if candidates[best] >= iou_threshold:
+            matched[best] = True
+            true_positives[i] = True
+    return true_positives
+
+
+def average_precision(true_positives, confidences, gt_count):
+    '''
+    Area under the precision/recall curve, interpolated on 101 recall points (as ultralytics and COCO).
+    '''
+    if gt_count == 0:
+        return float('nan')
+    if len(true_positives) == 0:
+        return 0.0
+    order = np.argsort(-confidences, kind='stable')
+    true_positives = true_positives[order]
+    tp = np.cumsum(true_positives)
+    fp = np.cumsum(~true_positives)
+    recall = tp / gt_count
+    precision = tp / (tp + fp)
+    # precision envelope, then sampled at recall 0, 0.01, ..., 1
+    envelope = np.maximum.accumulate(np.concatenate([precision, [0.0]])[::-1])[::-1]
+    positions = np.searchsorted(recall, np.linspace(0, 1, 101), side='left')
+    return float(np.mean(envelope[positions]))
+
+
+def load_images(image_paths):
+    images = []
+    for image_path in image_paths:
+        with Image.open(image_path) as image:
+            images.append(np.asarray(image.convert('RGB')))
+    return images
+
+
+def evaluate(predict_fn, image_paths, labels_folder, class_names, batch_size=16, iou_threshold=0.5):
+    '''
+    Run predict_fn on labeled images and compute the AP50 of every class.
+
+    Parameters:
+    - predict_fn (callable): takes a list of uint8 RGB images, returns one (K, 7) detection array per image
+    - image_paths (list): paths of the images
+    - labels_folder (str): folder of the labels, <image stem>.txt, a missing label means no boxes
+    - class_names (dict): class_id of the model -> class label of the label files
+    - batch_size (int): number of images per predict_fn call
+    - iou_threshold (float): IoU for a detection to be a true positive
+
+    Returns:
+    - result (dict): 'per_class' {class label: {'ap50', 'boxes', 'detections'}}, 'map50',
+      'images', 'seconds' (inference only), 'images_per_second'
+    '''
+    records = {}
+    gt_counts = {}
+    inference_seconds = 0.0
+    for start in range(0, len(image_paths), batch_size):
+        batch_paths = image_paths[start:start + batch_size]
+        images = load_images(batch_paths)
+        begin = time.perf_counter()
+        batch_detections = predict_fn(images)
+        inference_seconds += time.perf_counter() - begin
+
+        for image_path, detections in zip(batch_paths, batch_detections):
+            label_path = Path(labels_folder) / (Path(image_path).stem + '.txt')
+            if label_path.exists():
+                gt_corners, gt_labels, _ = read_obb_label_file(label_path)
+            else:
+                gt_corners, gt_labels = np.zeros((0, 4, 2)), []
+            gt_labels = np.array(gt_labels, dtype=str)
+            detections = np.asarray(detections, dtype=np.float64).reshape(-1, 7)
+            labels = np.array([class_names.get(int(class_id), str(int(class_id))) for class_id in detections[:, 6]], dtype=str)
+            corners = xywhr_to_corners(detections, dtype=np.float64)
+
+            for class_label in set(gt_labels.tolist()) | set(labels.tolist()):
+                is_class = labels == class_label
+                is_gt = gt_labels == class_label
+                gt_counts[class_label] = gt_counts.get(class_label, 0) + int(is_gt.sum())
+                true_positives = match_detections(corners[is_class], detections[is_class, 5], gt_corners[is_gt], iou_threshold)
+                tp_list, conf_list = records.setdefault(class_label, ([], []))
+                tp_list.append(true_positives)
+                conf_list.append(detections[is_class, 5])
+
+    per_class = {}
+    for class_label in sorted(gt_counts):
+        tp_list, conf_list = records.get(class_label, ([], []))
+        true_positives = np.concatenate(tp_list) if tp_list else np.zeros(0, dtype=bool)
+        confidences = np.concatenate(conf_list) if conf_list else np.zeros(0)
+        per_class[class_label] = {
+            'ap50': average_precision(true_positives, confidences, gt_counts[class_label]),
+            'boxes': gt_counts[class_label],
+            'detections': int(len(true_positives)),
+        }
+    aps = [values['ap50'] for values in per_class.values() if not np.isnan(values['ap50'])]
+    return {
+        'per_class': per_class,
+        'map50': float(np.mean(aps)) if aps else 0.0,
+        'images': len(image_paths),
+        'seconds': inference_seconds,
+        'images_per_second': len(image_paths) / inference_seconds if inference_seconds > 0 else 0.0,
+    }
+
+
+def print_evaluation(name, result):
+    print(f"{name}: mAP50 {result['map50']:.4f}, {result['images_per_second']:.1f} images/s ({result['images']} images)")
+    for class_label, values in result['per_class'].items():
+        print(f"    {class_label}: AP50 {values['ap50']:.4f}, {values['boxes']} boxes, {values['detections']} detections")
@@ -0,0 +1,125 @@
+# numpy operations on oriented boxes
+#
+# Detections are float arrays of shape (N, 7): cx, cy, w, h, rotation (radians), conf, class_id
+# which is the xywhr layout used by ultralytics for OBB results.
+
+import numpy as np
+
+
+def _covariance_matrix(boxes):
+    '''
+    Covariance of the gaussian distribution of xywhr boxes (see ProbIoU).
+
+    Returns:
+    - a, b, c (np.ndarray): the terms of the 2*2 covariance matrix [[a, c], [c, b]], shape (N,)
+    '''
+    a = boxes[:, 2] ** 2 / 12
+    b = boxes[:, 3] ** 2 / 12
+    cos = np.cos(boxes[:, 4])
+    sin = np.sin(boxes[:, 4])
+    return a * cos ** 2 + b * sin ** 2, a * sin ** 2 + b * cos ** 2, (a - b) * cos * sin
+
+
+def batch_probiou(obb1, obb2, eps=1e-7):
+    '''
+    Pairwise probabilistic IoU of two sets of xywhr boxes (https://arxiv.org/abs/2106.06072),
+    the same measure ultralytics uses for rotated NMS.
+
+    Parameters:
+    - obb1 (np.ndarray): (N, >=5) boxes
+    - obb2 (np.ndarray): (M, >=5) boxes
+
+    Returns:
+    - np.ndarray: (N, M) IoU in [0, 1]
+    '''
+    obb1 = np.asarray(obb1, dtype=np.float64)
+    obb2 = np.asarray(obb2, dtype=np.float64)
+    x1, y1 = obb1[:, 0:1], obb1[:, 1:2]
+    x2, y2 = obb2[None, :, 0], obb2[None, :, 1]
+    a1, b1, c1 = (term[:, None] for term in _covariance_matrix(obb1))
+    a2, b2, c2 = (term[None, :] for term in _covariance_matrix(obb2))
+
+    denominator = (a1 + a2) * (b1 + b2) - (c1 + c2) ** 2 + eps
+    t1 = ((a1 + a2) * (y1 - y2) ** 2 + (b1 + b2) * (x1 - x2) ** 2) / denominator * 0.25
+    t2 = ((c1 + c2) * (x2 - x1) * (y1 - y2)) / denominator * 0.5
+    t3 = np.log(denominator / (4 * np.sqrt(np.clip(a1 * b1 - c1 ** 2, 0, None) * np.clip(a2 * b2 - c2 ** 2, 0, None)) + eps) + eps) * 0.5
+    bd = np.clip(t1 + t2 + t3, eps, 100.0)
+    hd = np.sqrt(1.0 - np.exp(-bd) + eps)
+    return 1 - hd
+
+
+def _class_offset_boxes(detections):
+    # move every class far away from the others so that boxes of different classes never overlap
+    boxes = detections[:, :5].astype(np.float64)
+    offset = detections[:, 6:7] * (boxes[:, :4].max() + 1 if len(boxes) else 0)
+    boxes[:, :2] += offset
+    return boxes
+
+
+def rotated_nms(detections, iou_threshold=0.5, class_agnostic=False):
+    '''
+    Vectorized NMS of oriented boxes: a box is dropped if it overlaps any box with a higher conf.
+
+    Parameters:
+    - detections (np.ndarray): (N, 7) cx, cy, w, h, r, conf, class_id
+    - iou_threshold (float): boxes overlapping more than this are duplicates
+    - class_agnostic (bool): also suppress boxes of different classes
+
+    Returns:
+    - np.ndarray: the kept detections sorted by conf
+    '''
+    if len(detections) == 0:
+        return detections
+    detections = detections[np.argsort(-detections[:, 5], kind='stable')]
+    boxes = detections[:, :5] if class_agnostic else _class_offset_boxes(detections)
+    ious = np.triu(batch_probiou(boxes, boxes), k=1)
+    keep = ious.max(axis=0) < iou_threshold
+    return detections[keep]
+
+
+def weighted_boxes_fusion(detections, iou_threshold=0.5, class_agnostic=False):
+    '''
+    Fuse the overlapping oriented boxes instead of dropping them: every box joins the
+    cluster of the highest conf box it overlaps, a cluster becomes its conf weighted mean box.
+
+    Parameters:
+    - detections (np.ndarray): (N, 7) cx, cy, w, h, r, conf, class_id
+    - iou_threshold (float): boxes overlapping more than this belong to the same object
+    - class_agnostic (bool): also fuse boxes of different classes
+
+    Returns:
+    - np.ndarray: (K, 7) fused detections sorted by conf
+    '''
+    if len(detections) == 0:
+        return detections
+    detections = detections[np.argsort(-detections[:, 5], kind='stable')].astype(np.float64)
+    boxes = detections[:, :5] if class_agnostic else _class_offset_boxes(detections)
+    ious = np.triu(batch_probiou(boxes, boxes), k=1)
+    is_anchor = ious.max(axis=0) < iou_threshold
+
+    # first (highest conf) anchor overlapping each box, an anchor is its own cluster
+    overlaps_anchor = (ious >= iou_threshold) & is_anchor[:, None]
+    cluster = np.where(is_anchor, np.arange(len(detections)), np.argmax(overlaps_anchor, axis=0))
+    # boxes that only overlap boxes which were themselves fused start their own cluster
+    orphan = ~is_anchor & ~overlaps_anchor.any(axis=0)
+    cluster[orphan] = np.nonzero(orphan)[0]
+
+    # bring every box to the angle of its anchor, swapping w and h when it is described
+    # by the other side, so the angles can be averaged
+    anchor_angle = detections[cluster, 4]
+    delta = (detections[:, 4] - anchor_angle + np.pi / 2) % np.pi - np.pi / 2
+    swap = np.abs(delta) > np.pi / 4
+    delta = np.where(swap, delta - np.sign(delta) * np.pi / 2, delta)
+    w = np.where(swap, detections[:, 3], detections[:, 2])
+    h = np.where(swap, detections[:, 2], detections[:, 3])
+    aligned = np.stack([detections[:, 0], detections[:, 1], w, h, anchor_angle + delta], axis=1)
+
+    anchors, inverse, counts = np.unique(cluster, return_inverse=True, return_counts=True)
+    conf = detections[:, 5]
+    weight_sum = np.bincount(inverse, weights=conf)
+    fused = np.zeros((len(anchors), 7))
+    for column in range(5):
+        fused[:, column] = np.bincount(inverse, weights=aligned[:, column] * conf) / weight_sum
+    fused[:, 5] = weight_sum / counts
+    fused[:, 6] = detections[anchors, 6]
+    return fused[np.argsort(-fused[:, 5], kind='stable')]
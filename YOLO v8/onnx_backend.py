@@ -0,0 +1,308 @@
+# ONNX Runtime backend of the OBB model for CPU inference
+#
+# The trained model is exported to ONNX once by ultralytics, then run by an onnxruntime CPU session
+# without torch. The letterbox, the decoding of the raw output (xywh, class scores, angle) and the
+# rotated NMS are done in numpy the same way ultralytics does them, so OnnxObbModel is a drop-in
+# replacement of predict_tiles: it takes a list of uint8 RGB images and returns one (K, 7)
+# cx, cy, w, h, r, conf, class_id array per image.
+#
+# The report checks that both backends give the same detections on a sample of labeled tiles and
+# compares their speed (images/s) and their mAP50.
+#
+# Usage:
+# python onnx_backend.py export runs/obb/train/weights/best.pt --imgsz 256
+# python onnx_backend.py report runs/obb/train/weights/best.pt runs/obb/train/weights/best.onnx <tiles folder> <labels folder>
+#                               [--limit 500] [--threads 4] [--output report.json]
+
+import ast
+import sys
+import json
+import argparse
+import numpy as np
+from pathlib import Path
+from PIL import Image
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'utils'))
+from crop import get_jpg_files_path
+from obb_ops import batch_probiou, rotated_nms
+from obb_metrics import evaluate, print_evaluation, load_images
+from full_frame_inference import load_model, predict_tiles
+
+
+def export_onnx(weights, imgsz=256, opset=12, dynamic=True, simplify=True):
+    '''
+    Export an ultralytics OBB model to ONNX.
+
+    Parameters:
+    - weights (str): path of the trained model, e.g. runs/obb/train/weights/best.pt
+    - imgsz (int): input size of the exported graph
+    - opset (int): ONNX opset
+    - dynamic (bool): dynamic batch size, needed to send batches of tiles
+    - simplify (bool): run onnxslim on the graph
+
+    Returns:
+    - str: path of the .onnx file, next to the weights
+    '''
+    model = load_model(weights)
+    return model.export(format='onnx', imgsz=imgsz, opset=opset, dynamic=dynamic, simplify=simplify)
+
+
+def letterbox(image, imgsz=256, pad_value=114):
+    '''
+    Resize an image keeping its aspect ratio and pad it to imgsz*imgsz, centered as ultralytics does.
+
+    Returns:
+    - letterboxed (np.ndarray): (imgsz, imgsz, 3) uint8
+    - ratio (float): resize factor
+    - pad (tuple): (left, top) padding in pixels
+    '''
+    height, width = image.shape[:2]
+    ratio = min(imgsz / height, imgsz / width)
+    new_width, new_height = int(round(width * ratio)), int(round(height * ratio))
+    if (new_width, new_height) != (width, height):
+        image = np.asarray(Image.fromarray(image).resize((new_width, new_height), Image.BILINEAR))
+    left = int(round((imgsz - new_width) / 2 - 0.1))
+    top = int(round((imgsz - new_height) / 2 - 0.1))
+    letterboxed = np.full((imgsz, imgsz, 3), pad_value, dtype=np.uint8)
+    letterboxed[top:top + new_height, left:left + new_width] = image
+    return letterboxed, ratio, (left, top)
+
+
+def regularize_rboxes(boxes):
+    '''
+    Put the angles of xywhr boxes in [0, pi/2), swapping w and h when needed (as ultralytics).
+    '''
+    boxes = boxes.copy()
+    swap = boxes[:, 4] % np.pi >= np.pi / 2
+    boxes[swap, 2], boxes[swap, 3] = boxes[swap, 3], boxes[swap, 2]
+    boxes[:, 4] = boxes[:, 4] % (np.pi / 2)
+    return boxes
+
+
+def decode_output(output, conf=0.25, iou=0.7, max_det=300):
+    '''
+    Decode the raw output of an exported OBB model for one image.
+
+    Parameters:
+    - output (np.ndarray): (4 + number of classes + 1, anchors) xywh, class scores, angle
+    - conf (float): confidence threshold
+    - iou (float): NMS threshold
+    - max_det (int): most detections kept
+
+    Returns:
+    - np.ndarray: (K, 7) float32 cx, cy, w, h, r, conf, class_id in letterboxed pixels
+    '''
+    predictions = output.T
+    scores = predictions[:, 4:-1]
+    class_ids = scores.argmax(axis=1)
+    confidences = scores[np.arange(len(scores)), class_ids]
+    keep = confidences > conf
+    if not keep.any():
+        return np.zeros((0, 7), dtype=np.float32)
+    detections = np.concatenate([
+        predictions[keep, :4],
+        predictions[keep, -1:],
+        confidences[keep, None],
+        class_ids[keep, None],
+    ], axis=1).astype(np.float64)
+    detections = rotated_nms(detections, iou)[:max_det]
+    detections[:, :5] = regularize_rboxes(detections[:, :5])
+    return detections.astype(np.float32)
+
+
+class OnnxObbModel:
+    '''
+    OBB model run by an onnxruntime CPU session, called like predict_tiles.
+
+    Parameters:
+    - onnx_path (str): exported model
+    - imgsz (int): inference size, defaults to the size the model was exported with
+    - conf (float): confidence threshold
+    - iou (float): NMS threshold inside an image
+    - intra_op_threads (int): threads used inside an operator, None lets onnxruntime use all the cores
+    - inter_op_threads (int): threads running independent operators, 1 is best for a sequential graph
+    '''
+
+    def __init__(self, onnx_path, imgsz=None, conf=0.25, iou=0.7, intra_op_threads=None, inter_op_threads=1):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        self.session = ort.InferenceSession(str(onnx_path), options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+        # ultralytics stores the class names and the export size in the metadata of the graph
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.names = ast.literal_eval(metadata['names']) if 'names' in metadata else {}
+        exported_size = ast.literal_eval(metadata['imgsz'])[0] if 'imgsz' in metadata else 256
+        self.imgsz = imgsz or exported_size
+        self.conf = conf
+        self.iou = iou
+
+    def preprocess(self, images):
+        '''
+        Returns:
+        - batch (np.ndarray): (N, 3, imgsz, imgsz) float32 in [0, 1]
+        - transforms (list): (ratio, (left, top)) of every image
+        '''
+        letterboxed, transforms = [], []
+        for image in images:
+            boxed, ratio, pad = letterbox(np.asarray(image), self.imgsz)
+            letterboxed.append(boxed)
+            transforms.append((ratio, pad))
+        batch = np.stack(letterboxed).transpose(0, 3, 1, 2).astype(np.float32) / 255
+        return np.ascontiguousarray(batch), transforms
+
+    def __call__(self, images):
+        '''
+        Parameters:
+        - images: uint8 RGB images, a (N, H, W, 3) array or a list of (H, W, 3) images of any size
+
+        Returns:
+        - list: one (K, 7) float32 array (cx, cy, w, h, r, conf, class_id) per image, in image pixels
+        '''
+        if len(images) == 0:
+            return []
+        batch, transforms = self.preprocess(images)
+        outputs = self.session.run(None, {self.input_name: batch})[0]
+        detections = []
+        for output, (ratio, (left, top)) in zip(outputs, transforms):
+            image_detections = decode_output(output, self.conf, self.iou)
+            image_detections[:, 0] = (image_detections[:, 0] - left) / ratio
+            image_detections[:, 1] = (image_detections[:, 1] - top) / ratio
+            image_detections[:, 2:4] /= ratio
+            detections.append(image_detections)
+        return detections
+
+
+def parity_check(reference_fn, candidate_fn, images, batch_size=16, min_iou=0.9, conf_tolerance=0.02):
+    '''
+    Compare the detections of two backends on the same images.
+
+    A reference detection is matched to the candidate detection of the same class with the highest
+    probiou, it agrees if that IoU is at least min_iou and the confidences differ by at most conf_tolerance.
+
+    Returns:
+    - dict: 'reference', 'candidate' (detection counts), 'matched', 'agreement' (matched / reference),
+      'min_iou', 'max_conf_difference' of the matched detections
+    '''
+    reference_count, candidate_count, matched = 0, 0, 0
+    min_matched_iou, max_conf_difference = 1.0, 0.0
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        for reference, candidate in zip(reference_fn(batch), candidate_fn(batch)):
+            reference_count += len(reference)
+            candidate_count += len(candidate)
+            if len(reference) == 0 or len(candidate) == 0:
+                continue
+            ious = batch_probiou(reference, candidate)
+            ious[reference[:, 6:7] != candidate[None, :, 6]] = 0
+            best = ious.argmax(axis=1)
+            best_ious = ious[np.arange(len(reference)), best]
+            conf_differences = np.abs(reference[:, 5] - candidate[best, 5])
+            agree = (best_ious >= min_iou) & (conf_differences <= conf_tolerance)
+            matched += int(agree.sum())
+            if agree.any():
+                min_matched_iou = min(min_matched_iou, float(best_ious[agree].min()))
+                max_conf_difference = max(max_conf_difference, float(conf_differences[agree].max()))
+    return {
+        'reference': reference_count,
+        'candidate': candidate_count,
+        'matched': matched,
+        'agreement': matched / reference_count if reference_count else 1.0,
+        'min_iou': min_matched_iou,
+        'max_conf_difference': max_conf_difference,
+    }
+
+
+def compare_backends(backends, image_paths, labels_folder, class_names, batch_size=16, parity_images=64):
+    '''
+    Evaluate several predict functions on the same labeled images, the first one is the reference
+    the others are checked against.
+
+    Parameters:
+    - backends (dict): name -> predict function (list of images -> list of (K, 7) detections)
+    - image_paths (list): labeled tiles
+    - labels_folder (str): labels of the tiles
+    - class_names (dict): class_id -> class label of the label files
+    - batch_size (int): images per call
+    - parity_images (int): number of images the detections are compared on
+
+    Returns:
+    - dict: name -> {'evaluation': see obb_metrics.evaluate, 'parity': see parity_check (not for the reference)}
+    '''
+    names = list(backends)
+    sample = load_images(image_paths[:parity_images])
+    report = {}
+    for name in names:
+        # one untimed call so the first batch does not pay for the lazy initialisations
+        backends[name](sample[:1])
+        report[name] = {'evaluation': evaluate(backends[name], image_paths, labels_folder, class_names, batch_size)}
+        if name != names[0]:
+            report[name]['parity'] = parity_check(backends[names[0]], backends[name], sample, batch_size)
+    return report
+
+
+def print_report(report):
+    reference = None
+    for name, result in report.items():
+        print_evaluation(name, result['evaluation'])
+        if reference is None:
+            reference = result['evaluation']
+            continue
+        evaluation = result['evaluation']
+        speedup = evaluation['images_per_second'] / reference['images_per_second'] if reference['images_per_second'] else 0.0
+        print(f"    {speedup:.2f}x the speed, mAP50 {evaluation['map50'] - reference['map50']:+.4f}")
+        parity = result.get('parity')
+        if parity is not None:
+            print(f"    parity: {parity['matched']}/{parity['reference']} detections agree ({parity['agreement']:.1%}), "
+                  f"min IoU {parity['min_iou']:.3f}, max conf difference {parity['max_conf_difference']:.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ONNX export and ONNX Runtime CPU backend of the OBB model.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='export the trained model to ONNX')
+    export_parser.add_argument('weights')
+    export_parser.add_argument('--imgsz', type=int, default=256)
+    export_parser.add_argument('--opset', type=int, default=12)
+
+    report_parser = subparsers.add_parser('report', help='compare the speed and the mAP of the PyTorch and ONNX backends')
+    report_parser.add_argument('weights', help='the .pt model')
+    report_parser.add_argument('onnx', help='the exported .onnx model')
+    report_parser.add_argument('images', help='folder of labeled tiles')
+    report_parser.add_argument('labels', help='labels of the tiles in the 8 corner format')
+    report_parser.add_argument('--imgsz', type=int, default=256)
+    report_parser.add_argument('--conf', type=float, default=0.25)
+    report_parser.add_argument('--batch-size', type=int, default=16)
+    report_parser.add_argument('--limit', type=int, default=None, help='evaluate on the first N tiles only')
+    report_parser.add_argument('--threads', type=int, default=None, help='intra-op threads of onnxruntime')
+    report_parser.add_argument('--output', default=None, help='json file the report is saved to')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        print(f'Exported to {export_onnx(args.weights, args.imgsz, args.opset)}')
+        return
+
+    model = load_model(args.weights)
+    onnx_model = OnnxObbModel(args.onnx, args.imgsz, args.conf, intra_op_threads=args.threads)
+    image_paths = sorted(get_jpg_files_path(args.images))[:args.limit]
+    backends = {
+        'pytorch': lambda images: predict_tiles(model, images, imgsz=args.imgsz, conf=args.conf),
+        'onnxruntime': onnx_model,
+    }
+    report = compare_backends(backends, image_paths, args.labels, model.names, args.batch_size)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'Report saved to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+# INT8 static quantization of the exported OBB model, calibrated on our own tiles
+#
+# The activations ranges are calibrated on a random sample of the tiles written by crop.py, the
+# same letterbox as the ONNX backend is used so the calibration sees what the model sees at
+# inference. The quantized model is run through OnnxObbModel (same API as predict_tiles) and
+# compared to the FP32 ONNX model on the other labeled tiles (never the calibration ones):
+# latency, mAP50 and AP50 of every class.
+# The model is only copied to the deployment path when the accuracy drop is within the budget.
+#
+# Usage:
+# python quantize.py runs/obb/train/weights/best.onnx <tiles folder> <labels folder>
+#                    [--calibration-tiles 300] [--calibration-images <folder>] [--method minmax] [--max-map-drop 0.01] [--max-class-drop 0.03]
+#                    [--deploy <path of the deployed model>]
+
+import os
+import re
+import sys
+import json
+import random
+import shutil
+import argparse
+import numpy as np
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'utils'))
+from crop import get_jpg_files_path
+from label_writer import atomic_path
+from obb_metrics import load_images
+from onnx_backend import OnnxObbModel, letterbox, compare_backends, print_report
+
+
+class TileCalibrationReader:
+    '''
+    Feed letterboxed batches of tiles to the onnxruntime calibrator
+    (the get_next / rewind interface of onnxruntime.quantization.CalibrationDataReader).
+
+    Parameters:
+    - tile_paths (list): tiles used for the calibration
+    - input_name (str): name of the input of the graph
+    - imgsz (int): input size of the graph
+    - batch_size (int): tiles per batch, 1 works with graphs exported without a dynamic batch
+    '''
+
+    def __init__(self, tile_paths, input_name='images', imgsz=256, batch_size=1):
+        self.tile_paths = list(tile_paths)
+        self.input_name = input_name
+        self.imgsz = imgsz
+        self.batch_size = batch_size
+        self.position = 0
+
+    def get_next(self):
+        if self.position >= len(self.tile_paths):
+            return None
+        batch_paths = self.tile_paths[self.position:self.position + self.batch_size]
+        self.position += self.batch_size
+        letterboxed = [letterbox(image, self.imgsz)[0] for image in load_images(batch_paths)]
+        batch = np.stack(letterboxed).transpose(0, 3, 1, 2).astype(np.float32) / 255
+        return {self.input_name: np.ascontiguousarray(batch)}
+
+    def rewind(self):
+        self.position = 0
+
+    def __iter__(self):
+        self.rewind()
+        return iter(self.get_next, None)
+
+
+def sample_tiles(tile_paths, count, seed=0):
+    '''
+    Random sample of tiles, the same for a given seed.
+    '''
+    tile_paths = sorted(tile_paths)
+    if count is None or count >= len(tile_paths):
+        return tile_paths
+    return sorted(random.Random(seed).sample(tile_paths, count))
+
+
+def split_tiles(tile_paths, calibration_count, seed=0):
+    '''
+    Seeded split of the tiles into disjoint calibration and evaluation sets, the accuracy of the
+    quantized model is only measured on tiles it was not calibrated on.
+
+    Returns:
+    - calibration_paths (list), evaluation_paths (list): both sorted
+    '''
+    calibration_paths = sample_tiles(tile_paths, min(calibration_count, max(len(tile_paths) - 1, 0)), seed)
+    calibration_set = set(calibration_paths)
+    return calibration_paths, [tile_path for tile_path in sorted(tile_paths) if tile_path not in calibration_set]
+
+
+def head_nodes(onnx_path):
+    '''
+    Names of the nodes of the detection head (the last /model.<index>/ module of an ultralytics export),
+    they decode the boxes and the angle and lose the most accuracy when quantized.
+    '''
+    import onnx
+
+    model = onnx.load(str(onnx_path), load_external_data=False)
+    indices = {}
+    for node in model.graph.node:
+        match = re.match(r'^/model\.(\d+)/', node.name)
+        if match:
+            indices[node.name] = int(match.group(1))
+    if not indices:
+        return []
+    last = max(indices.values())
+    return [name for name, index in indices.items() if index == last]
+
+
+def quantize_model(onnx_path, output_path, calibration_paths, imgsz=256, method='minmax', per_channel=True,
+                   exclude_head=True, batch_size=1):
+    '''
+    Static INT8 quantization (QDQ format, uint8 activations and int8 weights).
+
+    Parameters:
+    - onnx_path (str): FP32 model exported by onnx_backend.export_onnx
+    - output_path (str): path of the quantized model
+    - calibration_paths (list): tiles the activation ranges are calibrated on
+    - imgsz (int): input size of the graph
+    - method (str): 'minmax', 'entropy' or 'percentile' calibration
+    - per_channel (bool): one scale per output channel of the convolutions
+    - exclude_head (bool): keep the detection head in FP32
+    - batch_size (int): tiles per calibration batch
+
+    Returns:
+    - str: output_path
+    '''
+    import onnxruntime as ort
+    from onnxruntime.quantization import quantize_static, QuantFormat, QuantType, CalibrationMethod
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    methods = {
+        'minmax': CalibrationMethod.MinMax,
+        'entropy': CalibrationMethod.Entropy,
+        'percentile': CalibrationMethod.Percentile,
+    }
+    # shape inference and constant folding first, as recommended before static quantization
+    prepared_path = f'{output_path}.prepared.onnx'
+    quant_pre_process(str(onnx_path), prepared_path)
+    try:
+        input_name = ort.InferenceSession(prepared_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+        reader = TileCalibrationReader(calibration_paths, input_name, imgsz, batch_size)
+        quantize_static(
+            prepared_path,
+            str(output_path),
+            reader,
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=per_channel,
+            calibrate_method=methods[method],
+            nodes_to_exclude=head_nodes(prepared_path) if exclude_head else [],
+        )
+    finally:
+        if os.path.exists(prepared_path):
+            os.remove(prepared_path)
+    return str(output_path)
+
+
+def accuracy_gate(reference, candidate, max_map_drop=0.01, max_class_drop=None):
+    '''
+    Check that the quantized model stays within the accuracy budget.
+
+    Parameters:
+    - reference, candidate (dict): results of obb_metrics.evaluate of the FP32 and INT8 models
+    - max_map_drop (float): largest allowed drop of mAP50
+    - max_class_drop (float): largest allowed drop of the AP50 of any class, None to not check
+
+    Returns:
+    - passed (bool)
+    - reasons (list): why the model is refused
+    '''
+    reasons = []
+    map_drop = reference['map50'] - candidate['map50']
+    if map_drop > max_map_drop:
+        reasons.append(f'mAP50 dropped by {map_drop:.4f} (budget {max_map_drop})')
+    if max_class_drop is not None:
+        for class_label, values in reference['per_class'].items():
+            if np.isnan(values['ap50']):
+                continue
+            class_drop = values['ap50'] - candidate['per_class'].get(class_label, {'ap50': 0.0})['ap50']
+            if class_drop > max_class_drop:
+                reasons.append(f'AP50 of {class_label} dropped by {class_drop:.4f} (budget {max_class_drop})')
+    return not reasons, reasons
+
+
+def print_class_deltas(reference, candidate):
+    print('class: AP50 fp32 -> int8 (delta)')
+    for class_label, values in reference['per_class'].items():
+        if np.isnan(values['ap50']):
+            continue
+        quantized_ap = candidate['per_class'].get(class_label, {'ap50': 0.0})['ap50']
+        print(f"    {class_label}: {values['ap50']:.4f} -> {quantized_ap:.4f} ({quantized_ap - values['ap50']:+.4f})")
+    reference_ms = 1000 / reference['images_per_second'] if reference['images_per_second'] else 0.0
+    candidate_ms = 1000 / candidate['images_per_second'] if candidate['images_per_second'] else 0.0
+    print(f'latency: {reference_ms:.2f} -> {candidate_ms:.2f} ms/image '
+          f'({reference_ms / candidate_ms if candidate_ms else 0.0:.2f}x faster)')
+
+
+def deploy(model_path, deploy_path):
+    '''
+    Copy the model to deploy_path, the deployed model is replaced in one step.
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(deploy_path)), exist_ok=True)
+    with atomic_path(deploy_path) as temporary_path:
+        shutil.copyfile(model_path, temporary_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='INT8 static quantization of the OBB model calibrated on our tiles.')
+    parser.add_argument('onnx', help='FP32 model exported with onnx_backend.py export')
+    parser.add_argument('images', help='folder of tiles written by crop.py, split into calibration and evaluation tiles')
+    parser.add_argument('labels', help='labels of the tiles in the 8 corner format')
+    parser.add_argument('--output', default=None, help='path of the quantized model, default <model>.int8.onnx')
+    parser.add_argument('--imgsz', type=int, default=256)
+    parser.add_argument('--conf', type=float, default=0.25)
+    parser.add_argument('--calibration-tiles', type=int, default=300, help='number of tiles sampled for the calibration')
+    parser.add_argument('--calibration-images', default=None,
+                        help='folder of calibration tiles, then all the tiles of images are used for the evaluation')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the calibration/evaluation split')
+    parser.add_argument('--method', choices=['minmax', 'entropy', 'percentile'], default='minmax')
+    parser.add_argument('--quantize-head', action='store_true', help='also quantize the detection head')
+    parser.add_argument('--limit', type=int, default=None, help='evaluate on the first N evaluation tiles only')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads of onnxruntime')
+    parser.add_argument('--max-map-drop', type=float, default=0.01, help='accuracy budget: largest allowed drop of mAP50')
+    parser.add_argument('--max-class-drop', type=float, default=None, help='largest allowed drop of the AP50 of any class')
+    parser.add_argument('--deploy', default=None, help='copy the quantized model here if it is within the budget')
+    parser.add_argument('--report', default=None, help='json file the report is saved to')
+    args = parser.parse_args()
+
+    output_path = args.output or str(Path(args.onnx).with_suffix('.int8.onnx'))
+    tile_paths = get_jpg_files_path(args.images)
+    if args.calibration_images:
+        calibration_paths = sample_tiles(get_jpg_files_path(args.calibration_images), args.calibration_tiles, args.seed)
+        # a tile of both folders is left out of the evaluation
+        calibration_names = {Path(calibration_path).name for calibration_path in calibration_paths}
+        evaluation_paths = [tile_path for tile_path in sorted(tile_paths) if Path(tile_path).name not in calibration_names]
+    else:
+        calibration_paths, evaluation_paths = split_tiles(tile_paths, args.calibration_tiles, args.seed)
+    evaluation_paths = evaluation_paths[:args.limit]
+    if not evaluation_paths:
+        print('No tiles left for the evaluation, add tiles or lower --calibration-tiles')
+        sys.exit(1)
+    print(f'Calibrating on {len(calibration_paths)} tiles ({args.method}), evaluating on {len(evaluation_paths)} other tiles')
+    quantize_model(args.onnx, output_path, calibration_paths, args.imgsz, args.method, exclude_head=not args.quantize_head)
+    print(f'Quantized model saved to {output_path}')
+
+    reference_model = OnnxObbModel(args.onnx, args.imgsz, args.conf, intra_op_threads=args.threads)
+    quantized_model = OnnxObbModel(output_path, args.imgsz, args.conf, intra_op_threads=args.threads)
+    report = compare_backends({'fp32': reference_model, 'int8': quantized_model},
+                              evaluation_paths, args.labels, reference_model.names)
+    print_report(report)
+    reference, candidate = report['fp32']['evaluation'], report['int8']['evaluation']
+    print_class_deltas(reference, candidate)
+
+    passed, reasons = accuracy_gate(reference, candidate, args.max_map_drop, args.max_class_drop)
+    report['gate'] = {'passed': passed, 'reasons': reasons, 'max_map_drop': args.max_map_drop, 'max_class_drop': args.max_class_drop,
+                      'calibration_tiles': len(calibration_paths), 'evaluation_tiles': len(evaluation_paths)}
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'Report saved to {args.report}')
+
+    if not passed:
+        for reason in reasons:
+            print(f'Refused: {reason}')
+        sys.exit(1)
+    print('Within the accuracy budget')
+    if args.deploy:
+        deploy(output_path, args.deploy)
+        print(f'Deployed to {args.deploy}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+# pre-decoded training cache: every image is decoded and resized once, training reads a memmap
+#
+# ultralytics decodes every jpg again at every epoch, on the CPU training nodes the dataloader
+# is slower than the model. The cache of a split '<cache_path>' is made of (like tile_shards.py):
+# - <cache_path>.images      raw uint8 (N, imgsz, imgsz, 3) BGR images, letterboxed (centered, black padding)
+# - <cache_path>.index.npy   one record per image (see INDEX_DTYPE)
+# - <cache_path>.labels.npy  float32 (M, C) rows of the yolo label files, class then normalized coordinates
+# - <cache_path>.json        imgsz, number of images, image paths and the signature of the sources
+#
+# The images are resized exactly as ultralytics does (long side to imgsz, cv2 linear), so the
+# augmentations get the same pixels as without the cache. The signature is a hash of the content
+# of every label file and of the path, size and modification time of every image: any change rebuilds
+# the cache. An image rewritten with the same size and modification time (rsync -t, a restored backup)
+# is only noticed with --hash-images, which hashes the content of the images too (reads the whole dataset).
+#
+# Usage:
+# python training_cache.py config.yaml --imgsz 640 [--hash-images]   build the caches of train and val ahead
+# in python: model.train(data='config.yaml', trainer=CachedDetectionTrainer)   (CachedOBBTrainer for OBB)
+
+import os
+import json
+import math
+import hashlib
+import argparse
+import numpy as np
+import cv2
+import yaml
+from pathlib import Path
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.data.utils import IMG_FORMATS, img2label_paths
+from ultralytics.models.yolo.detect import DetectionTrainer
+from ultralytics.models.yolo.obb import OBBTrainer
+from ultralytics.utils import colorstr
+from ultralytics.utils.torch_utils import de_parallel
+
+CACHE_VERSION = 2
+
+INDEX_DTYPE = np.dtype([
+    ('height0', np.int32),       # size of the image on disk
+    ('width0', np.int32),
+    ('height', np.int32),        # size after the resize, the rest of the imgsz*imgsz cell is padding
+    ('width', np.int32),
+    ('top', np.int32),           # position of the resized image in the cell
+    ('left', np.int32),
+    ('label_offset', np.int64),  # first row of the image in .labels.npy
+    ('label_count', np.int32),   # number of rows of the label file
+    ('valid', np.bool_),         # False if the image could not be read, it is then decoded by ultralytics
+])
+
+
+def _file_digest(path, chunk_size=1 << 20):
+    '''
+    sha1 of the content of a file, 'missing' if it does not exist.
+    '''
+    try:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    except FileNotFoundError:
+        return 'missing'
+
+
+def _stat_digest(path):
+    try:
+        stat = os.stat(path)
+        return f'{stat.st_size}:{stat.st_mtime_ns}'
+    except FileNotFoundError:
+        return 'missing'
+
+
+def source_signature(image_paths, imgsz, hash_images=False, num_threads=16):
+    '''
+    Hash of the content of the label files and of the path, size and modification time of the images.
+
+    Parameters:
+    - image_paths (list): images of the split
+    - imgsz (int): training size
+    - hash_images (bool): hash the content of the images instead of their size and modification time
+    - num_threads (int): files hashed in parallel (hashlib releases the GIL, the reads overlap)
+    '''
+    pairs = sorted(zip(image_paths, img2label_paths(image_paths)))
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        label_digests = list(executor.map(_file_digest, [label_path for _, label_path in pairs]))
+        image_digest = _file_digest if hash_images else _stat_digest
+        image_digests = list(executor.map(image_digest, [image_path for image_path, _ in pairs]))
+    digest = hashlib.sha1(f'{CACHE_VERSION}:{imgsz}:{hash_images}'.encode())
+    for (image_path, label_path), image_digest, label_digest in zip(pairs, image_digests, label_digests):
+        digest.update(f'{image_path}:{image_digest}|{label_path}:{label_digest};'.encode())
+    return digest.hexdigest()
+
+
+def resized_shape(height0, width0, imgsz):
+    # BaseDataset.load_image with rect_mode: the long side is resized to imgsz
+    ratio = imgsz / max(height0, width0)
+    if ratio == 1:
+        return height0, width0
+    return min(math.ceil(height0 * ratio), imgsz), min(math.ceil(width0 * ratio), imgsz)
+
+
+def read_yolo_label_file(label_path):
+    '''
+    Returns:
+    - np.ndarray: float32 (M, C) rows of a yolo label file (class then normalized coordinates)
+    '''
+    if not os.path.isfile(label_path):
+        return np.zeros((0, 0), dtype=np.float32)
+    with open(label_path, 'r') as file:
+        rows = [line.split() for line in file.read().strip().splitlines() if line.strip()]
+    if not rows:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.array(rows, dtype=np.float32)
+
+
+def _cache_images_worker(task):
+    '''
+    Decode, resize and write a chunk of images into the memmap, inside the process pool, never raises.
+
+    Returns:
+    - list: (index, record fields, label rows, error) of every image of the chunk
+    '''
+    images_path, count, imgsz, chunk = task
+    images = np.memmap(images_path, dtype=np.uint8, mode='r+', shape=(count, imgsz, imgsz, 3))
+    results = []
+    for index, image_path, label_path in chunk:
+        try:
+            image = cv2.imread(image_path)
+            if image is None:
+                raise ValueError('cv2 could not decode the image')
+            height0, width0 = image.shape[:2]
+            height, width = resized_shape(height0, width0, imgsz)
+            if (height, width) != (height0, width0):
+                image = cv2.resize(image, (width, height), interpolation=cv2.INTER_LINEAR)
+            top, left = (imgsz - height) // 2, (imgsz - width) // 2
+            images[index] = 0
+            images[index, top:top + height, left:left + width] = image
+            results.append((index, (height0, width0, height, width, top, left), read_yolo_label_file(label_path), None))
+        except Exception as e:
+            results.append((index, None, np.zeros((0, 0), dtype=np.float32), str(e)))
+    images.flush()
+    del images
+    return results
+
+
+def build_training_cache(image_paths, cache_path, imgsz=640, num_workers=None, chunksize=64, force=False, hash_images=False):
+    '''
+    Build the cache of a list of images, or reuse it if the sources did not change.
+
+    Parameters:
+    - image_paths (list): images of the split, their labels are found as ultralytics does (images/ -> labels/)
+    - cache_path (str): path of the cache without extension
+    - imgsz (int): training size
+    - num_workers (int): processes decoding the images
+    - chunksize (int): images per task of the pool
+    - force (bool): rebuild even if the cache is up to date
+    - hash_images (bool): compare the content of the images to the cache, not only their size and modification time
+
+    Returns:
+    - TrainingCache: the cache, opened
+    '''
+    image_paths = [os.path.abspath(image_path) for image_path in image_paths]
+    cache_path = str(cache_path)
+    signature = source_signature(image_paths, imgsz, hash_images)
+    if not force and os.path.exists(cache_path + '.json'):
+        with open(cache_path + '.json', 'r') as file:
+            if json.load(file).get('signature') == signature:
+                return TrainingCache(cache_path)
+
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    # the metadata is written last, a cache without it is incomplete
+    if os.path.exists(cache_path + '.json'):
+        os.remove(cache_path + '.json')
+
+    count = len(image_paths)
+    images = np.memmap(cache_path + '.images', dtype=np.uint8, mode='w+', shape=(max(count, 1), imgsz, imgsz, 3))
+    del images
+    label_paths = img2label_paths(image_paths)
+    items = [(index, image_path, label_path) for index, (image_path, label_path) in enumerate(zip(image_paths, label_paths))]
+    tasks = [(cache_path + '.images', max(count, 1), imgsz, items[i:i + chunksize]) for i in range(0, count, chunksize)]
+
+    index = np.zeros(count, dtype=INDEX_DTYPE)
+    label_rows = [None] * count
+    failed = []
+    with Pool(processes=num_workers) as pool:
+        for results in pool.imap_unordered(_cache_images_worker, tasks):
+            for i, fields, rows, error in results:
+                label_rows[i] = rows
+                if error is not None:
+                    failed.append((image_paths[i], error))
+                    continue
+                for name, value in zip(('height0', 'width0', 'height', 'width', 'top', 'left'), fields):
+                    index[name][i] = value
+                index['valid'][i] = True
+
+    columns = max((rows.shape[1] for rows in label_rows if rows is not None and len(rows)), default=0)
+    offset = 0
+    for i, rows in enumerate(label_rows):
+        index['label_offset'][i] = offset
+        index['label_count'][i] = len(rows)
+        offset += len(rows)
+    labels = [rows for rows in label_rows if len(rows) and rows.shape[1] == columns]
+    if len(labels) != sum(1 for rows in label_rows if len(rows)):
+        raise ValueError(f'The label files of {cache_path} mix rows of different lengths')
+    labels = np.concatenate(labels) if labels else np.zeros((0, columns), dtype=np.float32)
+    np.save(cache_path + '.index.npy', index)
+    np.save(cache_path + '.labels.npy', labels)
+    metadata = {
+        'version': CACHE_VERSION,
+        'imgsz': imgsz,
+        'count': count,
+        'files': image_paths,
+        'signature': signature,
+    }
+    with open(cache_path + '.json', 'w') as file:
+        json.dump(metadata, file)
+
+    size_gb = os.path.getsize(cache_path + '.images') / 1e9
+    print(f'Cached {count - len(failed)} images in {cache_path} ({size_gb:.2f} GB), {len(failed)} failed')
+    for image_path, error in failed:
+        print(f'Failed: {image_path}: {error}')
+    return TrainingCache(cache_path)
+
+
+class TrainingCache:
+    '''
+    Read access to a training cache, the images are memmap views read on demand.
+    '''
+
+    def __init__(self, cache_path):
+        self.cache_path = str(cache_path)
+        with open(self.cache_path + '.json', 'r') as file:
+            metadata = json.load(file)
+        self.imgsz = metadata['imgsz']
+        self.files = metadata['files']
+        self.positions = {image_path: i for i, image_path in enumerate(self.files)}
+        self.index = np.load(self.cache_path + '.index.npy')
+        self._labels = np.load(self.cache_path + '.labels.npy', mmap_mode='r')
+        self.images = np.memmap(self.cache_path + '.images', dtype=np.uint8, mode='r',
+                                shape=(max(metadata['count'], 1), self.imgsz, self.imgsz, 3))
+
+    def __len__(self):
+        return len(self.files)
+
+    def position(self, image_path):
+        '''
+        Returns:
+        - int: position of the image in the cache, None if it is not cached or could not be read
+        '''
+        i = self.positions.get(os.path.abspath(image_path))
+        return i if i is not None and self.index[i]['valid'] else None
+
+    def image(self, i):
+        '''
+        Returns:
+        - image (np.ndarray): the resized BGR image without the padding (a copy, the augmentations write in place)
+        - shape0 (tuple): (height, width) on disk
+        - shape (tuple): (height, width) after the resize
+        '''
+        record = self.index[i]
+        top, left, height, width = int(record['top']), int(record['left']), int(record['height']), int(record['width'])
+        image = np.array(self.images[i, top:top + height, left:left + width])
+        return image, (int(record['height0']), int(record['width0'])), (height, width)
+
+    def labels(self, i):
+        record = self.index[i]
+        start = int(record['label_offset'])
+        return np.array(self._labels[start:start + int(record['label_count'])])
+
+
+def label_dict(image_path, shape0, rows):
+    '''
+    Label of one image in the format of ultralytics (see verify_image_label), rows of more than
+    6 columns are polygons (the 4 corners of the OBB labels).
+    '''
+    rows = np.asarray(rows, dtype=np.float32)
+    segments = []
+    if len(rows) and rows.shape[1] > 6:
+        classes = rows[:, 0:1]
+        segments = [row[1:].reshape(-1, 2) for row in rows]
+        corners = rows[:, 1:].reshape(len(rows), -1, 2)
+        mins, maxs = corners.min(axis=1), corners.max(axis=1)
+        rows = np.concatenate([classes, (mins + maxs) / 2, maxs - mins], axis=1)
+    if len(rows):
+        _, unique = np.unique(rows, axis=0, return_index=True)
+        if len(unique) < len(rows):
+            rows = rows[unique]
+            if segments:
+                segments = [segments[i] for i in unique]
+    else:
+        rows = np.zeros((0, 5), dtype=np.float32)
+    return {
+        'im_file': image_path,
+        'shape': shape0,
+        'cls': rows[:, 0:1],
+        'bboxes': rows[:, 1:5],
+        'segments': segments,
+        'keypoints': None,
+        'normalized': True,
+        'bbox_format': 'xywh',
+    }
+
+
+def default_cache_path(img_path, imgsz):
+    # next to the images folder: train/images -> train/images-640.*
+    folder = Path(img_path[0]).parent if isinstance(img_path, (list, tuple)) else Path(img_path)
+    return str(folder.parent / f'{folder.name}-{imgsz}')
+
+
+class CachedYOLODataset(YOLODataset):
+    '''
+    YOLODataset reading its images and labels from a training cache, built on the first use.
+    The images that are not in the cache are decoded by ultralytics as usual.
+    '''
+
+    def __init__(self, *args, cache_path=None, num_workers=None, hash_images=False, **kwargs):
+        # get_labels is called by the constructor of the parent and needs these
+        self.training_cache_path = cache_path
+        self.training_cache_workers = num_workers
+        self.training_cache_hash_images = hash_images
+        self.training_cache = None
+        super().__init__(*args, **kwargs)
+
+    def get_labels(self):
+        if self.use_keypoints:
+            return super().get_labels()
+        cache_path = self.training_cache_path or default_cache_path(self.img_path, self.imgsz)
+        self.training_cache = build_training_cache(self.im_files, cache_path, self.imgsz, self.training_cache_workers,
+                                                   hash_images=self.training_cache_hash_images)
+        self.label_files = img2label_paths(self.im_files)
+        labels = []
+        for image_path in self.im_files:
+            i = self.training_cache.position(image_path)
+            if i is None:
+                # an unreadable image: ultralytics checks and reports it itself
+                return super().get_labels()
+            shape0 = (int(self.training_cache.index[i]['height0']), int(self.training_cache.index[i]['width0']))
+            labels.append(label_dict(image_path, shape0, self.training_cache.labels(i)))
+        return labels
+
+    def load_image(self, i, rect_mode=True):
+        position = self.training_cache.position(self.im_files[i]) if self.training_cache is not None else None
+        if position is None or not rect_mode:
+            return super().load_image(i, rect_mode)
+        image, shape0, shape = self.training_cache.image(position)
+        if self.augment:
+            # the mosaic picks its other images in the buffer
+            self.buffer.append(i)
+            if len(self.buffer) >= self.max_buffer_length:
+                self.buffer.pop(0)
+        return image, shape0, shape
+
+
+class CachedTrainerMixin:
+    '''
+    build_dataset of ultralytics (build_yolo_dataset) with CachedYOLODataset.
+    Set hash_images = True on a subclass to compare the content of the images to the cache.
+    '''
+    hash_images = False
+
+    def build_dataset(self, img_path, mode='train', batch=None):
+        stride = max(int(de_parallel(self.model).stride.max() if self.model else 0), 32)
+        return CachedYOLODataset(
+            img_path=img_path,
+            imgsz=self.args.imgsz,
+            batch_size=batch,
+            augment=mode == 'train',
+            hyp=self.args,
+            rect=self.args.rect or mode == 'val',
+            cache=None,
+            single_cls=self.args.single_cls or False,
+            stride=stride,
+            pad=0.0 if mode == 'train' else 0.5,
+            prefix=colorstr(f'{mode}: '),
+            task=self.args.task,
+            classes=self.args.classes,
+            data=self.data,
+            fraction=self.args.fraction if mode == 'train' else 1.0,
+            num_workers=self.args.workers or None,
+            hash_images=self.hash_images,
+        )
+
+
+class CachedDetectionTrainer(CachedTrainerMixin, DetectionTrainer):
+    pass
+
+
+class CachedOBBTrainer(CachedTrainerMixin, OBBTrainer):
+    pass
+
+
+def image_files(folder):
+    return sorted(str(path) for path in Path(folder).rglob('*.*') if path.suffix[1:].lower() in IMG_FORMATS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the pre-decoded training caches of a dataset yaml.')
+    parser.add_argument('data', help='dataset yaml, e.g. config.yaml')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--splits', nargs='+', default=['train', 'val'])
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='rebuild even if the sources did not change')
+    parser.add_argument('--hash-images', action='store_true',
+                        help='hash the content of the images, not only their size and modification time')
+    args = parser.parse_args()
+
+    with open(args.data, 'r') as file:
+        data = yaml.safe_load(file)
+    root = Path(data.get('path', Path(args.data).parent))
+    for split in args.splits:
+        if not data.get(split):
+            continue
+        folder = root / data[split]
+        build_training_cache(image_files(folder), default_cache_path(str(folder), args.imgsz), args.imgsz,
+                             args.workers, force=args.force, hash_images=args.hash_images)
+
+
+if __name__ == "__main__":
+    main()
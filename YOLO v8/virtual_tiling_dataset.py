@@ -0,0 +1,365 @@
+# training on windows cropped on the fly from the full frames, no tile is written to disk
+#
+# A sample is a (frame, window origin) pair. The frames are decoded into a bounded LRU cache, a
+# window is cropped from the decoded frame and the full frame OBB labels are reprojected into it
+# (crop.reproject_obb_to_window, the same as when the tiles are written). Window size and stride
+# are parameters of the dataset, so trying another tile size does not need a new tile folder.
+# With random offsets every window is moved by up to max_offset pixels at every epoch.
+#
+# A decoded DJI frame is about 60 MB, so the samples are drawn frame group by frame group
+# (FrameGroupedSampler): a group fits in the cache and its windows are shuffled together.
+#
+# The frames and labels are given in the dataset yaml, labels in the 8 corner format of the converters:
+#   train: frames/train           val: frames/val
+#   train_labels: labels/train    val_labels: labels/val
+#   window_size: 256              stride: 256               random_offset: 64
+# model.train(data='frames.yaml', imgsz=256, trainer=VirtualTilingOBBTrainer)
+#
+# Usage (statistics and read speed of the virtual tiles):
+# python virtual_tiling_dataset.py <frames folder> <labels folder> --window-size 256 --stride 192
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import cv2
+from collections import OrderedDict
+from pathlib import Path
+from PIL import Image
+
+from ultralytics.data.build import InfiniteDataLoader, seed_worker, PIN_MEMORY
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.models.yolo.obb import OBBTrainer
+from ultralytics.utils import colorstr
+from ultralytics.utils.torch_utils import de_parallel, torch_distributed_zero_first
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'utils'))
+from crop import window_origins, reproject_obb_to_window
+from miscellaneous import read_obb_label_file
+from training_cache import image_files, label_dict
+
+
+class FrameCache:
+    '''
+    LRU cache of decoded BGR frames, bounded by their size in bytes.
+    Every dataloader worker has its own cache.
+    '''
+
+    def __init__(self, budget_bytes=1 << 30):
+        self.budget_bytes = budget_bytes
+        self.frames = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, frame_path):
+        frame = self.frames.get(frame_path)
+        if frame is not None:
+            self.frames.move_to_end(frame_path)
+            self.hits += 1
+            return frame
+        self.misses += 1
+        frame = cv2.imread(frame_path)
+        if frame is None:
+            raise ValueError(f'Could not decode {frame_path}')
+        self.frames[frame_path] = frame
+        self.size += frame.nbytes
+        # the frame just added is kept even if it is alone over the budget
+        while self.size > self.budget_bytes and len(self.frames) > 1:
+            _, evicted = self.frames.popitem(last=False)
+            self.size -= evicted.nbytes
+        return frame
+
+
+class VirtualTiling:
+    '''
+    The windows of a set of full frames with their reprojected labels.
+
+    Parameters:
+    - frame_paths (list): full frames
+    - labels_folder (str): labels of the frames (<frame stem>.txt, 8 corner format), None for no labels
+    - class_names (dict): class_id -> class label of the label files, boxes of other labels are ignored
+    - window_size (int): side of the windows
+    - stride (int): step between two windows, defaults to window_size
+    - pad (bool): keep the remainder strip of the frames (padded with black)
+    - min_visibility (float): boxes with less than this fraction inside a window are dropped
+    - budget_bytes (int): size of the cache of decoded frames
+    '''
+
+    def __init__(self, frame_paths, labels_folder=None, class_names=None, window_size=256, stride=None, pad=True,
+                 min_visibility=0.5, budget_bytes=1 << 30):
+        self.frame_paths = [str(frame_path) for frame_path in frame_paths]
+        self.window_size = window_size
+        self.min_visibility = min_visibility
+        self.cache = FrameCache(budget_bytes)
+        class_ids = {label: class_id for class_id, label in (class_names or {}).items()}
+
+        self.frame_sizes = []
+        self.frame_labels = []
+        samples = []
+        for frame_id, frame_path in enumerate(self.frame_paths):
+            # only the header is read
+            with Image.open(frame_path) as image:
+                width, height = image.size
+            self.frame_sizes.append((width, height))
+            corners, class_labels = np.zeros((0, 4, 2)), []
+            if labels_folder is not None:
+                label_path = Path(labels_folder) / (Path(frame_path).stem + '.txt')
+                if label_path.exists():
+                    corners, class_labels, _ = read_obb_label_file(label_path)
+            known = np.array([label in class_ids for label in class_labels], dtype=bool)
+            self.frame_labels.append((corners[known], np.array([class_ids[label] for label in class_labels if label in class_ids], dtype=np.int64)))
+            samples.extend((frame_id, x, y) for x, y in window_origins(width, height, window_size, stride, pad))
+        self.samples = np.array(samples, dtype=np.int64).reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def frame_ids(self):
+        return self.samples[:, 0]
+
+    def frames_in_budget(self):
+        '''
+        Number of the largest frames that fit in the cache together.
+        '''
+        largest = max((width * height * 3 for width, height in self.frame_sizes), default=1)
+        return max(1, self.cache.budget_bytes // largest)
+
+    def origin(self, i, max_offset=0, rng=np.random):
+        '''
+        Top left corner of window i, moved by a random offset of up to max_offset pixels
+        and kept inside the frame (or at its base position for the padded windows).
+        '''
+        frame_id, x, y = (int(value) for value in self.samples[i])
+        if max_offset <= 0:
+            return x, y
+        width, height = self.frame_sizes[frame_id]
+        dx, dy = rng.randint(-max_offset, max_offset + 1, size=2)
+        x = int(min(max(x + dx, 0), max(width - self.window_size, x)))
+        y = int(min(max(y + dy, 0), max(height - self.window_size, y)))
+        return x, y
+
+    def window(self, i, origin=None):
+        '''
+        Crop window i from its decoded frame.
+
+        Parameters:
+        - i (int): sample index
+        - origin (tuple): (x, y) to crop at instead of the window origin, e.g. from origin(i, max_offset)
+
+        Returns:
+        - tile (np.ndarray): (window_size, window_size, 3) uint8 BGR, black where the window is past the frame
+        - corners (np.ndarray): (K, 4, 2) corners of the boxes in window pixels
+        - class_ids (np.ndarray): (K,) class id of every box
+        '''
+        frame_id = int(self.samples[i, 0])
+        x, y = origin if origin is not None else (int(self.samples[i, 1]), int(self.samples[i, 2]))
+        frame = self.cache.get(self.frame_paths[frame_id])
+        height, width = frame.shape[:2]
+        tile = np.zeros((self.window_size, self.window_size, 3), dtype=np.uint8)
+        crop = frame[y:min(y + self.window_size, height), x:min(x + self.window_size, width)]
+        tile[:crop.shape[0], :crop.shape[1]] = crop
+
+        corners, class_ids = self.frame_labels[frame_id]
+        keep, window_corners = reproject_obb_to_window(corners, x, y, self.window_size, self.min_visibility)
+        return tile, window_corners, class_ids[keep]
+
+    def name(self, i, origin=None):
+        frame_id, x, y = (int(value) for value in self.samples[i])
+        x, y = origin if origin is not None else (x, y)
+        return f'{self.frame_paths[frame_id]}@{x},{y}'
+
+
+class FrameGroupedSampler:
+    '''
+    Shuffled order of the samples that keeps the frames in the cache: the frames are shuffled and
+    cut into groups of frames_per_group, the windows of a group are shuffled together.
+    A new order is drawn at every epoch (every iter).
+    '''
+
+    def __init__(self, frame_ids, frames_per_group, seed=None):
+        frame_ids = np.asarray(frame_ids)
+        self.frames = np.unique(frame_ids)
+        self.samples_of_frame = {frame_id: np.flatnonzero(frame_ids == frame_id) for frame_id in self.frames.tolist()}
+        self.frames_per_group = max(1, frames_per_group)
+        self.count = len(frame_ids)
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        frames = self.rng.permutation(self.frames).tolist()
+        order = []
+        for start in range(0, len(frames), self.frames_per_group):
+            group = np.concatenate([self.samples_of_frame[frame_id] for frame_id in frames[start:start + self.frames_per_group]])
+            order.extend(self.rng.permutation(group).tolist())
+        return iter(order)
+
+
+def window_label(name, corners, class_ids, window_size):
+    '''
+    Label of a window in the format of ultralytics, corners normalized by the window size.
+    '''
+    rows = np.concatenate([class_ids.reshape(-1, 1), corners.reshape(-1, 8) / window_size], axis=1) if len(corners) else np.zeros((0, 9))
+    return label_dict(name, (window_size, window_size), rows)
+
+
+class VirtualTilingDataset(YOLODataset):
+    '''
+    YOLODataset serving the windows of VirtualTiling instead of image files.
+
+    Parameters (on top of the ones of YOLODataset, img_path is the folder of the full frames):
+    - labels_folder (str): labels of the frames in the 8 corner format
+    - window_size, min_visibility, budget_bytes: see VirtualTiling
+    - window_stride, pad_frames: stride and pad of VirtualTiling (stride and pad are the ones of YOLODataset)
+    - max_offset (int): random offset of the windows in pixels, only when augmenting
+    '''
+
+    def __init__(self, *args, labels_folder=None, window_size=256, window_stride=None, pad_frames=True, min_visibility=0.5,
+                 budget_bytes=1 << 30, max_offset=0, **kwargs):
+        # get_img_files and get_labels are called by the constructor of the parent and need these
+        self.tiling_options = dict(labels_folder=labels_folder, window_size=window_size, stride=window_stride, pad=pad_frames,
+                                   min_visibility=min_visibility, budget_bytes=budget_bytes)
+        self.max_offset = max_offset
+        self.tiling = None
+        super().__init__(*args, **kwargs)
+
+    def get_img_files(self, img_path):
+        frame_paths = image_files(img_path)
+        if not frame_paths:
+            raise FileNotFoundError(f'{self.prefix}No frames found in {img_path}')
+        self.tiling = VirtualTiling(frame_paths, class_names=self.data['names'], **self.tiling_options)
+        return [self.tiling.name(i) for i in range(len(self.tiling))]
+
+    def get_labels(self):
+        # labels of the windows at their base position, used by ultralytics for the statistics and plots
+        labels = []
+        window_size = self.tiling.window_size
+        for i, name in enumerate(self.im_files):
+            frame_id = int(self.tiling.samples[i, 0])
+            corners, class_ids = self.tiling.frame_labels[frame_id]
+            keep, window_corners = reproject_obb_to_window(corners, int(self.tiling.samples[i, 1]), int(self.tiling.samples[i, 2]),
+                                                           window_size, self.tiling.min_visibility)
+            labels.append(window_label(name, window_corners, class_ids[keep], window_size))
+        return labels
+
+    def load_image(self, i, rect_mode=True):
+        image, _, _ = self.tiling.window(i)
+        return self.resize(image)
+
+    def resize(self, image):
+        # as BaseDataset.load_image: the window is resized to imgsz
+        height0, width0 = image.shape[:2]
+        if (height0, width0) != (self.imgsz, self.imgsz):
+            image = cv2.resize(image, (self.imgsz, self.imgsz), interpolation=cv2.INTER_LINEAR)
+        return image, (height0, width0), image.shape[:2]
+
+    def get_image_and_label(self, index):
+        # the window and its boxes are cropped together, at a random offset when augmenting
+        origin = self.tiling.origin(index, self.max_offset if self.augment else 0)
+        tile, corners, class_ids = self.tiling.window(index, origin)
+        if self.single_cls:
+            class_ids = np.zeros_like(class_ids)
+        label = window_label(self.tiling.name(index, origin), corners, class_ids, self.tiling.window_size)
+        label.pop('shape')
+        label['img'], label['ori_shape'], label['resized_shape'] = self.resize(tile)
+        label['ratio_pad'] = (label['resized_shape'][0] / label['ori_shape'][0], label['resized_shape'][1] / label['ori_shape'][1])
+        if self.rect:
+            label['rect_shape'] = self.batch_shapes[self.batch[index]]
+        if self.augment:
+            # the mosaic picks its other images in the buffer
+            self.buffer.append(index)
+            if len(self.buffer) >= self.max_buffer_length:
+                self.buffer.pop(0)
+        return self.update_labels_info(label)
+
+
+class VirtualTilingOBBTrainer(OBBTrainer):
+    '''
+    OBBTrainer on the virtual tiles of the full frames, the yaml keys train_labels/val_labels,
+    window_size, stride and random_offset configure the tiling (see the top of the file).
+    '''
+
+    def build_dataset(self, img_path, mode='train', batch=None):
+        stride = max(int(de_parallel(self.model).stride.max() if self.model else 0), 32)
+        return VirtualTilingDataset(
+            img_path=img_path,
+            imgsz=self.args.imgsz,
+            batch_size=batch,
+            augment=mode == 'train',
+            hyp=self.args,
+            rect=self.args.rect or mode == 'val',
+            cache=None,
+            single_cls=self.args.single_cls or False,
+            stride=stride,
+            pad=0.0 if mode == 'train' else 0.5,
+            prefix=colorstr(f'{mode}: '),
+            task=self.args.task,
+            classes=self.args.classes,
+            data=self.data,
+            fraction=1.0,
+            labels_folder=self.data.get(f'{mode}_labels'),
+            window_size=self.data.get('window_size', self.args.imgsz),
+            window_stride=self.data.get('stride'),
+            max_offset=self.data.get('random_offset', 0),
+        )
+
+    def get_dataloader(self, dataset_path, batch_size=16, rank=0, mode='train'):
+        if mode != 'train' or rank != -1:
+            return super().get_dataloader(dataset_path, batch_size, rank, mode)
+        with torch_distributed_zero_first(rank):
+            dataset = self.build_dataset(dataset_path, mode, batch_size)
+        sampler = FrameGroupedSampler(dataset.tiling.frame_ids, dataset.tiling.frames_in_budget())
+        return InfiniteDataLoader(
+            dataset=dataset,
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=min(os.cpu_count(), self.args.workers),
+            sampler=sampler,
+            pin_memory=PIN_MEMORY,
+            collate_fn=getattr(dataset, 'collate_fn', None),
+            worker_init_fn=seed_worker,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Statistics and read speed of the virtual tiles of full frames.')
+    parser.add_argument('frames', help='folder of the full frames')
+    parser.add_argument('labels', help='labels of the frames in the 8 corner format')
+    parser.add_argument('--window-size', type=int, default=256)
+    parser.add_argument('--stride', type=int, default=None)
+    parser.add_argument('--random-offset', type=int, default=0)
+    parser.add_argument('--budget-mb', type=int, default=1024, help='size of the cache of decoded frames')
+    parser.add_argument('--samples', type=int, default=1000, help='number of windows read for the speed')
+    args = parser.parse_args()
+
+    frame_paths = image_files(args.frames)
+    class_labels = set()
+    for frame_path in frame_paths:
+        label_path = Path(args.labels) / (Path(frame_path).stem + '.txt')
+        if label_path.exists():
+            class_labels.update(read_obb_label_file(label_path)[1])
+    class_names = dict(enumerate(sorted(class_labels)))
+    tiling = VirtualTiling(frame_paths, args.labels, class_names, args.window_size, args.stride,
+                           budget_bytes=args.budget_mb << 20)
+    print(f'{len(frame_paths)} frames, {len(tiling)} windows of {args.window_size} px, classes {class_names}')
+
+    sampler = FrameGroupedSampler(tiling.frame_ids, tiling.frames_in_budget(), seed=0)
+    boxes = 0
+    start = time.perf_counter()
+    for count, i in enumerate(sampler):
+        if count == args.samples:
+            break
+        _, corners, _ = tiling.window(i, tiling.origin(i, args.random_offset))
+        boxes += len(corners)
+    seconds = time.perf_counter() - start
+    read = min(args.samples, len(tiling))
+    print(f'{read} windows read in {seconds:.2f} s ({read / seconds if seconds > 0 else 0.0:.0f} windows/s), '
+          f'{boxes / max(read, 1):.2f} boxes per window, {tiling.cache.misses} frames decoded, {tiling.cache.hits} cache hits')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import sys
+from pathlib import Path
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'utils'))
+from crop import reproject_obb_to_window
+from geometry import polygon_area, clip_polygons_to_rect, clip_polygons_to_convex
+
+
+def is_rectangle(corners):
+    sides = np.roll(corners, -1, axis=0) - corners
+    return np.allclose((sides * np.roll(sides, -1, axis=0)).sum(axis=1), 0)
+
+
+def test_rotated_box_crossing_the_border_stays_a_rectangle():
+    corners = np.array([[[230, 200], [270, 240], [250, 260], [210, 220]],     # 45 degrees, two corners outside
+                        [[150, 180], [300, 230], [290, 260], [140, 210]],     # long and thin, one end outside
+                        [[10, 10], [50, 10], [50, 30], [10, 30]]], dtype=np.float64)
+    keep, window_corners = reproject_obb_to_window(corners, 0, 0, 256, min_visibility=0.3)
+    assert keep.tolist() == [0, 1, 2]
+    for box, window_box in zip(corners, window_corners):
+        assert is_rectangle(window_box)
+        # the rectangle covers the whole visible part of the box and is not bigger than the box
+        visible, count = clip_polygons_to_rect(box[None], 0, 0, 256, 256)
+        covered, covered_count = clip_polygons_to_convex(visible, window_box[None], count)
+        assert np.isclose(polygon_area(covered, covered_count)[0], polygon_area(visible, count)[0])
+        assert polygon_area(window_box) <= polygon_area(box) + 1e-6
+    # the thin box is shortened to the window, the box inside is not touched
+    assert polygon_area(window_corners[1]) < polygon_area(corners[1])
+    assert np.array_equal(window_corners[2], corners[2])
@@ -0,0 +1,44 @@
+import sys
+from pathlib import Path
+from PIL import Image
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'utils'))
+from dataset_catalog import DatasetCatalog, list_files
+
+TILE = 'DJI_20240518124354_0068_V3'
+
+
+def write_label(folder, lines):
+    folder.mkdir(parents=True, exist_ok=True)
+    (folder / f'{TILE}.txt').write_text(''.join(f'0,0,10,0,10,10,0,10,{line},0\n' for line in lines))
+
+
+def test_tile_with_labels_in_two_folders_is_listed_once(tmp_path):
+    tiles = tmp_path / 'tiles'
+    tiles.mkdir()
+    Image.new('RGB', (256, 256)).save(tiles / f'{TILE}.jpg')
+    write_label(tmp_path / 'labelTxt', ['waste'])
+    write_label(tmp_path / 'labelTxt_old', ['waste', 'waste', 'plastic'])
+
+    with DatasetCatalog(tmp_path / 'catalog.db') as catalog:
+        catalog.scan(tmp_path)
+        rows = catalog.tiles()
+        assert len(rows) == 1
+        assert rows[0][1] == str(tmp_path / 'labelTxt' / f'{TILE}.txt')
+
+        rows = catalog.tiles(min_boxes=2, class_label='waste', label_folder=tmp_path / 'labelTxt_old')
+        assert [(label_path, box_count) for _, label_path, box_count, _, _ in rows] == \
+            [(str(tmp_path / 'labelTxt_old' / f'{TILE}.txt'), 2)]
+        assert catalog.tiles(min_boxes=2, class_label='waste', label_folder=tmp_path / 'labelTxt') == []
+
+
+def test_catalog_lists_the_same_files_as_the_folder(tmp_path):
+    tiles = tmp_path / 'tiles'
+    tiles.mkdir()
+    for name in ['b', 'a']:
+        Image.new('RGB', (16, 16)).save(tiles / f'{name}.jpg')
+    write_label(tmp_path / 'labelTxt', ['waste'])
+
+    catalog_path = tmp_path / 'catalog.db'
+    assert list_files(tiles, '.jpg', catalog_path) == list_files(tiles, '.jpg') == [str(tiles / 'a.jpg'), str(tiles / 'b.jpg')]
+    assert list_files(tmp_path / 'labelTxt', '.txt', catalog_path) == [str(tmp_path / 'labelTxt' / f'{TILE}.txt')]
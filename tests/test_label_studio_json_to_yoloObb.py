@@ -0,0 +1,42 @@
+import sys
+import json
+from pathlib import Path
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'utils'))
+import label_studio_json_to_yoloObb
+from label_studio_json_to_yoloObb import iter_label_studio_tasks
+
+EXPORT = Path(__file__).resolve().parent.parent / 'label-studio json files' / 'bagmati-patch2-waste3-444-files' / \
+    'bagmati-patch2-waste3-444-files.json'
+
+
+def test_streamed_tasks_match_the_export():
+    with open(EXPORT, 'r', encoding='utf-8') as file:
+        tasks = json.load(file)
+    assert list(iter_label_studio_tasks(EXPORT, chunk_size=4096)) == tasks
+
+
+def test_malformed_task_fails_fast_with_its_byte_offset(tmp_path, monkeypatch):
+    first = '[\r\n{"id": 1, "file_upload": "é.jpg"},\r\n'
+    bad = '{"id": 2, "file_upload": tru},\r\n'
+    rest = ',\r\n'.join(json.dumps({'id': i, 'file_upload': 'x' * 100}) for i in range(3, 10000)) + ']'
+    json_path = tmp_path / 'export.json'
+    json_path.write_bytes((first + bad + rest).encode('utf-8'))
+
+    # count the chunks read from the export
+    reads = []
+
+    def counting_open(*args, **kwargs):
+        file = open(*args, **kwargs)
+        read = file.read
+        monkeypatch.setattr(file, 'read', lambda size: reads.append(size) or read(size), raising=False)
+        return file
+
+    monkeypatch.setattr(label_studio_json_to_yoloObb, 'open', counting_open, raising=False)
+    tasks = iter_label_studio_tasks(json_path, chunk_size=256, max_task_chunks=4)
+    assert next(tasks)['id'] == 1
+    with pytest.raises(ValueError, match=f"malformed task at byte {len(first.encode('utf-8'))}:"):
+        next(tasks)
+    # the decoder gave up after a few chunks instead of reading the rest of the file
+    assert len(reads) <= 6
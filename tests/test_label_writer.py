@@ -0,0 +1,25 @@
+import os
+import sys
+from pathlib import Path
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'utils'))
+from label_writer import write_label_files
+from annotation_store import AnnotationSet, write_obb_txt_folder
+
+
+def test_items_with_the_same_name_are_written_once(tmp_path):
+    items = [(f'{i % 3}.txt', f'{i}\n' * 1000) for i in range(30)]
+    written, failed = write_label_files(items, tmp_path, num_workers=8)
+    assert written == 3
+    assert len(failed) == 27
+    assert sorted(os.listdir(tmp_path)) == ['0.txt', '1.txt', '2.txt']
+    assert (tmp_path / '1.txt').read_text() == '1\n' * 1000
+
+
+def test_images_with_the_same_label_name_are_skipped(tmp_path):
+    corners = np.arange(24, dtype=np.float64).reshape(3, 4, 2)
+    annotations = AnnotationSet.from_boxes(['a.jpg', 'a.png', 'DJI.0001.jpg'], corners, ['waste'] * 3, np.array([0, 1, 2]))
+    written = write_obb_txt_folder(annotations, tmp_path)
+    assert written == {'a.jpg': 'a.txt', 'DJI.0001.jpg': 'DJI.txt'}
+    assert (tmp_path / 'a.txt').read_text().startswith('0.0,1.0,')
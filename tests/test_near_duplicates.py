@@ -0,0 +1,20 @@
+import sys
+from pathlib import Path
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'utils'))
+from near_duplicates import find_clusters, hamming_distance
+
+
+def test_chain_of_overlapping_frames_is_not_one_cluster():
+    # every hash differs from the previous one by 4 bits, the first and the last by 40
+    hashes = np.array([(1 << (4 * i)) - 1 for i in range(11)], dtype=np.uint64)
+    clusters = find_clusters(hashes, max_distance=6)
+    assert clusters == [[0, 1], [2, 3], [4, 5], [6, 7], [8, 9]]
+    for kept, *duplicates in clusters:
+        assert (hamming_distance(hashes[duplicates], hashes[kept]) <= 6).all()
+
+
+def test_identical_hashes_and_keep_order():
+    hashes = np.array([7, 7, 15, 1 << 40, 7], dtype=np.uint64)
+    assert find_clusters(hashes, max_distance=1, order=[2, 0, 1, 3, 4]) == [[2, 0, 1, 4]]
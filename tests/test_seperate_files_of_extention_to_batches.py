@@ -0,0 +1,58 @@
+import os
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'utils'))
+from seperate_files_of_extention_to_batches import plan_batches, write_journal, load_journal, move_files_to_batches, undo_batches
+
+
+def make_files(folder, names):
+    folder.mkdir(parents=True, exist_ok=True)
+    for name in names:
+        (folder / name).write_bytes(b'x')
+
+
+def test_extension_is_case_insensitive(tmp_path):
+    make_files(tmp_path, ['a.jpg', 'B.JPG', 'c.txt'])
+    assert [name for name, _ in plan_batches('.jpg', tmp_path)] == ['B.JPG', 'a.jpg']
+
+
+def test_planned_file_deleted_before_the_run(tmp_path):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    make_files(source, ['a.jpg', 'b.jpg', 'c.jpg'])
+    dest.mkdir()
+    # the plan is written, then a planned file disappears before the files are moved
+    write_journal(dest, source, plan_batches('.jpg', source, batch_size=2))
+    os.remove(source / 'b.jpg')
+
+    summary = move_files_to_batches('.jpg', source, dest, batch_size=2)
+    assert summary['moved'] == 2
+    assert summary['skipped'] == ['b.jpg']
+    journal, done = load_journal(dest)
+    assert len(done) == len(journal['moves'])
+
+    # the journal is finished: the second run plans the new files in a new batch instead of resuming
+    make_files(source, ['d.jpg'])
+    summary = move_files_to_batches('.jpg', source, dest, batch_size=2)
+    assert summary['moved'] == 1
+    assert summary['skipped'] == []
+    assert (dest / 'batch_3' / 'd.jpg').exists()
+    assert not (source / 'd.jpg').exists()
+
+
+def test_every_run_can_be_undone(tmp_path):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    make_files(source, ['a.jpg', 'b.jpg', 'c.jpg'])
+    move_files_to_batches('.jpg', source, dest, batch_size=2)
+    make_files(source, ['d.jpg'])
+    move_files_to_batches('.jpg', source, dest, batch_size=2)
+    assert sorted(os.listdir(dest / 'batch_1')) == ['a.jpg', 'b.jpg']
+    assert sorted(os.listdir(dest / 'batch_3')) == ['d.jpg']
+
+    # the latest run first, then the previous one
+    assert undo_batches(dest)['moved'] == 1
+    assert sorted(os.listdir(source)) == ['d.jpg']
+    assert undo_batches(dest)['moved'] == 3
+    assert sorted(os.listdir(source)) == ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg']
+    assert os.listdir(dest) == []
+    assert undo_batches(dest) is None
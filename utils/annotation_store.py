@@ -0,0 +1,250 @@
+# in memory set of oriented box annotations kept in flat numpy arrays
+#
+# All the boxes of all the images are in one float32 corners array, the boxes of image i
+# are corners[offsets[i]:offsets[i + 1]]. A box costs 37 bytes (8 float32 corners, an int32
+# class id and a uint8 difficulty) instead of a dict per box.
+# The loaders of the converters (label-studio, CVAT/Pascal VOC) and load_obb_txt_folder produce
+# an AnnotationSet, write_obb_txt_folder writes one back in the yolo_obb format of the converters.
+
+import os
+import numpy as np
+from pathlib import Path
+from miscellaneous import get_filenames_of_extention, read_obb_label_file, format_lines
+from label_writer import write_label_files
+
+
+class AnnotationSet:
+    '''
+    Annotations of many images.
+
+    Attributes:
+    - file_names (np.ndarray): (N,) image file names
+    - widths, heights (np.ndarray): (N,) int32 image size, 0 if unknown
+    - offsets (np.ndarray): (N + 1,) int64, the boxes of image i are [offsets[i]:offsets[i + 1]]
+    - corners (np.ndarray): (M, 4, 2) float32 corners in pixels
+    - class_ids (np.ndarray): (M,) int32 index in class_names
+    - difficulties (np.ndarray): (M,) uint8
+    - class_names (list): name of every class id
+    '''
+
+    def __init__(self, file_names, widths, heights, offsets, corners, class_ids, difficulties, class_names):
+        self.file_names = np.asarray(file_names, dtype=str)
+        self.widths = np.asarray(widths, dtype=np.int32)
+        self.heights = np.asarray(heights, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.corners = np.asarray(corners, dtype=np.float32).reshape(-1, 4, 2)
+        self.class_ids = np.asarray(class_ids, dtype=np.int32)
+        self.difficulties = np.asarray(difficulties, dtype=np.uint8)
+        self.class_names = list(class_names)
+
+    def __len__(self):
+        return len(self.file_names)
+
+    @property
+    def num_boxes(self):
+        return len(self.corners)
+
+    def box_range(self, i):
+        return int(self.offsets[i]), int(self.offsets[i + 1])
+
+    def boxes(self, i):
+        '''
+        Returns:
+        - corners (np.ndarray): (K, 4, 2) float32 view on the boxes of image i
+        - class_ids (np.ndarray): (K,) int32 view
+        '''
+        start, end = self.box_range(i)
+        return self.corners[start:end], self.class_ids[start:end]
+
+    def class_labels(self, i):
+        start, end = self.box_range(i)
+        return [self.class_names[class_id] for class_id in self.class_ids[start:end]]
+
+    def index_of(self, file_name):
+        '''
+        Position of an image from its file name, -1 if it is not in the set.
+        '''
+        if not hasattr(self, '_index'):
+            self._index = {name: i for i, name in enumerate(self.file_names.tolist())}
+        return self._index.get(file_name, -1)
+
+    def save(self, path):
+        '''
+        Save to a single uncompressed .npz file, or to a folder of .npy files if path
+        does not end with .npz (that folder can be loaded with mmap=True).
+        '''
+        arrays = {
+            'file_names': self.file_names,
+            'widths': self.widths,
+            'heights': self.heights,
+            'offsets': self.offsets,
+            'corners': self.corners,
+            'class_ids': self.class_ids,
+            'difficulties': self.difficulties,
+            'class_names': np.asarray(self.class_names, dtype=str),
+        }
+        path = str(path)
+        if path.endswith('.npz'):
+            np.savez(path, **arrays)
+        else:
+            os.makedirs(path, exist_ok=True)
+            for name, array in arrays.items():
+                np.save(os.path.join(path, f'{name}.npy'), array)
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        '''
+        Load a set written by save. With mmap=True (folder only) the box arrays are memory mapped.
+        '''
+        path = str(path)
+        if path.endswith('.npz'):
+            with np.load(path) as arrays:
+                arrays = {name: arrays[name] for name in arrays.files}
+        else:
+            mmap_mode = 'r' if mmap else None
+            arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+                      for name in ('widths', 'heights', 'offsets', 'corners', 'class_ids', 'difficulties')}
+            arrays['file_names'] = np.load(os.path.join(path, 'file_names.npy'))
+            arrays['class_names'] = np.load(os.path.join(path, 'class_names.npy'))
+        return cls(arrays['file_names'], arrays['widths'], arrays['heights'], arrays['offsets'],
+                   arrays['corners'], arrays['class_ids'], arrays['difficulties'], arrays['class_names'].tolist())
+
+    @classmethod
+    def from_boxes(cls, file_names, corners, class_labels, file_indices, difficulties=None, widths=None, heights=None, class_names=None):
+        '''
+        Build a set from the flat arrays the converters produce.
+
+        Parameters:
+        - file_names (list): N image file names
+        - corners (np.ndarray): (M, 4, 2) or (M, 8) corners in pixels
+        - class_labels (list): M class names
+        - file_indices (np.ndarray): (M,) image of every box, sorted
+        - difficulties (np.ndarray): (M,) defaults to 0
+        - widths, heights (np.ndarray): (N,) image sizes, defaults to 0 (unknown)
+        - class_names (list): known class names, new ones are appended
+
+        Returns:
+        - AnnotationSet
+        '''
+        class_names = list(class_names or [])
+        class_lookup = {name: i for i, name in enumerate(class_names)}
+        for label in class_labels:
+            if label not in class_lookup:
+                class_lookup[label] = len(class_names)
+                class_names.append(label)
+        class_ids = np.array([class_lookup[label] for label in class_labels], dtype=np.int32)
+
+        file_indices = np.asarray(file_indices, dtype=np.int64)
+        counts = np.bincount(file_indices, minlength=len(file_names)) if len(file_indices) else np.zeros(len(file_names), dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        if difficulties is None:
+            difficulties = np.zeros(len(class_ids), dtype=np.uint8)
+        if widths is None:
+            widths = np.zeros(len(file_names), dtype=np.int32)
+        if heights is None:
+            heights = np.zeros(len(file_names), dtype=np.int32)
+        return cls(file_names, widths, heights, offsets, corners, class_ids, difficulties, class_names)
+
+    @classmethod
+    def concatenate(cls, annotation_sets):
+        '''
+        Merge several sets (e.g. the chunks of a streamed export) into one.
+        '''
+        annotation_sets = list(annotation_sets)
+        class_names = []
+        for annotations in annotation_sets:
+            class_names += [name for name in annotations.class_names if name not in class_names]
+        class_lookup = {name: i for i, name in enumerate(class_names)}
+
+        class_ids, offsets, base = [], [np.zeros(1, dtype=np.int64)], 0
+        for annotations in annotation_sets:
+            remap = np.array([class_lookup[name] for name in annotations.class_names] or [0], dtype=np.int32)
+            class_ids.append(remap[annotations.class_ids])
+            offsets.append(annotations.offsets[1:] + base)
+            base += annotations.num_boxes
+
+        def joined(name, empty):
+            arrays = [getattr(annotations, name) for annotations in annotation_sets]
+            return np.concatenate(arrays) if arrays else empty
+
+        return cls(joined('file_names', np.zeros(0, dtype=str)), joined('widths', np.zeros(0)), joined('heights', np.zeros(0)),
+                   np.concatenate(offsets), joined('corners', np.zeros((0, 4, 2))),
+                   np.concatenate(class_ids) if class_ids else np.zeros(0), joined('difficulties', np.zeros(0)), class_names)
+
+
+def load_obb_txt_folder(labels_folder):
+    '''
+    Load a folder of label files in the yolo_obb format of the converters
+    (x1,y1,x2,y2,x3,y3,x4,y4,class_label,difficulty). The image of a label is assumed to be <stem>.jpg.
+
+    Parameters:
+    - labels_folder (str): folder of the .txt files
+
+    Returns:
+    - AnnotationSet, None if the folder does not exist
+    '''
+    status, filenames = get_filenames_of_extention(labels_folder, extention='.txt')
+    if not status:
+        print(f'Error in getting filenames of labels from {labels_folder}')
+        return None
+    filenames.sort()
+
+    file_names, corners, class_labels, difficulties, file_indices = [], [], [], [], []
+    for file_index, filename in enumerate(filenames):
+        file_corners, file_class_labels, file_difficulties = read_obb_label_file(os.path.join(labels_folder, filename))
+        file_names.append(Path(filename).stem + '.jpg')
+        corners.append(file_corners)
+        class_labels.extend(file_class_labels)
+        difficulties.extend(file_difficulties)
+        file_indices.append(np.full(len(file_corners), file_index, dtype=np.int64))
+    corners = np.concatenate(corners) if corners else np.zeros((0, 4, 2))
+    file_indices = np.concatenate(file_indices) if file_indices else np.zeros(0, dtype=np.int64)
+    return AnnotationSet.from_boxes(file_names, corners, class_labels, file_indices, np.array(difficulties, dtype=np.uint8))
+
+
+def write_obb_txt_folder(annotations, destination_folder, round_variable=3, write_empty=True, num_workers=8, archive=None):
+    '''
+    Write an AnnotationSet as one label file per image in the yolo_obb format of the converters
+    (x1,y1,x2,y2,x3,y3,x4,y4,class_label,difficulty), every line is formatted in one vectorized pass.
+    The files are written atomically from a pool of threads (see label_writer.py).
+
+    Parameters:
+    - annotations (AnnotationSet): the annotations
+    - destination_folder (str): folder of the label files
+    - round_variable (int): number of decimals
+    - write_empty (bool): also write an empty file for the images without boxes
+    - num_workers (int): number of writer threads
+    - archive (LabelArchiveWriter): if given the labels are added to this archive instead of destination_folder
+
+    Returns:
+    - written (dict): image file name -> label file name, an image whose label name is the one of
+      an earlier image (a.jpg and a.png) is skipped and left out
+    '''
+    corners = np.round(annotations.corners.astype(np.float64), round_variable).reshape(-1, 8)
+    class_names = np.asarray(annotations.class_names, dtype=str)
+    class_labels = class_names[annotations.class_ids] if len(class_names) else np.zeros(0, dtype=str)
+    lines = np.char.add(format_lines(corners, [class_labels, annotations.difficulties]), '\n').tolist()
+
+    written = {}
+    items = []
+    labels_of = {}
+    for i, file_name in enumerate(annotations.file_names.tolist()):
+        start, end = annotations.box_range(i)
+        if start == end and not write_empty:
+            continue
+        # file_name needs to be be .txt not .jpg
+        label_name = file_name.split('.')[0] + '.txt'
+        if label_name in labels_of:
+            # e.g. a.jpg and a.png, the second one would overwrite the label of the first
+            print(f'Skipped {file_name}: its label {label_name} is already the one of {labels_of[label_name]}')
+            continue
+        labels_of[label_name] = file_name
+        items.append((label_name, ''.join(lines[start:end])))
+        written[file_name] = label_name
+
+    if archive is not None:
+        archive.add_many(items)
+        return written
+    _, failed = write_label_files(items, destination_folder, num_workers)
+    failed = {file_name for file_name, _ in failed}
+    return {file_name: label_name for file_name, label_name in written.items() if label_name not in failed}
@@ -0,0 +1,109 @@
+# manifest of what the converters already converted, so that a re-run only converts
+# the inputs that changed and removes the labels whose input disappeared
+#
+# The manifest is a json file kept next to the labels:
+# {
+#     "version": 1,
+#     "entries": {<input key>: {"signature": ..., "label": <label file name>}, ...}
+# }
+# For an xml folder the key is the xml file name and the signature its size, mtime and sha1,
+# for a label-studio export the key is the task id and the signature its updated_at and annotations.
+
+import os
+import json
+import hashlib
+from pathlib import Path
+
+MANIFEST_VERSION = 1
+
+
+def load_manifest(manifest_path):
+    '''
+    Parameters:
+    - manifest_path (str): path of the manifest json file
+
+    Returns:
+    - dict: {input key: {'signature': ..., 'label': ...}}, empty if there is no (valid) manifest yet
+    '''
+    try:
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (json.JSONDecodeError, OSError) as e:
+        print(f"Ignoring the manifest '{manifest_path}': {e}")
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest.get('entries', {})
+
+
+def save_manifest(manifest_path, entries):
+    '''
+    Write the manifest atomically, an interrupted run keeps the previous manifest.
+    '''
+    temp_path = f'{manifest_path}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump({'version': MANIFEST_VERSION, 'entries': entries}, file)
+    os.replace(temp_path, manifest_path)
+
+
+def file_sha1(path, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def changed_files(paths, entries):
+    '''
+    Compare files with their manifest entries. The content is only hashed when the size or
+    mtime changed, a file touched without being modified is not converted again.
+
+    Parameters:
+    - paths (list): paths of the input files, the key of a file is its name
+    - entries (dict): manifest entries
+
+    Returns:
+    - changed (list): paths whose content changed or that are new
+    - signatures (dict): key -> current signature {'size', 'mtime', 'sha1'} of every file of paths
+    '''
+    changed = []
+    signatures = {}
+    for path in paths:
+        key = Path(path).name
+        stat = os.stat(path)
+        previous = entries.get(key, {}).get('signature')
+        if previous and previous['size'] == stat.st_size and previous['mtime'] == stat.st_mtime_ns:
+            signatures[key] = previous
+            continue
+        sha1 = file_sha1(path)
+        signatures[key] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': sha1}
+        if not previous or previous.get('sha1') != sha1:
+            changed.append(path)
+    return changed, signatures
+
+
+def remove_stale_labels(entries, current_keys, destination_folder):
+    '''
+    Delete the label files of the inputs that are not there anymore and drop them from the manifest.
+
+    Parameters:
+    - entries (dict): manifest entries, modified in place
+    - current_keys (set): keys of the inputs of this run
+    - destination_folder (str): folder of the labels
+
+    Returns:
+    - list: names of the deleted label files
+    '''
+    removed = []
+    for key in [key for key in entries if key not in current_keys]:
+        label = entries.pop(key).get('label')
+        if label:
+            try:
+                os.remove(Path(destination_folder) / label)
+                removed.append(label)
+            except FileNotFoundError:
+                pass
+    return removed
@@ -1,35 +1,433 @@
 from PIL import Image
 import os
+import time
 import yaml
+import numpy as np
+from multiprocessing import Pool
+from miscellaneous import read_obb_label_file, format_lines
+from label_writer import write_label_files, lines_to_text
+from geometry import polygon_area, clip_polygons_to_rect, min_area_rectangle
 # script to take a photo and output differnet 256*256 image window of that photo
 
-def extract_windows(image_path, output_folder, window_size=256):
+def extract_windows(image_path, output_folder, window_size=256, verbose=True, tile_filter=None, drop_empty=False):
+    '''
+    Crop an image into non-overlapping window_size*window_size tiles and save them as jpg.
+
+    Parameters:
+    - image_path (str): path of the image to crop
+    - output_folder (str): folder where the tiles are saved as <image_name><window_index>.jpg
+    - window_size (int): side of the square window in pixels
+    - verbose (bool): print a line for every saved window
+    - tile_filter (EmptyTileFilter): optional filter of the windows that are only water (empty_tile_filter.py),
+      the likely empty windows are saved in output_folder/likely_empty instead
+    - drop_empty (bool): do not save the likely empty windows at all
+
+    Returns:
+    - window_count (int): number of windows saved
+    - likely_empty_count (int): number of windows the filter found likely empty (tagged or dropped)
+    - failed (list): (tile name, error) of the windows that could not be saved
+    '''
     image = Image.open(image_path)
     width, height = image.size
-    print(f"window_size: {width}*{height}")
+    if verbose:
+        print(f"window_size: {width}*{height}")
     
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+    # exist_ok since several workers may create the folder at the same time
+    os.makedirs(output_folder, exist_ok=True)
     
     image_name = os.path.splitext(os.path.basename(image_path))[0]  # Get the name of the input image file
 
+    # the windows of the frame are scored in one batch, in the same row by row order as the loops below
+    likely_empty = None
+    if tile_filter is not None:
+        origins = window_origins(width, height, window_size)
+        frame = np.asarray(image.convert('RGB'))
+        windows = np.stack([frame[y:y + window_size, x:x + window_size] for x, y in origins]) if origins else []
+        likely_empty = ~tile_filter.keep(windows)
+        if not drop_empty:
+            os.makedirs(os.path.join(output_folder, 'likely_empty'), exist_ok=True)
+
     window_count = 0
+    failed = []
     for i in range(0, height-height%window_size, window_size):
         for j in range(0, width-width%window_size, window_size):
+            # the name of a window is its index in the frame, a dropped window keeps its number
+            window_index = (i // window_size) * (width // window_size) + j // window_size
+            window_folder = output_folder
+            if likely_empty is not None and likely_empty[window_index]:
+                if drop_empty:
+                    continue
+                window_folder = os.path.join(output_folder, 'likely_empty')
+            tile_name = f'{image_name}{window_index}.jpg'
             try:
                 # image.crop((left, upper, right, lower))
                 window = image.crop((j, i, j + window_size, i + window_size))
-                window.save(os.path.join(output_folder, f'{image_name}{window_count}.jpg'))
+                window.save(os.path.join(window_folder, tile_name))
                 window_count += 1
-                print(f"{image_name}{window_count} saved sucessfully.")
+                if verbose:
+                    print(f"{tile_name} saved sucessfully.")
 
 
-                print(f"size of {window_count} :::: ({j},{i}), ({j+window_size},{i+window_size})")
+                    print(f"size of {tile_name} :::: ({j},{i}), ({j+window_size},{i+window_size})")
             except Exception as e:
-                print(e)
+                # the other windows are still saved, the caller reports the failures
+                failed.append((tile_name, str(e)))
+                if verbose:
+                    print(f"Failed: {tile_name}: {e}")
         
-    print(width - width%window_size)
-    print(height - height%window_size)
+    if verbose:
+        print(width - width%window_size)
+        print(height - height%window_size)
+    return window_count, int(likely_empty.sum()) if likely_empty is not None else 0, failed
+
+
+def _extract_windows_worker(task):
+    '''
+    Worker run inside the process pool. Never raises so that one broken image
+    does not stop the whole flight.
+
+    Returns:
+    - (image_path, window_count, likely_empty_count, error) (tuple): error is None if every window was saved
+    '''
+    image_path, output_folder, window_size, tile_filter, drop_empty = task
+    try:
+        window_count, likely_empty_count, failed = extract_windows(image_path, output_folder, window_size, False,
+                                                                   tile_filter, drop_empty)
+    except Exception as e:
+        return image_path, 0, 0, str(e)
+    error = None
+    if failed:
+        error = f"{len(failed)} windows failed: " + '; '.join(f'{tile_name}: {message}' for tile_name, message in failed)
+    return image_path, window_count, likely_empty_count, error
+
+
+def extract_windows_parallel(image_paths, output_folder, window_size=256, num_workers=None, chunksize=None, report_every=100,
+                             tile_filter=None, drop_empty=False):
+    '''
+    Crop many images into windows using a pool of processes.
+    The tiles written are identical to calling extract_windows on every image one by one,
+    only the per window prints are replaced by a progress line every report_every images
+    and a summary at the end.
+
+    Parameters:
+    - image_paths (list): paths of the images to crop
+    - output_folder (str): folder where the tiles are saved
+    - window_size (int): side of the square window in pixels
+    - num_workers (int): number of processes, defaults to the number of cpus
+    - chunksize (int): number of images handed to a worker at a time,
+      defaults to roughly 4 chunks per worker
+    - report_every (int): print the progress after this many images
+    - tile_filter, drop_empty: see extract_windows
+
+    Returns:
+    - summary (dict): 'images', 'windows', 'likely_empty' (windows tagged or dropped by tile_filter),
+      'failed' (list of (path, error)), 'seconds', 'images_per_second', 'windows_per_second'
+    '''
+    image_paths = list(image_paths)
+    total = len(image_paths)
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(1, min(num_workers, total)) if total else 1
+    if chunksize is None:
+        chunksize = max(1, total // (num_workers * 4))
+
+    os.makedirs(output_folder, exist_ok=True)
+    tasks = [(image_path, output_folder, window_size, tile_filter, drop_empty) for image_path in image_paths]
+
+    window_total = 0
+    likely_empty_total = 0
+    failed = []
+    start = time.perf_counter()
+    with Pool(processes=num_workers) as pool:
+        results = pool.imap_unordered(_extract_windows_worker, tasks, chunksize=chunksize)
+        for done, (image_path, window_count, likely_empty_count, error) in enumerate(results, start=1):
+            window_total += window_count
+            likely_empty_total += likely_empty_count
+            if error is not None:
+                failed.append((image_path, error))
+            if done % report_every == 0 or done == total:
+                elapsed = time.perf_counter() - start
+                print(f"[{done}/{total}] images, {window_total} windows, {len(failed)} failed, {elapsed:.1f}s")
+
+    seconds = time.perf_counter() - start
+    summary = {
+        'images': total,
+        'windows': window_total,
+        'likely_empty': likely_empty_total,
+        'failed': failed,
+        'seconds': seconds,
+        'images_per_second': total / seconds if seconds > 0 else 0.0,
+        'windows_per_second': window_total / seconds if seconds > 0 else 0.0,
+    }
+    print(f"Cropped {total} images into {window_total} windows with {num_workers} workers "
+          f"in {seconds:.1f}s ({summary['images_per_second']:.2f} images/s, {summary['windows_per_second']:.1f} windows/s)")
+    if tile_filter is not None:
+        print(f"{likely_empty_total} likely empty windows {'dropped' if drop_empty else 'tagged'}")
+    for image_path, error in failed:
+        print(f"Failed: {image_path}: {error}")
+    return summary
+
+
+def window_origins(width, height, window_size=256, stride=None, pad=False):
+    '''
+    Top left corners of the windows that cover an image, row by row.
+    With stride == window_size and pad=False these are the windows of extract_windows.
+
+    Parameters:
+    - width, height (int): image size
+    - window_size (int): side of the square window
+    - stride (int): step between two windows, window_size - overlap. Defaults to window_size
+    - pad (bool): add a last row/column of windows that goes past the image border
+      so that the remainder strip is not thrown away
+
+    Returns:
+    - origins (list): list of (x, y)
+    '''
+    if stride is None:
+        stride = window_size
+
+    def axis_positions(size):
+        if size < window_size:
+            return [0] if pad else []
+        positions = list(range(0, size - window_size + 1, stride))
+        if pad and positions[-1] + window_size < size:
+            positions.append(positions[-1] + stride)
+        return positions
+
+    return [(x, y) for y in axis_positions(height) for x in axis_positions(width)]
+
+
+def reproject_obb_to_window(corners, x, y, window_size, min_visibility=0.5, clip=True):
+    '''
+    Move full frame oriented boxes into the coordinates of one window.
+
+    Parameters:
+    - corners (np.ndarray): (N, 4, 2) corners in full frame pixels
+    - x, y (int): top left corner of the window in the full frame
+    - window_size (int): side of the square window
+    - min_visibility (float): fraction of the box area that has to be inside the window,
+      boxes below it are dropped
+    - clip (bool): replace the kept boxes crossing the window border by the minimum area rectangle
+      of their part inside the window, otherwise the corners are left as they are (they may be outside the tile)
+
+    Returns:
+    - keep (np.ndarray): indices of the kept boxes
+    - window_corners (np.ndarray): (len(keep), 4, 2) corners relative to the window
+    '''
+    if len(corners) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 4, 2))
+    x_max, y_max = x + window_size, y + window_size
+
+    # cheap test on the axis aligned extent before clipping the polygons
+    low = corners.min(axis=1)
+    high = corners.max(axis=1)
+    candidates = np.nonzero((high[:, 0] > x) & (low[:, 0] < x_max) & (high[:, 1] > y) & (low[:, 1] < y_max))[0]
+
+    area = polygon_area(corners[candidates])
+    clipped, counts = clip_polygons_to_rect(corners[candidates], x, y, x_max, y_max)
+    visible_area = polygon_area(clipped, counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        visible = (area > 0) & (visible_area > 0) & (visible_area / area >= min_visibility)
+    keep = candidates[visible]
+
+    window_corners = corners[keep] - np.array([x, y], dtype=np.float64)
+    if clip:
+        # clamping every corner on its own would not give a rectangle for a rotated box
+        crossing = ((window_corners < 0) | (window_corners > window_size)).any(axis=(1, 2))
+        if crossing.any():
+            inside = clipped[visible][crossing] - np.array([x, y], dtype=np.float64)
+            window_corners[crossing] = min_area_rectangle(inside, counts[visible][crossing], dtype=np.float64)
+    return keep, window_corners
+
+
+def extract_windows_with_labels(image_path, label_path, output_folder, labels_output_folder, window_size=256,
+                                stride=None, pad=False, min_visibility=0.5, clip=True, keep_empty=False, verbose=True,
+                                tile_filter=None, drop_empty=False):
+    '''
+    Crop an image into windows and write the label file of every window in the same pass.
+    The full frame labels are in the 8 corner format written by the converters
+    (x1,y1,x2,y2,x3,y3,x4,y4,class_label,difficulty in pixels), the labels of the windows
+    are written in the same format relative to the window.
+
+    Parameters:
+    - image_path (str): path of the full frame image
+    - label_path (str): path of the full frame label file
+    - output_folder (str): folder where the tiles are saved as <image_name><window_index>.jpg
+    - labels_output_folder (str): folder where the labels are saved as <image_name><window_index>.txt
+    - window_size (int): side of the square window in pixels
+    - stride (int): step between two windows, window_size - overlap. Defaults to window_size
+    - pad (bool): keep the remainder strip by padding the last windows with black
+    - min_visibility (float): boxes with less than this fraction of their area inside a window are dropped
+    - clip (bool): shrink the boxes crossing the border of the window to their part inside the window
+    - keep_empty (bool): also write an (empty) label file for windows without boxes
+    - verbose (bool): print a line for every saved window
+    - tile_filter (EmptyTileFilter): optional filter of the windows that are only water (empty_tile_filter.py),
+      the likely empty windows and their labels are saved in a likely_empty sub folder of
+      output_folder and labels_output_folder instead
+    - drop_empty (bool): do not save the likely empty windows (and their labels) at all
+
+    Returns:
+    - window_count (int): number of windows saved
+    - box_count (int): number of boxes written over all windows
+    - likely_empty_count (int): number of windows the filter found likely empty (tagged or dropped)
+    - likely_empty_boxes (int): number of boxes on those windows, the boxes lost from the training tiles
+    '''
+    corners, class_labels, difficulties = read_obb_label_file(label_path)
+    return extract_windows_with_boxes(image_path, corners, class_labels, difficulties, output_folder, labels_output_folder,
+                                      window_size, stride, pad, min_visibility, clip, keep_empty, verbose, tile_filter, drop_empty)
+
+
+def extract_windows_with_boxes(image_path, corners, class_labels, difficulties, output_folder, labels_output_folder,
+                               window_size=256, stride=None, pad=False, min_visibility=0.5, clip=True, keep_empty=False, verbose=True,
+                               tile_filter=None, drop_empty=False):
+    '''
+    Same as extract_windows_with_labels with the full frame boxes given as arrays instead of a label file.
+
+    Parameters:
+    - corners (np.ndarray): (N, 4, 2) corners of the boxes in full frame pixels
+    - class_labels (list): class label of every box
+    - difficulties (list): difficulty of every box
+    - the other parameters are the ones of extract_windows_with_labels
+
+    Returns:
+    - window_count, box_count, likely_empty_count, likely_empty_boxes (int): see extract_windows_with_labels
+    '''
+    image = Image.open(image_path)
+    width, height = image.size
+    corners = np.asarray(corners, dtype=np.float64).reshape(-1, 4, 2)
+    class_labels = np.asarray(class_labels, dtype=str)
+    difficulties = np.asarray(difficulties, dtype=str)
+
+    os.makedirs(output_folder, exist_ok=True)
+    os.makedirs(labels_output_folder, exist_ok=True)
+
+    image_name = os.path.splitext(os.path.basename(image_path))[0]
+
+    origins = window_origins(width, height, window_size, stride, pad)
+    # crop past the border of the image is filled with black
+    windows = [image.crop((x, y, x + window_size, y + window_size)) for x, y in origins]
+    # the windows of the frame are scored in one batch
+    likely_empty = np.zeros(len(windows), dtype=bool)
+    if tile_filter is not None and windows:
+        likely_empty = ~tile_filter.keep(np.stack([np.asarray(window.convert('RGB')) for window in windows]))
+
+    window_count = 0
+    box_count = 0
+    likely_empty_boxes = 0
+    label_items = {}
+    for window_index, ((x, y), window) in enumerate(zip(origins, windows)):
+        # the name of a window is its index in the frame, a dropped window keeps its number
+        tile_name = f'{image_name}{window_index}'
+        keep, window_corners = reproject_obb_to_window(corners, x, y, window_size, min_visibility, clip)
+        tile_folder, label_folder = output_folder, labels_output_folder
+        if likely_empty[window_index]:
+            likely_empty_boxes += len(keep)
+            if drop_empty:
+                continue
+            tile_folder = os.path.join(output_folder, 'likely_empty')
+            label_folder = os.path.join(labels_output_folder, 'likely_empty')
+            os.makedirs(tile_folder, exist_ok=True)
+        window.save(os.path.join(tile_folder, f'{tile_name}.jpg'))
+        window_count += 1
+
+        if len(keep) or keep_empty:
+            lines = format_lines(np.round(window_corners.reshape(-1, 8), 3), [class_labels[keep], difficulties[keep]])
+            label_items.setdefault(label_folder, []).append((f'{tile_name}.txt', lines_to_text(lines.tolist())))
+            box_count += len(keep)
+        if verbose:
+            print(f"{tile_name} saved sucessfully with {len(keep)} boxes. ({x},{y}), ({x+window_size},{y+window_size})")
+
+    # the labels of all the windows of the frame are written at once by a pool of threads
+    for label_folder, items in label_items.items():
+        write_label_files(items, label_folder)
+    return window_count, box_count, int(likely_empty.sum()), likely_empty_boxes
+
+
+def extract_windows_of_annotation_set(annotations, image_folder, output_folder, labels_output_folder, **kwargs):
+    '''
+    Crop every image of an AnnotationSet (see annotation_store.py) together with its boxes.
+
+    Parameters:
+    - annotations (AnnotationSet): full frame annotations, e.g. from load_label_studio_annotations
+    - image_folder (str): folder of the full frame images named like annotations.file_names
+    - output_folder (str): folder of the tiles
+    - labels_output_folder (str): folder of the labels of the tiles
+    - kwargs: window_size, stride, pad, min_visibility, clip, keep_empty, verbose, tile_filter, drop_empty
+      of extract_windows_with_labels
+
+    Returns:
+    - window_count, box_count, likely_empty_count, likely_empty_boxes (int): totals over all the images
+    '''
+    totals = np.zeros(4, dtype=np.int64)
+    for i, file_name in enumerate(annotations.file_names.tolist()):
+        image_path = os.path.join(image_folder, file_name)
+        if not os.path.exists(image_path):
+            print(f"Image file {file_name} not found in {image_folder}")
+            continue
+        corners, _ = annotations.boxes(i)
+        start, end = annotations.box_range(i)
+        totals += extract_windows_with_boxes(image_path, corners, annotations.class_labels(i),
+                                             annotations.difficulties[start:end].tolist(),
+                                             output_folder, labels_output_folder, **kwargs)
+    return tuple(totals.tolist())
+
+
+def iter_windows(image_paths, window_size=256, stride=None, pad=False):
+    '''
+    Generator over the windows of many images without writing anything to disk.
+    Every image is decoded once and the windows are numpy views into the decoded frame,
+    no pixels are copied (copy a tile before modifying it).
+
+    Parameters:
+    - image_paths (list): paths of the images
+    - window_size (int): side of the square window in pixels
+    - stride (int): step between two windows, defaults to window_size
+    - pad (bool): keep the remainder strip, the frame is padded with black once
+
+    Yields:
+    - tile (np.ndarray): uint8 view of shape (window_size, window_size, 3)
+    - origin (tuple): (x, y) of the top left corner of the window in the frame
+    - source_id (int): index of the image in image_paths
+    '''
+    for source_id, image_path in enumerate(image_paths):
+        with Image.open(image_path) as image:
+            frame = np.asarray(image.convert('RGB'))
+        height, width = frame.shape[:2]
+        origins = window_origins(width, height, window_size, stride, pad)
+        if not origins:
+            continue
+        if pad:
+            padded_width = max(x for x, _ in origins) + window_size
+            padded_height = max(y for _, y in origins) + window_size
+            if padded_width > width or padded_height > height:
+                frame = np.pad(frame, ((0, padded_height - height), (0, padded_width - width), (0, 0)))
+        for x, y in origins:
+            yield frame[y:y + window_size, x:x + window_size], (x, y), source_id
+
+
+def batch_windows(windows, batch_size=32):
+    '''
+    Stack the windows of iter_windows into batches.
+
+    Parameters:
+    - windows (iterable): (tile, origin, source_id) as yielded by iter_windows
+    - batch_size (int): number of tiles in a batch, the last batch may be smaller
+
+    Yields:
+    - tiles (np.ndarray): uint8 array of shape (N, H, W, 3)
+    - origins (np.ndarray): int32 array of shape (N, 2) with the (x, y) of every tile
+    - source_ids (np.ndarray): int64 array of shape (N,)
+    '''
+    tiles, origins, source_ids = [], [], []
+    for tile, origin, source_id in windows:
+        tiles.append(tile)
+        origins.append(origin)
+        source_ids.append(source_id)
+        if len(tiles) == batch_size:
+            yield np.stack(tiles), np.array(origins, dtype=np.int32), np.array(source_ids, dtype=np.int64)
+            tiles, origins, source_ids = [], [], []
+    if tiles:
+        yield np.stack(tiles), np.array(origins, dtype=np.int32), np.array(source_ids, dtype=np.int64)
 
 
 def get_jpg_files_path(folder_path):
@@ -82,11 +480,72 @@ def main():
         folder_path = yaml_data['folder_path']
         copped_image_output_folder=yaml_data['copped_image_output_folder']
 
-        jpg_files_paths = get_jpg_files_path(folder_path)
+        # optional: number of processes, 1 (or missing) keeps the serial behaviour
+        num_workers = yaml_data.get('num_workers', 1)
+
+        # optional: take the frames from the dataset catalog (dataset_catalog.py), the scan only
+        # opens the files that changed since the previous run
+        catalog_path = yaml_data.get('catalog')
+        if catalog_path:
+            from dataset_catalog import DatasetCatalog
+            with DatasetCatalog(catalog_path) as catalog:
+                catalog.scan(folder_path)
+                jpg_files_paths = catalog.files(folder_path)
+        else:
+            jpg_files_paths = get_jpg_files_path(folder_path)
+
+        # optional: filter of the windows that are only water (empty_tile_filter.py),
+        # empty_tiles 'tag' puts them in a likely_empty sub folder, 'drop' does not save them
+        tile_filter = None
+        if yaml_data.get('empty_tile_filter'):
+            from empty_tile_filter import EmptyTileFilter
+            tile_filter = EmptyTileFilter.load(yaml_data['empty_tile_filter'])
+        drop_empty = yaml_data.get('empty_tiles', 'tag') == 'drop'
+
+        # optional: crop the full frame labels together with the images
+        labels_folder = yaml_data.get('labels_folder')
+        if labels_folder:
+            labels_output_folder = yaml_data['labels_output_folder']
+            window_size = yaml_data.get('window_size', 256)
+            totals = np.zeros(4, dtype=np.int64)
+            for jpg_files_path in jpg_files_paths:
+                label_path = os.path.join(labels_folder, os.path.splitext(os.path.basename(jpg_files_path))[0] + '.txt')
+                if not os.path.exists(label_path):
+                    print(f"No labels for {jpg_files_path}, skipped.")
+                    continue
+                totals += extract_windows_with_labels(jpg_files_path, label_path, copped_image_output_folder, labels_output_folder,
+                                                      window_size=window_size,
+                                                      stride=window_size - yaml_data.get('overlap', 0),
+                                                      pad=yaml_data.get('pad', False),
+                                                      min_visibility=yaml_data.get('min_visibility', 0.5),
+                                                      clip=yaml_data.get('clip', True),
+                                                      tile_filter=tile_filter, drop_empty=drop_empty)
+            window_count, box_count, likely_empty_count, likely_empty_boxes = totals.tolist()
+            print(f"{window_count} windows saved with {box_count} boxes")
+            if tile_filter is not None:
+                # the boxes of the dropped windows are not in box_count
+                all_boxes = box_count + (likely_empty_boxes if drop_empty else 0)
+                print(f"{likely_empty_count} likely empty windows {'dropped' if drop_empty else 'tagged'}, "
+                      f"{likely_empty_boxes} of {all_boxes} boxes were on them "
+                      f"(recall {1 - likely_empty_boxes / max(all_boxes, 1):.3f})")
+            return
 
-        for jpg_files_path in jpg_files_paths:
-            print(file_path)
-            extract_windows(jpg_files_path, copped_image_output_folder)
+        if num_workers is None or num_workers > 1:
+            extract_windows_parallel(jpg_files_paths, copped_image_output_folder, num_workers=num_workers,
+                                     tile_filter=tile_filter, drop_empty=drop_empty)
+        else:
+            likely_empty_total = 0
+            failed = []
+            for jpg_files_path in jpg_files_paths:
+                print(file_path)
+                _, likely_empty_count, window_failures = extract_windows(jpg_files_path, copped_image_output_folder,
+                                                                         tile_filter=tile_filter, drop_empty=drop_empty)
+                likely_empty_total += likely_empty_count
+                failed += window_failures
+            if tile_filter is not None:
+                print(f"{likely_empty_total} likely empty windows {'dropped' if drop_empty else 'tagged'}")
+            if failed:
+                print(f"{len(failed)} windows could not be saved")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,377 @@
+# local catalog (SQLite) of the images, tiles and labels of the dataset
+#
+# A scan walks a folder once and only opens the files whose size or mtime changed since the
+# previous scan (image size, sha1 of the content, boxes of a label), files that disappeared are
+# removed. The scripts can then select files with a query instead of listing directories, e.g.
+# all the tiles of a flight having at least one waste box. crop.py, near_duplicates.py,
+# empty_tile_filter.py, render_overlays.py/gallery.py and move_files.py take an optional catalog
+# and list their image and label folders through list_files.
+#
+# Names of the DJI files:
+#     DJI_20240518124354_0068_V.jpg       a frame
+#     DJI_20240518124354_0068_V248.jpg    window 248 of that frame (crop.py)
+#     3a930657-DJI_..._V248.jpg           same, with the prefix added by label-studio
+# The origin of a tile is computed from its window index and the size of its frame (when the
+# frame is in the catalog) with the stride the tile folder was scanned with.
+#
+# Usage:
+# python dataset_catalog.py catalog.db scan <folder> [<folder> ...] [--flight NAME] [--stride 192]
+# python dataset_catalog.py catalog.db tiles [--flight NAME] [--min-boxes 1] [--class waste] [--label-folder labelTxt]
+
+import os
+import re
+import sys
+import time
+import sqlite3
+import argparse
+from pathlib import Path
+from PIL import Image
+from conversion_manifest import file_sha1
+from miscellaneous import read_obb_label_file
+from crop import window_origins
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    folder TEXT NOT NULL,
+    stem TEXT NOT NULL,
+    kind TEXT NOT NULL,             -- 'frame', 'tile' or 'image'
+    frame TEXT,                     -- stem of the frame (without label-studio prefix)
+    window INTEGER,                 -- index of the window of a tile in its frame
+    origin_x INTEGER,
+    origin_y INTEGER,
+    flight TEXT,
+    width INTEGER,
+    height INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha1 TEXT
+);
+CREATE INDEX IF NOT EXISTS images_stem ON images (stem);
+CREATE INDEX IF NOT EXISTS images_frame ON images (frame, kind);
+CREATE INDEX IF NOT EXISTS images_flight ON images (flight, kind);
+CREATE TABLE IF NOT EXISTS labels (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    folder TEXT NOT NULL,
+    stem TEXT NOT NULL,
+    box_count INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS labels_stem ON labels (stem);
+CREATE TABLE IF NOT EXISTS label_classes (
+    label_id INTEGER NOT NULL REFERENCES labels (id) ON DELETE CASCADE,
+    class_label TEXT NOT NULL,
+    count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS label_classes_label ON label_classes (label_id);
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    stride INTEGER,
+    pad INTEGER,
+    scanned_at REAL
+);
+'''
+
+FRAME_PATTERN = re.compile(r'^(?:[0-9a-f]{8}-)?(?P<frame>DJI_\d{14}_\d+_V)(?P<window>\d*)$')
+FLIGHT_FOLDER_PATTERN = re.compile(r'^DJI_\d{12}_\d+$')
+IMAGE_EXTENTIONS = ('.jpg', '.jpeg', '.png')
+
+
+def parse_image_name(stem):
+    '''
+    Returns:
+    - kind (str): 'frame', 'tile' or 'image' (not a DJI name)
+    - frame (str): stem of the frame, None for other images
+    - window (int): window index of a tile, None otherwise
+    '''
+    match = FRAME_PATTERN.match(stem)
+    if match is None:
+        return 'image', None, None
+    if match.group('window'):
+        return 'tile', match.group('frame'), int(match.group('window'))
+    return 'frame', match.group('frame'), None
+
+
+def flight_of(path, frame):
+    '''
+    Flight of an image: the DJI flight folder it is in (e.g. DJI_202405181237_003), else the capture day of its frame.
+    '''
+    for parent in Path(path).parents:
+        if FLIGHT_FOLDER_PATTERN.match(parent.name):
+            return parent.name
+    if frame is not None:
+        return frame[:12]
+    return None
+
+
+class DatasetCatalog:
+    '''
+    Example:
+    >>> catalog = DatasetCatalog('dataset/catalog.db')
+    >>> catalog.scan('dataset/bishnumati')                      # frames
+    >>> catalog.scan('dataset/bishnumati-cropped-images')       # tiles
+    >>> catalog.scan('dataset/labelTxt')                        # labels of the tiles
+    >>> catalog.tiles(flight='DJI_20240518', min_boxes=1, class_label='waste')
+    '''
+
+    def __init__(self, database_path):
+        self.database_path = str(database_path)
+        self.connection = sqlite3.connect(self.database_path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def scan(self, folder, flight=None, stride=None, pad=False):
+        '''
+        Update the catalog with the images and labels of a folder (recursively).
+
+        Parameters:
+        - folder (str): folder to scan
+        - flight (str): flight of all the images of the folder, derived from the names by default
+        - stride (int): stride the tiles of the folder were cut with, defaults to the tile size
+        - pad (bool): whether the tiles were cut with pad=True (see crop.window_origins)
+
+        Returns:
+        - summary (dict): 'images', 'labels' (files seen), 'updated' (files opened), 'removed', 'seconds'
+        '''
+        start = time.perf_counter()
+        folder = os.path.abspath(folder)
+        # the folder and its sub folders (LIKE would treat the _ of the DJI names as a wildcard)
+        in_folder = (folder, len(folder) + 1, folder + os.sep)
+        known_images = {path: (size, mtime_ns) for path, size, mtime_ns in self.connection.execute(
+            'SELECT path, size, mtime_ns FROM images WHERE folder = ? OR substr(folder, 1, ?) = ?', in_folder)}
+        known_labels = {path: (size, mtime_ns) for path, size, mtime_ns in self.connection.execute(
+            'SELECT path, size, mtime_ns FROM labels WHERE folder = ? OR substr(folder, 1, ?) = ?', in_folder)}
+
+        seen_images, seen_labels = set(), set()
+        image_rows, label_rows = [], []
+        for directory, _, filenames in os.walk(folder):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                extention = os.path.splitext(filename)[1].lower()
+                if extention not in IMAGE_EXTENTIONS and extention != '.txt':
+                    continue
+                stat = os.stat(path)
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if extention == '.txt':
+                    seen_labels.add(path)
+                    if known_labels.get(path) != signature:
+                        label_rows.append(self._label_row(path, directory, signature))
+                else:
+                    seen_images.add(path)
+                    if known_images.get(path) != signature:
+                        image_rows.append(self._image_row(path, directory, signature, flight))
+
+        with self.connection:
+            self.connection.executemany('''
+                INSERT INTO images (path, folder, stem, kind, frame, window, flight, width, height, size, mtime_ns, sha1)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET kind = excluded.kind, frame = excluded.frame, window = excluded.window,
+                    flight = excluded.flight, width = excluded.width, height = excluded.height, origin_x = NULL, origin_y = NULL,
+                    size = excluded.size, mtime_ns = excluded.mtime_ns, sha1 = excluded.sha1''', image_rows)
+            for path, directory, stem, box_count, size, mtime_ns, class_counts in label_rows:
+                self.connection.execute('DELETE FROM labels WHERE path = ?', (path,))
+                label_id = self.connection.execute(
+                    'INSERT INTO labels (path, folder, stem, box_count, size, mtime_ns) VALUES (?, ?, ?, ?, ?, ?)',
+                    (path, directory, stem, box_count, size, mtime_ns)).lastrowid
+                self.connection.executemany('INSERT INTO label_classes (label_id, class_label, count) VALUES (?, ?, ?)',
+                                            [(label_id, class_label, count) for class_label, count in class_counts.items()])
+            removed_images = [(path,) for path in known_images.keys() - seen_images]
+            removed_labels = [(path,) for path in known_labels.keys() - seen_labels]
+            self.connection.executemany('DELETE FROM images WHERE path = ?', removed_images)
+            self.connection.executemany('DELETE FROM labels WHERE path = ?', removed_labels)
+            self.connection.execute('INSERT OR REPLACE INTO folders (path, stride, pad, scanned_at) VALUES (?, ?, ?, ?)',
+                                    (folder, stride, int(pad), time.time()))
+            self._update_tile_origins()
+
+        summary = {
+            'images': len(seen_images),
+            'labels': len(seen_labels),
+            'updated': len(image_rows) + len(label_rows),
+            'removed': len(removed_images) + len(removed_labels),
+            'seconds': time.perf_counter() - start,
+        }
+        print(f"{folder}: {summary['images']} images, {summary['labels']} labels, {summary['updated']} updated, "
+              f"{summary['removed']} removed in {summary['seconds']:.2f}s")
+        return summary
+
+    @staticmethod
+    def _image_row(path, directory, signature, flight):
+        stem = Path(path).stem
+        kind, frame, window = parse_image_name(stem)
+        try:
+            with Image.open(path) as image:
+                width, height = image.size
+        except Exception as e:
+            print(f'Error reading {path}: {e}')
+            width, height = None, None
+        return (path, directory, stem, kind, frame, window, flight or flight_of(path, frame),
+                width, height, signature[0], signature[1], file_sha1(path))
+
+    @staticmethod
+    def _label_row(path, directory, signature):
+        _, class_labels, _ = read_obb_label_file(path)
+        class_counts = {}
+        for class_label in class_labels:
+            class_counts[class_label] = class_counts.get(class_label, 0) + 1
+        return path, directory, Path(path).stem, len(class_labels), signature[0], signature[1], class_counts
+
+    def _update_tile_origins(self):
+        '''
+        Origin of the tiles whose frame is in the catalog, from the window index.
+        '''
+        rows = self.connection.execute('''
+            SELECT tile.id, tile.window, tile.width, frame.width, frame.height, folders.stride, folders.pad
+            FROM images AS tile
+            JOIN images AS frame ON frame.frame = tile.frame AND frame.kind = 'frame'
+            LEFT JOIN folders ON substr(tile.path, 1, length(folders.path) + 1) = folders.path || ?
+            WHERE tile.kind = 'tile' AND tile.origin_x IS NULL AND tile.width IS NOT NULL AND frame.width IS NOT NULL''',
+            (os.sep,)).fetchall()
+        origins_cache = {}
+        updates = []
+        for tile_id, window, tile_size, width, height, stride, pad in rows:
+            key = (width, height, tile_size, stride, bool(pad))
+            if key not in origins_cache:
+                origins_cache[key] = window_origins(width, height, tile_size, stride, bool(pad))
+            origins = origins_cache[key]
+            if window < len(origins):
+                updates.append((origins[window][0], origins[window][1], tile_id))
+        self.connection.executemany('UPDATE images SET origin_x = ?, origin_y = ? WHERE id = ?', updates)
+
+    def query(self, sql, parameters=()):
+        return self.connection.execute(sql, parameters).fetchall()
+
+    def files(self, folder, extention='.jpg'):
+        '''
+        Paths of the images (or the labels for extention '.txt') of a scanned folder (not recursive),
+        the replacement of get_jpg_files_path. The extension is matched case insensitively.
+        '''
+        folder = os.path.abspath(folder)
+        table = 'labels' if extention.lower() == '.txt' else 'images'
+        return [path for path, in self.connection.execute(
+            f'SELECT path FROM {table} WHERE folder = ? AND path LIKE ? ORDER BY path', (folder, '%' + extention))]
+
+    def tiles(self, flight=None, min_boxes=0, class_label=None, folder=None, label_folder=None):
+        '''
+        Select tiles with their label. When several label folders have a label of the same name, the label
+        of label_folder is used if given, else the one next to the tile, else the first one by path.
+
+        Parameters:
+        - flight (str): only the tiles of this flight
+        - min_boxes (int): only the tiles whose label has at least this many boxes (of class_label if given)
+        - class_label (str): count only the boxes of this class
+        - folder (str): only the tiles of this folder
+        - label_folder (str): take the labels from this folder only
+
+        Returns:
+        - list: (tile path, label path or None, box count, origin_x, origin_y)
+        '''
+        count = 'COALESCE(label_classes.count, 0)' if class_label is not None else 'COALESCE(labels.box_count, 0)'
+        join_classes = 'LEFT JOIN label_classes ON label_classes.label_id = labels.id AND label_classes.class_label = ?' \
+            if class_label is not None else ''
+        # one label per tile, a join on the stem alone would repeat the tile for every label folder
+        label_condition = 'AND candidate.folder = ?' if label_folder is not None else ''
+        conditions, parameters = ["images.kind = 'tile'"], []
+        if label_folder is not None:
+            parameters.append(os.path.abspath(label_folder))
+        if class_label is not None:
+            parameters.append(class_label)
+        if flight is not None:
+            conditions.append('images.flight = ?')
+            parameters.append(flight)
+        if folder is not None:
+            conditions.append('images.folder = ?')
+            parameters.append(os.path.abspath(folder))
+        if min_boxes > 0:
+            conditions.append(f'{count} >= ?')
+            parameters.append(min_boxes)
+        return self.query(f'''
+            WITH ranked AS (
+                SELECT tile.id AS image_id, candidate.id AS label_id, ROW_NUMBER() OVER (
+                    PARTITION BY tile.id ORDER BY candidate.folder = tile.folder DESC, candidate.path) AS rank
+                FROM images AS tile
+                JOIN labels AS candidate ON candidate.stem = tile.stem {label_condition}
+                WHERE tile.kind = 'tile')
+            SELECT images.path, labels.path, {count}, images.origin_x, images.origin_y
+            FROM images
+            LEFT JOIN ranked ON ranked.image_id = images.id AND ranked.rank = 1
+            LEFT JOIN labels ON labels.id = ranked.label_id
+            {join_classes}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY images.path''', parameters)
+
+    def summary(self):
+        '''
+        Returns:
+        - list: (flight, kind, number of images) of the catalog
+        '''
+        return self.query('SELECT flight, kind, COUNT(*) FROM images GROUP BY flight, kind ORDER BY flight, kind')
+
+
+def list_files(folder, extention='.jpg', catalog_path=None):
+    '''
+    Sorted paths of the files of a folder (not recursive) with the extension (case insensitive).
+
+    Parameters:
+    - folder (str): folder of images or of labels (extention '.txt')
+    - extention (str): extension of the files
+    - catalog_path (str): if given the folder is scanned into this catalog (only the files that changed
+      since the previous scan are opened) and the paths come from it, else the folder is listed
+
+    Returns:
+    - list: paths of the files
+    '''
+    if catalog_path is None:
+        with os.scandir(folder) as entries:
+            return sorted(entry.path for entry in entries if entry.name.lower().endswith(extention.lower()) and entry.is_file())
+    with DatasetCatalog(catalog_path) as catalog:
+        catalog.scan(folder)
+        return catalog.files(folder, extention)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite catalog of the images, tiles and labels of the dataset.')
+    parser.add_argument('database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    scan_parser = subparsers.add_parser('scan', help='add or update folders')
+    scan_parser.add_argument('folders', nargs='+')
+    scan_parser.add_argument('--flight', default=None)
+    scan_parser.add_argument('--stride', type=int, default=None, help='stride the tiles were cut with')
+    scan_parser.add_argument('--pad', action='store_true', help='the tiles were cut with pad=True')
+    tiles_parser = subparsers.add_parser('tiles', help='print the tiles matching a selection')
+    tiles_parser.add_argument('--flight', default=None)
+    tiles_parser.add_argument('--min-boxes', type=int, default=0)
+    tiles_parser.add_argument('--class', dest='class_label', default=None)
+    tiles_parser.add_argument('--label-folder', default=None, help='take the labels from this folder only')
+    subparsers.add_parser('summary', help='number of images per flight')
+    args = parser.parse_args()
+
+    with DatasetCatalog(args.database) as catalog:
+        if args.command == 'scan':
+            for folder in args.folders:
+                catalog.scan(folder, args.flight, args.stride, args.pad)
+        elif args.command == 'tiles':
+            start = time.perf_counter()
+            tiles = catalog.tiles(args.flight, args.min_boxes, args.class_label, label_folder=args.label_folder)
+            for tile_path, label_path, box_count, origin_x, origin_y in tiles:
+                print(f'{tile_path},{label_path or ""},{box_count},{origin_x},{origin_y}')
+            print(f'{len(tiles)} tiles in {(time.perf_counter() - start) * 1000:.1f} ms', file=sys.stderr)
+        else:
+            for flight, kind, count in catalog.summary():
+                print(f'{flight}: {count} {kind}s')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+# cheap filter of the windows that are only water, before they are labeled or sent to the detector
+#
+# A handful of statistics is computed for a whole batch of tiles at once (colour means and
+# spreads, saturation, grey level entropy, edge density, sun glint) and a logistic regression
+# on them gives the probability that a tile has waste. The regression is fitted on tiles that
+# are already labeled (a tile with at least one box is not empty) and the threshold is picked on
+# held out tiles for a target recall, so the number of waste tiles lost is known in advance.
+#
+# Usage:
+# python empty_tile_filter.py calibrate <tiles folder> <labels folder> filter.json [--recall 0.98] [--catalog catalog.db]
+# python empty_tile_filter.py report filter.json <tiles folder> <labels folder> [--catalog catalog.db]
+# then in path_constants.yaml (crop.py): empty_tile_filter : filter.json, empty_tiles : tag or drop
+
+import os
+import json
+import zlib
+import argparse
+import numpy as np
+from pathlib import Path
+from multiprocessing import Pool
+from PIL import Image
+from dataset_catalog import list_files
+
+FEATURE_NAMES = [
+    'mean_r', 'mean_g', 'mean_b', 'std_r', 'std_g', 'std_b', 'std_grey',
+    'saturation_mean', 'saturation_std', 'entropy', 'edge_mean', 'edge_density', 'glint',
+]
+
+
+def tile_features(tiles, edge_threshold=20.0):
+    '''
+    Statistics of a batch of tiles, computed on every second pixel.
+
+    Parameters:
+    - tiles (np.ndarray): uint8 RGB tiles of shape (N, H, W, 3)
+    - edge_threshold (float): grey level step counted as an edge
+
+    Returns:
+    - np.ndarray: (N, len(FEATURE_NAMES)) float32
+    '''
+    tiles = np.asarray(tiles)[:, ::2, ::2].astype(np.float32)
+    n = len(tiles)
+    pixels = tiles.reshape(n, -1, 3)
+    grey = tiles @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+    maximum = pixels.max(axis=2)
+    saturation = (maximum - pixels.min(axis=2)) / (maximum + 1.0)
+
+    # entropy of a 16 bin histogram of every tile, all the histograms in one bincount
+    bins = np.minimum(grey.reshape(n, -1) // 16, 15).astype(np.int64) + 16 * np.arange(n)[:, None]
+    histograms = np.bincount(bins.ravel(), minlength=16 * n).reshape(n, 16).astype(np.float32)
+    histograms /= np.maximum(histograms.sum(axis=1, keepdims=True), 1.0)
+    entropy = -(histograms * np.log2(np.where(histograms > 0, histograms, 1.0))).sum(axis=1)
+
+    gradient_x = np.abs(np.diff(grey, axis=2))[:, :-1, :]
+    gradient_y = np.abs(np.diff(grey, axis=1))[:, :, :-1]
+    gradient = np.maximum(gradient_x, gradient_y).reshape(n, -1)
+
+    return np.column_stack([
+        pixels.mean(axis=1),
+        pixels.std(axis=1),
+        grey.reshape(n, -1).std(axis=1),
+        saturation.mean(axis=1),
+        saturation.std(axis=1),
+        entropy,
+        gradient.mean(axis=1),
+        (gradient > edge_threshold).mean(axis=1),
+        (grey.reshape(n, -1) > 240).mean(axis=1),
+    ]).astype(np.float32)
+
+
+def fit_logistic(features, targets, l2=1e-2, iterations=25):
+    '''
+    Logistic regression fitted with Newton's method on standardized features.
+
+    Returns:
+    - weights (np.ndarray): (F,), bias (float)
+    '''
+    x = np.column_stack([features, np.ones(len(features))]).astype(np.float64)
+    y = np.asarray(targets, dtype=np.float64)
+    weights = np.zeros(x.shape[1])
+    penalty = l2 * np.eye(x.shape[1])
+    penalty[-1, -1] = 0.0
+    for _ in range(iterations):
+        p = 1.0 / (1.0 + np.exp(-(x @ weights)))
+        gradient = x.T @ (p - y) + penalty @ weights
+        hessian = (x * (p * (1 - p))[:, None]).T @ x + penalty
+        step = np.linalg.solve(hessian, gradient)
+        weights -= step
+        if np.abs(step).max() < 1e-6:
+            break
+    return weights[:-1], float(weights[-1])
+
+
+class EmptyTileFilter:
+    '''
+    Probability that a tile has waste from its tile_features, tiles below threshold are likely empty.
+    '''
+
+    def __init__(self, mean, std, weights, bias, threshold=0.5):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.std = np.asarray(std, dtype=np.float32)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.bias = float(bias)
+        self.threshold = float(threshold)
+
+    def score_features(self, features):
+        z = (features - self.mean) / self.std @ self.weights + self.bias
+        return 1.0 / (1.0 + np.exp(-z))
+
+    def score(self, tiles):
+        '''
+        Returns:
+        - np.ndarray: (N,) probability that every tile has waste
+        '''
+        if len(tiles) == 0:
+            return np.zeros(0, dtype=np.float32)
+        return self.score_features(tile_features(tiles))
+
+    def keep(self, tiles):
+        '''
+        Returns:
+        - np.ndarray: (N,) bool, False for the likely empty tiles
+        '''
+        return self.score(tiles) >= self.threshold
+
+    @classmethod
+    def fit(cls, features, has_boxes, l2=1e-2):
+        mean = features.mean(axis=0)
+        std = np.maximum(features.std(axis=0), 1e-6)
+        weights, bias = fit_logistic((features - mean) / std, has_boxes, l2)
+        return cls(mean, std, weights, bias)
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump({'features': FEATURE_NAMES, 'mean': self.mean.tolist(), 'std': self.std.tolist(),
+                       'weights': self.weights.tolist(), 'bias': self.bias, 'threshold': self.threshold}, file, indent=4)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as file:
+            parameters = json.load(file)
+        if parameters.get('features') != FEATURE_NAMES:
+            raise ValueError(f'{path} was calibrated with other features')
+        return cls(parameters['mean'], parameters['std'], parameters['weights'], parameters['bias'], parameters['threshold'])
+
+
+def _features_worker(task):
+    '''
+    Features and targets of a chunk of labeled tiles inside the process pool, unreadable tiles are skipped.
+    '''
+    tile_paths, labels_folder = task
+    tiles, has_boxes, names = [], [], []
+    for tile_path in tile_paths:
+        try:
+            with Image.open(tile_path) as image:
+                tiles.append(np.asarray(image.convert('RGB')))
+        except Exception as e:
+            print(f'Error reading {tile_path}: {e}')
+            continue
+        label_path = Path(labels_folder) / (Path(tile_path).stem + '.txt')
+        has_boxes.append(label_path.exists() and label_path.stat().st_size > 0)
+        names.append(Path(tile_path).name)
+    if not tiles:
+        return np.zeros((0, len(FEATURE_NAMES)), dtype=np.float32), np.zeros(0, dtype=bool), names
+    # tiles of different sizes are scored one by one
+    if len({tile.shape for tile in tiles}) > 1:
+        return np.concatenate([tile_features(tile[None]) for tile in tiles]), np.array(has_boxes), names
+    return tile_features(np.stack(tiles)), np.array(has_boxes), names
+
+
+def labeled_tile_features(tile_folder, labels_folder, num_workers=None, chunksize=256, extention='.jpg', catalog_path=None):
+    '''
+    Features of the tiles of a folder and whether their label has at least one box
+    (a tile without label file counts as empty, e.g. crop.py with keep_empty=False).
+    The tiles are listed from the dataset catalog if catalog_path is given (see dataset_catalog.list_files).
+
+    Returns:
+    - features (np.ndarray): (N, F), has_boxes (np.ndarray): (N,) bool, names (list): tile file names
+    '''
+    tile_paths = list_files(tile_folder, extention, catalog_path)
+    chunks = [(tile_paths[i:i + chunksize], labels_folder) for i in range(0, len(tile_paths), chunksize)]
+    features, has_boxes, names = [], [], []
+    with Pool(processes=num_workers) as pool:
+        for chunk_features, chunk_has_boxes, chunk_names in pool.imap(_features_worker, chunks):
+            features.append(chunk_features)
+            has_boxes.append(chunk_has_boxes)
+            names.extend(chunk_names)
+    if not features:
+        return np.zeros((0, len(FEATURE_NAMES)), dtype=np.float32), np.zeros(0, dtype=bool), []
+    return np.concatenate(features), np.concatenate(has_boxes), names
+
+
+def recall_report(scores, has_boxes, thresholds=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5)):
+    '''
+    Recall of the waste tiles and fraction of the tiles dropped at every threshold.
+
+    Returns:
+    - list: (threshold, recall, dropped fraction, waste tiles lost)
+    '''
+    rows = []
+    positives = max(int(has_boxes.sum()), 1)
+    for threshold in thresholds:
+        kept = scores >= threshold
+        rows.append((threshold, float((kept & has_boxes).sum() / positives), float(1 - kept.mean()),
+                     int((~kept & has_boxes).sum())))
+    return rows
+
+
+def print_recall_report(rows):
+    print('threshold  recall  dropped  waste tiles lost')
+    for threshold, recall, dropped, lost in rows:
+        print(f'{threshold:9.3f}  {recall:6.3f}  {dropped:7.1%}  {lost}')
+
+
+def calibrate(tile_folder, labels_folder, target_recall=0.98, holdout=0.2, num_workers=None, catalog_path=None):
+    '''
+    Fit the filter on labeled tiles and pick the highest threshold that keeps target_recall of the
+    waste tiles of a held out part (picked from the crc32 of the file names, the same on every run).
+
+    Returns:
+    - EmptyTileFilter
+    '''
+    features, has_boxes, names = labeled_tile_features(tile_folder, labels_folder, num_workers, catalog_path=catalog_path)
+    if len(names) == 0 or has_boxes.all() or not has_boxes.any():
+        raise ValueError(f'{tile_folder} needs labeled tiles with and without boxes to calibrate')
+    held_out = np.array([zlib.crc32(name.encode()) % 1000 < holdout * 1000 for name in names])
+    training = ~held_out
+    if not (has_boxes & held_out).any() or not (has_boxes & training).any():
+        # too few waste tiles to split, the threshold is picked on the training tiles
+        held_out[:] = True
+        training[:] = True
+
+    tile_filter = EmptyTileFilter.fit(features[training], has_boxes[training])
+    scores = tile_filter.score_features(features[held_out])
+    positive_scores = np.sort(scores[has_boxes[held_out]])
+    # the threshold under which at most (1 - target_recall) of the waste tiles fall
+    lost = int(np.floor((1 - target_recall) * len(positive_scores)))
+    tile_filter.threshold = float(positive_scores[lost]) if lost < len(positive_scores) else 0.0
+
+    print(f'{len(names)} tiles, {int(has_boxes.sum())} with boxes, {int(held_out.sum())} held out')
+    rows = recall_report(scores, has_boxes[held_out], sorted({tile_filter.threshold, 0.1, 0.2, 0.3, 0.5}))
+    print_recall_report(rows)
+    kept = scores >= tile_filter.threshold
+    print(f'threshold {tile_filter.threshold:.3f}: recall {(kept & has_boxes[held_out]).sum() / max(has_boxes[held_out].sum(), 1):.3f}, '
+          f'{1 - kept.mean():.1%} of the tiles dropped')
+    return tile_filter
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Filter of the tiles that are only water.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    calibrate_parser = subparsers.add_parser('calibrate', help='fit the filter on labeled tiles')
+    calibrate_parser.add_argument('tile_folder')
+    calibrate_parser.add_argument('labels_folder')
+    calibrate_parser.add_argument('filter_path', help='json file the filter is saved to')
+    calibrate_parser.add_argument('--recall', type=float, default=0.98, help='share of the waste tiles to keep')
+    calibrate_parser.add_argument('--workers', type=int, default=None)
+    calibrate_parser.add_argument('--catalog', default=None, help='list the tiles from this dataset catalog (dataset_catalog.py)')
+    report_parser = subparsers.add_parser('report', help='recall and dropped tiles of a filter on labeled tiles')
+    report_parser.add_argument('filter_path')
+    report_parser.add_argument('tile_folder')
+    report_parser.add_argument('labels_folder')
+    report_parser.add_argument('--workers', type=int, default=None)
+    report_parser.add_argument('--catalog', default=None, help='list the tiles from this dataset catalog (dataset_catalog.py)')
+    args = parser.parse_args()
+
+    if args.command == 'calibrate':
+        tile_filter = calibrate(args.tile_folder, args.labels_folder, args.recall, num_workers=args.workers, catalog_path=args.catalog)
+        tile_filter.save(args.filter_path)
+    else:
+        tile_filter = EmptyTileFilter.load(args.filter_path)
+        features, has_boxes, _ = labeled_tile_features(args.tile_folder, args.labels_folder, args.workers, catalog_path=args.catalog)
+        scores = tile_filter.score_features(features)
+        print_recall_report(recall_report(scores, has_boxes, sorted({tile_filter.threshold, 0.1, 0.2, 0.3, 0.5})))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+# gallery of a dataset as pages of columns*rows thumbnails with their boxes, for review
+#
+# The thumbnails (boxes already drawn, see render_overlays.py) are kept in a cache folder
+# so that only the first build decodes the full resolution images. A thumbnail is keyed by
+# the path and mtime of the image and of its label file, editing either renders it again.
+# The cache has a size budget, the least recently used thumbnails are deleted above it.
+#
+# cache_folder/
+#     index.json          {"version": 1, "entries": {key: {"bytes": ..., "used": ...}}}
+#     <key>.jpg           one thumbnail per (image, label, cell size)
+#
+# Usage:
+# python gallery.py <image folder> <labels folder> <output folder> --cache <cache folder> [--pages 0-9]
+#                   [--catalog catalog.db]
+
+import os
+import json
+import time
+import hashlib
+import argparse
+from multiprocessing import Pool
+from PIL import Image
+from render_overlays import render_boxes, overlay_tasks_from_folder
+from label_writer import atomic_path, write_text_atomic
+
+INDEX_VERSION = 1
+
+
+def _mtime(path):
+    return os.stat(path).st_mtime_ns if path is not None else 0
+
+
+def thumbnail_key(image_path, label_path, cell_size):
+    '''
+    Key of a thumbnail: sha1 of the absolute paths and mtimes of the image and label and of the cell size.
+    '''
+    text = f'{os.path.abspath(image_path)}|{_mtime(image_path)}|{label_path}|{_mtime(label_path)}|{cell_size}'
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def _render_thumbnail_worker(task):
+    '''
+    Render one thumbnail inside the process pool, never raises.
+
+    Returns:
+    - (key, bytes, error) (tuple): error is None if successful
+    '''
+    key, image_path, label_path, cell_size, thumbnail_path = task
+    try:
+        thumbnail, _ = render_boxes(image_path, label_path, max_size=cell_size, width=1)
+        with atomic_path(thumbnail_path) as temp_path:
+            thumbnail.save(temp_path, format='JPEG', quality=85)
+        return key, os.path.getsize(thumbnail_path), None
+    except Exception as e:
+        return key, 0, str(e)
+
+
+class ThumbnailCache:
+    '''
+    Persistent cache of thumbnails with their boxes drawn, evicted least recently used first.
+
+    Example:
+    >>> cache = ThumbnailCache('gallery_cache', budget_bytes=1 << 30)
+    >>> cache.build(overlay_tasks_from_folder(image_folder, labels_folder), num_workers=8)
+    >>> thumbnail = cache.get(image_path, label_path)
+    >>> cache.save()
+    '''
+
+    def __init__(self, cache_folder, budget_bytes=512 << 20, cell_size=256):
+        self.cache_folder = str(cache_folder)
+        self.budget_bytes = budget_bytes
+        self.cell_size = cell_size
+        os.makedirs(self.cache_folder, exist_ok=True)
+        self.index_path = os.path.join(self.cache_folder, 'index.json')
+        self.entries = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r') as file:
+                index = json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"Ignoring the thumbnail index '{self.index_path}': {e}")
+            return {}
+        if index.get('version') != INDEX_VERSION:
+            return {}
+        # thumbnails deleted by hand are rendered again
+        return {key: entry for key, entry in index.get('entries', {}).items() if os.path.exists(self._path(key))}
+
+    def _path(self, key):
+        return os.path.join(self.cache_folder, f'{key}.jpg')
+
+    @property
+    def total_bytes(self):
+        return sum(entry['bytes'] for entry in self.entries.values())
+
+    def save(self):
+        '''
+        Write the index atomically, an interrupted run keeps the previous index.
+        '''
+        write_text_atomic(self.index_path, json.dumps({'version': INDEX_VERSION, 'entries': self.entries}))
+
+    def evict(self):
+        '''
+        Delete the least recently used thumbnails until the cache fits in its budget.
+
+        Returns:
+        - int: number of thumbnails deleted
+        '''
+        total = self.total_bytes
+        removed = 0
+        for key in sorted(self.entries, key=lambda key: self.entries[key]['used']):
+            if total <= self.budget_bytes:
+                break
+            total -= self.entries.pop(key)['bytes']
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            removed += 1
+        return removed
+
+    def build(self, tasks, num_workers=None, chunksize=16, page_size=256):
+        '''
+        Render the thumbnails of tasks that are not in the cache yet, using a pool of processes.
+        They are rendered page_size at a time in the order of tasks and the cache is evicted after
+        every page, so it never grows far above its budget. Once the thumbnails rendered by this call
+        fill the budget the rest is skipped, rendering them would only evict the first ones
+        (Gallery.page renders a skipped thumbnail when it is shown).
+
+        Parameters:
+        - tasks (list): (image_path, label_path or None), e.g. from overlay_tasks_from_folder
+        - num_workers (int): number of processes, defaults to the number of cpus
+        - chunksize (int): number of thumbnails handed to a worker at a time
+        - page_size (int): number of thumbnails rendered between two evictions
+
+        Returns:
+        - summary (dict): 'cached', 'rendered', 'skipped', 'evicted', 'failed' (list of (image_path, error)), 'seconds'
+        '''
+        start = time.perf_counter()
+        missing = {}
+        for image_path, label_path in tasks:
+            key = thumbnail_key(image_path, label_path, self.cell_size)
+            if key not in self.entries and key not in missing:
+                missing[key] = (key, image_path, label_path, self.cell_size, self._path(key))
+
+        failed = []
+        rendered, rendered_bytes, evicted = 0, 0, 0
+        pending = list(missing.values())
+        if pending:
+            with Pool(processes=num_workers) as pool:
+                while pending and rendered_bytes < self.budget_bytes:
+                    page, pending = pending[:page_size], pending[page_size:]
+                    for key, size, error in pool.imap_unordered(_render_thumbnail_worker, page, chunksize=chunksize):
+                        if error is not None:
+                            failed.append((missing[key][1], error))
+                            continue
+                        self.entries[key] = {'bytes': size, 'used': time.time()}
+                        rendered += 1
+                        rendered_bytes += size
+                    evicted += self.evict()
+        evicted += self.evict()
+        self.save()
+
+        summary = {
+            'cached': len(tasks) - len(missing),
+            'rendered': rendered,
+            'skipped': len(pending),
+            'evicted': evicted,
+            'failed': failed,
+            'seconds': time.perf_counter() - start,
+        }
+        print(f"{summary['cached']} thumbnails cached, {rendered} rendered, {len(pending)} skipped over the budget, "
+              f"{evicted} evicted, {len(failed)} failed in {summary['seconds']:.1f}s")
+        return summary
+
+    def get(self, image_path, label_path=None):
+        '''
+        Thumbnail of an image with its boxes, rendered (and cached) if it is not in the cache.
+
+        Returns:
+        - PIL.Image: RGB thumbnail whose longest side is cell_size
+        '''
+        key = thumbnail_key(image_path, label_path, self.cell_size)
+        if key not in self.entries:
+            _, size, error = _render_thumbnail_worker((key, image_path, label_path, self.cell_size, self._path(key)))
+            if error is not None:
+                raise RuntimeError(f'{image_path}: {error}')
+            self.entries[key] = {'bytes': size}
+        self.entries[key]['used'] = time.time()
+        with Image.open(self._path(key)) as thumbnail:
+            return thumbnail.convert('RGB')
+
+
+class Gallery:
+    '''
+    Pages of columns*rows thumbnails over all the images of a folder.
+
+    Example:
+    >>> gallery = Gallery(image_folder, labels_folder, 'gallery_cache', columns=6, rows=4)
+    >>> gallery.build()
+    >>> gallery.page(0).show()
+    '''
+
+    def __init__(self, image_folder, labels_folder, cache_folder, columns=4, rows=4, cell_size=256, budget_bytes=512 << 20,
+                 catalog_path=None):
+        self.tasks = overlay_tasks_from_folder(image_folder, labels_folder, catalog_path=catalog_path)
+        self.columns = columns
+        self.rows = rows
+        self.cache = ThumbnailCache(cache_folder, budget_bytes, cell_size)
+
+    def __len__(self):
+        return self.num_pages
+
+    @property
+    def num_pages(self):
+        per_page = self.columns * self.rows
+        return (len(self.tasks) + per_page - 1) // per_page
+
+    def build(self, num_workers=None, pages=None):
+        '''
+        Render the missing thumbnails of pages (all of them by default), one page at a time.
+        '''
+        per_page = self.columns * self.rows
+        tasks = self.tasks if pages is None else [task for page in pages for task in self.tasks[page * per_page:(page + 1) * per_page]]
+        return self.cache.build(tasks, num_workers, page_size=per_page)
+
+    def page(self, page):
+        '''
+        Returns:
+        - PIL.Image: mosaic of the thumbnails of the page
+        '''
+        cell_size = self.cache.cell_size
+        per_page = self.columns * self.rows
+        mosaic = Image.new('RGB', (self.columns * cell_size, self.rows * cell_size), (32, 32, 32))
+        for position, (image_path, label_path) in enumerate(self.tasks[page * per_page:(page + 1) * per_page]):
+            try:
+                thumbnail = self.cache.get(image_path, label_path)
+            except RuntimeError as e:
+                print(e)
+                continue
+            row, column = divmod(position, self.columns)
+            mosaic.paste(thumbnail, (column * cell_size, row * cell_size))
+        return mosaic
+
+    def save_pages(self, output_folder, pages=None):
+        '''
+        Write pages as page_<number>.jpg, all of them by default.
+        '''
+        os.makedirs(output_folder, exist_ok=True)
+        for page in (range(self.num_pages) if pages is None else pages):
+            self.page(page).save(os.path.join(output_folder, f'page_{page:05d}.jpg'), quality=90)
+            self.cache.evict()
+        self.cache.save()
+
+
+def parse_pages(text, num_pages):
+    '''
+    '3' -> [3], '0-9' -> [0, ..., 9], None -> every page
+    '''
+    if text is None:
+        return list(range(num_pages))
+    first, _, last = text.partition('-')
+    return list(range(int(first), min(int(last or first), num_pages - 1) + 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gallery of a dataset with a persistent thumbnail cache.')
+    parser.add_argument('image_folder')
+    parser.add_argument('labels_folder', help='label files in the 8 corner format of the converters')
+    parser.add_argument('output_folder', help='folder where the pages are written')
+    parser.add_argument('--cache', required=True, help='folder of the thumbnail cache')
+    parser.add_argument('--grid', default='4x4', help='COLUMNSxROWS thumbnails per page')
+    parser.add_argument('--cell-size', type=int, default=256)
+    parser.add_argument('--budget-mb', type=int, default=512, help='size of the cache above which thumbnails are evicted')
+    parser.add_argument('--pages', default=None, help='page or range of pages to write, e.g. 3 or 0-9')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--catalog', default=None, help='list the folders from this dataset catalog (dataset_catalog.py)')
+    args = parser.parse_args()
+
+    columns, rows = map(int, args.grid.lower().split('x'))
+    gallery = Gallery(args.image_folder, args.labels_folder, args.cache, columns, rows, args.cell_size, args.budget_mb << 20,
+                      args.catalog)
+    pages = parse_pages(args.pages, gallery.num_pages)
+    gallery.build(args.workers, pages)
+    gallery.save_pages(args.output_folder, pages)
+    print(f'{len(pages)} of {gallery.num_pages} pages written to {args.output_folder}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+# geometry of oriented boxes, shared by the converters, the cropping and the plotting scripts
+#
+# Every function works on a batch of N boxes at once. Corners are arrays of shape (N, 4, 2)
+# ordered clockwise in image coordinates (y going down), the first corner being the one the
+# box was defined from (top left before the rotation).
+# The computation is done in float64 and the result is returned as float32 by default, pass
+# dtype=np.float64 when the result is written to text and has to keep the same rounding.
+
+import numpy as np
+
+
+def _as_boxes(boxes, columns):
+    boxes = np.asarray(boxes, dtype=np.float64)
+    return boxes.reshape(-1, boxes.shape[-1] if boxes.size else columns)
+
+
+def xyxy_rotation_to_corners(boxes, dtype=np.float32):
+    '''
+    Rectangles given by their axis aligned corners and a rotation around their center
+    (Pascal VOC / CVAT export) to 4 corners.
+
+    Parameters:
+    - boxes (np.ndarray): (N, 5) xmin, ymin, xmax, ymax, rotation (degrees, clockwise)
+    - dtype: dtype of the result
+
+    Returns:
+    - np.ndarray: (N, 4, 2) corners (xmin,ymin), (xmax,ymin), (xmax,ymax), (xmin,ymax) after rotation
+    '''
+    boxes = _as_boxes(boxes, 5)
+    cx = (boxes[:, 0] + boxes[:, 2]) / 2
+    cy = (boxes[:, 1] + boxes[:, 3]) / 2
+    # corners relative to the center, (N, 4)
+    dx = np.stack([boxes[:, 0], boxes[:, 2], boxes[:, 2], boxes[:, 0]], axis=1) - cx[:, None]
+    dy = np.stack([boxes[:, 1], boxes[:, 1], boxes[:, 3], boxes[:, 3]], axis=1) - cy[:, None]
+    angle = np.deg2rad(boxes[:, 4])[:, None]
+    cos, sin = np.cos(angle), np.sin(angle)
+    return np.stack([dx * cos - dy * sin + cx[:, None], dx * sin + dy * cos + cy[:, None]], axis=2).astype(dtype)
+
+
+def corners_to_xyxy_rotation(corners, dtype=np.float32):
+    '''
+    Inverse of xyxy_rotation_to_corners.
+
+    Parameters:
+    - corners (np.ndarray): (N, 4, 2) or (N, 8) corners
+
+    Returns:
+    - np.ndarray: (N, 5) xmin, ymin, xmax, ymax, rotation (degrees in [0, 360))
+    '''
+    corners = np.asarray(corners, dtype=np.float64).reshape(-1, 4, 2)
+    center = corners.mean(axis=1)
+    width_side = corners[:, 1] - corners[:, 0]
+    height_side = corners[:, 3] - corners[:, 0]
+    width = np.hypot(width_side[:, 0], width_side[:, 1])
+    height = np.hypot(height_side[:, 0], height_side[:, 1])
+    rotation = np.degrees(np.arctan2(width_side[:, 1], width_side[:, 0])) % 360
+    return np.stack([center[:, 0] - width / 2, center[:, 1] - height / 2,
+                     center[:, 0] + width / 2, center[:, 1] + height / 2, rotation], axis=1).astype(dtype)
+
+
+def label_studio_to_corners(x, y, width, height, rotation, original_width, original_height, dtype=np.float32):
+    '''
+    Label-studio rectangles (top left corner and size in % of the image, rotation in degrees
+    clockwise around the top left corner) to corners in pixels.
+    pt1 is the top left corner, pt2 is obtained by moving along the width considering the rotation,
+    pt3 by moving along the height from pt2 and pt4 by moving along the height from pt1.
+
+    Parameters:
+    - x, y, width, height, rotation (np.ndarray): (N,) values of the label-studio results
+    - original_width, original_height (np.ndarray or float): image size in pixels
+
+    Returns:
+    - np.ndarray: (N, 4, 2) corners in pixels
+    '''
+    x_scale = np.asarray(original_width, dtype=np.float64) / 100
+    y_scale = np.asarray(original_height, dtype=np.float64) / 100
+    x0 = np.asarray(x, dtype=np.float64) * x_scale
+    y0 = np.asarray(y, dtype=np.float64) * y_scale
+    w = np.asarray(width, dtype=np.float64) * x_scale
+    h = np.asarray(height, dtype=np.float64) * y_scale
+    angle = np.radians(np.asarray(rotation, dtype=np.float64))
+    cos, sin = np.cos(angle), np.sin(angle)
+
+    xs = np.stack([x0, x0 + w * cos, x0 + w * cos - h * sin, x0 - h * sin], axis=-1)
+    ys = np.stack([y0, y0 + w * sin, y0 + w * sin + h * cos, y0 + h * cos], axis=-1)
+    return np.stack([xs, ys], axis=-1).reshape(-1, 4, 2).astype(dtype)
+
+
+def corners_to_label_studio(corners, original_width, original_height, dtype=np.float32):
+    '''
+    Inverse of label_studio_to_corners.
+
+    Returns:
+    - np.ndarray: (N, 5) x, y, width, height (in % of the image) and rotation (degrees in [0, 360))
+    '''
+    corners = np.asarray(corners, dtype=np.float64).reshape(-1, 4, 2)
+    width_side = corners[:, 1] - corners[:, 0]
+    height_side = corners[:, 3] - corners[:, 0]
+    x_scale = np.asarray(original_width, dtype=np.float64) / 100
+    y_scale = np.asarray(original_height, dtype=np.float64) / 100
+    return np.stack([corners[:, 0, 0] / x_scale, corners[:, 0, 1] / y_scale,
+                     np.hypot(width_side[:, 0], width_side[:, 1]) / x_scale,
+                     np.hypot(height_side[:, 0], height_side[:, 1]) / y_scale,
+                     np.degrees(np.arctan2(width_side[:, 1], width_side[:, 0])) % 360], axis=1).astype(dtype)
+
+
+def xywhr_to_corners(boxes, dtype=np.float32):
+    '''
+    Center, size and rotation (radians, the ultralytics OBB layout) to corners.
+
+    Parameters:
+    - boxes (np.ndarray): (N, >=5) cx, cy, w, h, r
+
+    Returns:
+    - np.ndarray: (N, 4, 2) corners
+    '''
+    boxes = _as_boxes(boxes, 5)
+    cx, cy, w, h, r = (boxes[:, i] for i in range(5))
+    cos, sin = np.cos(r), np.sin(r)
+    # half side vectors
+    wx, wy = w / 2 * cos, w / 2 * sin
+    hx, hy = -h / 2 * sin, h / 2 * cos
+    corners = np.stack([
+        np.stack([cx - wx - hx, cy - wy - hy], axis=1),
+        np.stack([cx + wx - hx, cy + wy - hy], axis=1),
+        np.stack([cx + wx + hx, cy + wy + hy], axis=1),
+        np.stack([cx - wx + hx, cy - wy + hy], axis=1),
+    ], axis=1)
+    return corners.astype(dtype)
+
+
+def corners_to_xywhr(corners, dtype=np.float32):
+    '''
+    Inverse of xywhr_to_corners.
+
+    Returns:
+    - np.ndarray: (N, 5) cx, cy, w, h, r (radians in [0, pi), w along the first side)
+    '''
+    corners = np.asarray(corners, dtype=np.float64).reshape(-1, 4, 2)
+    center = corners.mean(axis=1)
+    width_side = corners[:, 1] - corners[:, 0]
+    height_side = corners[:, 3] - corners[:, 0]
+    return np.stack([center[:, 0], center[:, 1],
+                     np.hypot(width_side[:, 0], width_side[:, 1]),
+                     np.hypot(height_side[:, 0], height_side[:, 1]),
+                     np.arctan2(width_side[:, 1], width_side[:, 0]) % np.pi], axis=1).astype(dtype)
+
+
+def normalize_corners(corners, width, height, dtype=np.float32):
+    '''
+    Pixels to [0, 1] coordinates.
+
+    Parameters:
+    - corners (np.ndarray): (N, 4, 2) corners in pixels
+    - width, height (np.ndarray or float): image size, per box (N,) or for all the boxes
+    '''
+    scale = np.stack(np.broadcast_arrays(np.asarray(width, dtype=np.float64), np.asarray(height, dtype=np.float64)), axis=-1)
+    return (np.asarray(corners, dtype=np.float64) / scale.reshape(-1, 1, 2)).astype(dtype)
+
+
+def denormalize_corners(corners, width, height, dtype=np.float32):
+    '''
+    [0, 1] coordinates to pixels, see normalize_corners.
+    '''
+    scale = np.stack(np.broadcast_arrays(np.asarray(width, dtype=np.float64), np.asarray(height, dtype=np.float64)), axis=-1)
+    return (np.asarray(corners, dtype=np.float64) * scale.reshape(-1, 1, 2)).astype(dtype)
+
+
+def polygon_area(polygons, counts=None):
+    '''
+    Area of polygons with the shoelace formula.
+
+    Parameters:
+    - polygons (np.ndarray): (N, K, 2) vertices in order, or a single polygon (K, 2)
+    - counts (np.ndarray): (N,) number of valid vertices of every polygon, defaults to K
+
+    Returns:
+    - np.ndarray: (N,) areas, a float for a single polygon
+    '''
+    polygons = np.asarray(polygons, dtype=np.float64)
+    single = polygons.ndim == 2
+    if single:
+        polygons = polygons[None]
+    n, k = polygons.shape[:2]
+    if k == 0:
+        areas = np.zeros(n)
+        return float(areas[0]) if single else areas
+    counts = np.full(n, k) if counts is None else np.asarray(counts)
+    index = np.arange(k)[None, :]
+    following = (index + 1) % np.maximum(counts, 1)[:, None]
+    x, y = polygons[..., 0], polygons[..., 1]
+    cross = x * np.take_along_axis(y, following, axis=1) - np.take_along_axis(x, following, axis=1) * y
+    areas = 0.5 * np.abs(np.where(index < counts[:, None], cross, 0).sum(axis=1))
+    areas[counts < 3] = 0
+    return float(areas[0]) if single else areas
+
+
+def clip_polygons_halfplane(polygons, counts, a, b, c):
+    '''
+    One step of Sutherland-Hodgman for N polygons at once: keep the part of every polygon
+    where a * x + b * y <= c.
+
+    Parameters:
+    - polygons (np.ndarray): (N, K, 2) vertices
+    - counts (np.ndarray): (N,) number of valid vertices
+    - a, b, c (np.ndarray or float): half plane of every polygon, (N,) or scalars
+
+    Returns:
+    - polygons (np.ndarray): (N, M, 2) clipped vertices, only the first counts[i] are valid
+    - counts (np.ndarray): (N,) number of vertices after clipping
+    '''
+    n, k = polygons.shape[:2]
+    if n == 0 or k == 0:
+        return polygons, counts
+    a, b, c = (np.broadcast_to(np.asarray(value, dtype=np.float64), (n,))[:, None] for value in (a, b, c))
+    index = np.arange(k)[None, :]
+    valid = index < counts[:, None]
+    previous = np.take_along_axis(polygons, ((index - 1) % np.maximum(counts, 1)[:, None])[..., None], axis=1)
+
+    distance = a * polygons[..., 0] + b * polygons[..., 1] - c
+    previous_distance = a * previous[..., 0] + b * previous[..., 1] - c
+    inside = (distance <= 0) & valid
+    crossing = ((distance <= 0) != (previous_distance <= 0)) & valid
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(crossing, previous_distance / (previous_distance - distance), 0)
+    intersection = previous + t[..., None] * (polygons - previous)
+
+    # every vertex outputs [intersection if the edge crosses, vertex if inside], then compact
+    candidates = np.stack([intersection, polygons], axis=2).reshape(n, 2 * k, 2)
+    keep = np.stack([crossing, inside], axis=2).reshape(n, 2 * k)
+    order = np.argsort(~keep, axis=1, kind='stable')
+    counts = keep.sum(axis=1)
+    width = max(int(counts.max()), 1)
+    return np.take_along_axis(candidates, order[:, :width, None], axis=1), counts
+
+
+def clip_polygons_to_rect(polygons, xmin, ymin, xmax, ymax, counts=None):
+    '''
+    Clip N polygons to axis aligned rectangles (one rectangle for all or one per polygon).
+
+    Parameters:
+    - polygons (np.ndarray): (N, K, 2) vertices in order
+    - xmin, ymin, xmax, ymax (np.ndarray or float): the rectangles
+    - counts (np.ndarray): (N,) number of valid vertices, defaults to K
+
+    Returns:
+    - polygons (np.ndarray): (N, M, 2) clipped vertices
+    - counts (np.ndarray): (N,) number of valid vertices, 0 when a polygon is outside its rectangle
+    '''
+    polygons = np.asarray(polygons, dtype=np.float64)
+    counts = np.full(len(polygons), polygons.shape[1]) if counts is None else np.asarray(counts)
+    for a, b, c in ((-1, 0, -np.asarray(xmin, dtype=np.float64)), (1, 0, xmax),
+                    (0, -1, -np.asarray(ymin, dtype=np.float64)), (0, 1, ymax)):
+        polygons, counts = clip_polygons_halfplane(polygons, counts, a, b, c)
+    return polygons, counts
+
+
+def min_area_rectangle(polygons, counts=None, dtype=np.float32):
+    '''
+    Minimum area rectangle of N convex polygons (e.g. boxes clipped by clip_polygons_to_rect).
+    One side of the rectangle is on an edge of the polygon, every edge is tried.
+
+    Parameters:
+    - polygons (np.ndarray): (N, K, 2) vertices in order
+    - counts (np.ndarray): (N,) number of valid vertices, defaults to K
+    - dtype: dtype of the result
+
+    Returns:
+    - np.ndarray: (N, 4, 2) corners, clockwise, the first side rotated by less than 45 degrees from the x axis
+    '''
+    polygons = np.asarray(polygons, dtype=np.float64)
+    n, k = polygons.shape[:2]
+    if n == 0 or k == 0:
+        return np.zeros((n, 4, 2), dtype=dtype)
+    counts = np.full(n, k) if counts is None else np.asarray(counts)
+    index = np.arange(k)[None, :]
+    valid = index < counts[:, None]
+    # the padding vertices are replaced by the first vertex, they do not change the extent
+    polygons = np.where(valid[..., None], polygons, polygons[:, :1])
+    following = np.take_along_axis(polygons, ((index + 1) % np.maximum(counts, 1)[:, None])[..., None], axis=1)
+    edges = following - polygons
+    # direction of every edge folded into [-45, 45) degrees, the 4 sides of a rectangle give the same one
+    angle = (np.arctan2(edges[..., 1], edges[..., 0]) + np.pi / 4) % (np.pi / 2) - np.pi / 4
+    u = np.stack([np.cos(angle), np.sin(angle)], axis=-1)
+    v = np.stack([-u[..., 1], u[..., 0]], axis=-1)
+
+    # (N, edges, vertices) projections of every vertex on the axes of every edge
+    along_u = np.einsum('nek,nvk->nev', u, polygons)
+    along_v = np.einsum('nek,nvk->nev', v, polygons)
+    low_u, high_u = along_u.min(axis=2), along_u.max(axis=2)
+    low_v, high_v = along_v.min(axis=2), along_v.max(axis=2)
+    area = np.where(valid, (high_u - low_u) * (high_v - low_v), np.inf)
+    best = np.argmin(area, axis=1)[:, None]
+
+    def pick(values):
+        return np.take_along_axis(values, best, axis=1)[:, 0]
+
+    u, v = np.take_along_axis(u, best[..., None], axis=1)[:, 0], np.take_along_axis(v, best[..., None], axis=1)[:, 0]
+    low_u, high_u, low_v, high_v = pick(low_u), pick(high_u), pick(low_v), pick(high_v)
+    corners = [u * along[:, None] + v * across[:, None]
+               for along, across in ((low_u, low_v), (high_u, low_v), (high_u, high_v), (low_u, high_v))]
+    return np.stack(corners, axis=1).astype(dtype)
+
+
+def clip_polygons_to_convex(polygons, convex, counts=None):
+    '''
+    Clip N polygons to N convex quadrilaterals (e.g. oriented boxes), one Sutherland-Hodgman
+    step per edge of the quadrilaterals.
+
+    Parameters:
+    - polygons (np.ndarray): (N, K, 2) vertices in order
+    - convex (np.ndarray): (N, 4, 2) corners of the convex polygons, clockwise or counter clockwise
+    - counts (np.ndarray): (N,) number of valid vertices of polygons, defaults to K
+
+    Returns:
+    - polygons (np.ndarray): (N, M, 2) clipped vertices
+    - counts (np.ndarray): (N,) number of valid vertices, 0 when they do not intersect
+    '''
+    polygons = np.asarray(polygons, dtype=np.float64)
+    convex = np.asarray(convex, dtype=np.float64)
+    counts = np.full(len(polygons), polygons.shape[1]) if counts is None else np.asarray(counts)
+    following = np.roll(convex, -1, axis=1)
+    # orientation from the signed area, the inside of an edge is on its left for counter clockwise polygons
+    orientation = np.sign((convex[..., 0] * following[..., 1] - following[..., 0] * convex[..., 1]).sum(axis=1))
+    orientation[orientation == 0] = 1
+    for i in range(convex.shape[1]):
+        x0, y0 = convex[:, i, 0], convex[:, i, 1]
+        dx, dy = following[:, i, 0] - x0, following[:, i, 1] - y0
+        polygons, counts = clip_polygons_halfplane(polygons, counts, orientation * dy, -orientation * dx,
+                                                   orientation * (dy * x0 - dx * y0))
+    return polygons, counts
+
+
+def obb_iou(corners1, corners2):
+    '''
+    Exact pairwise IoU of two sets of oriented boxes given by their corners.
+
+    Parameters:
+    - corners1 (np.ndarray): (N, 4, 2)
+    - corners2 (np.ndarray): (M, 4, 2)
+
+    Returns:
+    - np.ndarray: (N, M) IoU
+    '''
+    corners1 = np.asarray(corners1, dtype=np.float64).reshape(-1, 4, 2)
+    corners2 = np.asarray(corners2, dtype=np.float64).reshape(-1, 4, 2)
+    n, m = len(corners1), len(corners2)
+    if n == 0 or m == 0:
+        return np.zeros((n, m))
+    polygons, counts = clip_polygons_to_convex(np.repeat(corners1, m, axis=0), np.tile(corners2, (n, 1, 1)))
+    intersection = polygon_area(polygons, counts).reshape(n, m)
+    union = polygon_area(corners1)[:, None] + polygon_area(corners2)[None, :] - intersection
+    return np.where(union > 0, intersection / np.where(union > 0, union, 1), 0.0)
@@ -1,12 +1,31 @@
 import json 
 import pandas as pd
+import numpy as np
 from pathlib import Path
 import os
 import math
-from miscellaneous import save_to_txt_file, path_valid
-
-
-def convert_json_to_obb_format(json_path, destination_path, image_size=(256,256)):
+from itertools import islice
+from contextlib import nullcontext
+from miscellaneous import save_to_txt_file, path_valid, format_lines, group_by_file
+from geometry import label_studio_to_corners
+from conversion_manifest import load_manifest, save_manifest, remove_stale_labels
+from annotation_store import AnnotationSet, write_obb_txt_folder
+from label_writer import LabelArchiveWriter
+
+# one row per rectangle of the export, all the boxes of an export are kept in a single array
+LABEL_STUDIO_BOX_DTYPE = np.dtype([
+    ('file_index', np.int64),   # index in the list of file names
+    ('x', np.float64),          # top left corner in % of the image width
+    ('y', np.float64),          # top left corner in % of the image height
+    ('width', np.float64),      # in % of the image width
+    ('height', np.float64),     # in % of the image height
+    ('rotation', np.float64),   # degrees, clockwise around the top left corner
+    ('original_width', np.float64),
+    ('original_height', np.float64),
+])
+
+
+def convert_json_to_obb_format(json_path, destination_path, image_size=(256,256), tasks_per_chunk=1000, archive_path=None):
     '''
     function that converts the dataframe to yolo_obb format
 
@@ -14,6 +33,8 @@ def convert_json_to_obb_format(json_path, destination_path, image_size=(256,256)
     - json_path (str): path to the label-studio json file
     - destination_path (str) : path to the destination directory
     - image_size (tuple) : image size eg. 256*256 (image_height, image_width)
+    - tasks_per_chunk (int): number of tasks of the export converted at a time
+    - archive_path (str): if given the labels are packed in this zip archive instead of loose files in destination_path
     
     TODO: check the class label also and then put that class label in the files
 
@@ -36,73 +57,298 @@ def convert_json_to_obb_format(json_path, destination_path, image_size=(256,256)
         return False
 
     # Check if the destination_path is a directory
-    if not destination_path_obj.is_dir():
+    if archive_path is None and not destination_path_obj.is_dir():
         print(f"The path '{destination_path}' is not a directory.")
         return False
     
-    df = get_bboxes_from_label_studio_json(json_path)
-
-    print(df)
-
-    # convert the b_boxes into yolo_obb format
-    for _, row in df.iterrows():
-        file_name = row['file_name']
-        # file_name needs to be be .txt not .jpg
-        split_file_name = file_name.split('.')
-        file_name = split_file_name[0]
-
-        print(file_name)
-
-        b_boxes = row['b_boxes']
-        # Get original image dimensions
-        img_height, img_width = image_size
-
-        # Scale factors
-        x_scale = img_width / 100
-        y_scale = img_height / 100
-
-        lines_to_write = []
-        for bbox in b_boxes:
-            x0 = bbox['x'] * x_scale
-            y0 = bbox['y'] * y_scale
-            width = bbox['width'] * x_scale
-            height = bbox['height'] * y_scale
-            angle = bbox['rotation']
-
-            # Calculate rotated points: clockwise direction
-            '''
-            ptl is the initial point.
-            pt2 is obtained by moving horizontally from ptl considering the rotation.
-            pt3 is obtained by moving vertically from pt2 considering the rotation.
-            pt4 is obtained by moving vertically from ptl considering the rotation.
-            '''
-            pt1 = (round(x0, 3), round(y0, 3))
-            pt2 = (round(x0 + width * math.cos(math.radians(angle)), 3), round(y0 + width * math.sin(math.radians(angle))))
-            pt3 = (round(x0 + width * math.cos(math.radians(angle)) - height * math.sin(math.radians(angle)), 3), round(y0 + width * math.sin(math.radians(angle)) + height * math.cos(math.radians(angle)), 3))
-            pt4 = (round(x0 - height * math.sin(math.radians(angle)), 3), round(y0 + height * math.cos(math.radians(angle)), 3))
-
-            # TODO: convert the class-labels which is in b_boxes['rectanglelabels'] = ['class1', 'class2', 'class3']
-            class_label = bbox['rectanglelabels'][0]
-
-            # TODO: way to get the difficuulty of finding the class-label
-            difficulty = 0 # default 
-            
-            x1,y1 = pt1
-            x2,y2 = pt2
-            x3,y3 = pt3
-            x4,y4 = pt4
-
-            # save the files in the yolo_obb format (x1,y1,x2,y2,x3,y3,x4,y4)
-            coordinates = (x1,y1,x2,y2,x3,y3,x4,y4)
-            # print(coordinates)
-            new_file_path = destination_path_obj.joinpath(file_name)
-            # line = str(class_label) + ',' + ','.join(map(str, coordinates))
-            line = ','.join(map(str, coordinates)) + ',' + str(class_label) + ',' + str(difficulty)
-            
-            lines_to_write.append(line)
-        save_to_txt_file(lines_to_write=lines_to_write, destination_path=new_file_path)
+    # the export is read a chunk of tasks at a time so the memory does not grow with its size
+    total_files, total_boxes = 0, 0
+    # the archive only replaces a previous one once the whole export is converted
+    with LabelArchiveWriter(archive_path) if archive_path is not None else nullcontext() as archive:
+        for tasks in iter_task_chunks(json_path, tasks_per_chunk):
+            written, box_count = write_obb_labels_of_tasks(tasks, destination_path_obj, image_size, archive)
+            total_files += len(written)
+            total_boxes += box_count
+    print(f'{total_files} files, {total_boxes} boxes')
+    return True
+
+
+def write_obb_labels_of_tasks(tasks, destination_path_obj, image_size=(256,256), archive=None):
+    '''
+    Convert a list of tasks and write their label files in the yolo_obb format
+    (x1,y1,x2,y2,x3,y3,x4,y4,class_label,difficulty) through an AnnotationSet.
+
+    Parameters:
+    - tasks (list): tasks of the label-studio export
+    - destination_path_obj (Path): destination directory
+    - image_size (tuple): (image_height, image_width) used when a result has no original size
+    - archive (LabelArchiveWriter): if given the labels are added to this archive instead of destination_path_obj
+
+    Returns:
+    - written (dict): 'file_upload' -> name of the label file, for the tasks having boxes
+    - box_count (int): number of boxes written
+    '''
+    annotations = tasks_to_annotation_set(tasks, image_size)
+    written = write_obb_txt_folder(annotations, destination_path_obj, write_empty=False, archive=archive)
+    return written, annotations.num_boxes
+
+
+def tasks_to_annotation_set(tasks, image_size=(256,256)):
+    '''
+    Convert a list of label-studio tasks to an AnnotationSet (corners in pixels), tasks without boxes are skipped.
+
+    Parameters:
+    - tasks (list): tasks of the label-studio export
+    - image_size (tuple): (image_height, image_width) used when a result has no original size
+
+    Returns:
+    - AnnotationSet
+    '''
+    file_names, boxes, class_labels = flatten_label_studio_results(tasks, image_size)
+    # rounded in float64 so that the corners written back from float32 keep the same 3 decimals
+    corners = np.round(label_studio_boxes_to_corners(boxes), 3)
+
+    # size of every image from its first box
+    first_box = np.searchsorted(boxes['file_index'], np.arange(len(file_names)))
+    widths = boxes['original_width'][first_box] if len(boxes) else np.zeros(0)
+    heights = boxes['original_height'][first_box] if len(boxes) else np.zeros(0)
+
+    # TODO: way to get the difficuulty of finding the class-label
+    return AnnotationSet.from_boxes(file_names, corners, class_labels, boxes['file_index'], widths=widths, heights=heights)
+
+
+def load_label_studio_annotations(json_path, image_size=(256,256), tasks_per_chunk=1000):
+    '''
+    Load a label-studio export (streamed task by task) into an AnnotationSet.
+
+    Parameters:
+    - json_path (str): path to the label-studio json file
+    - image_size (tuple): (image_height, image_width) used when a result has no original size
+    - tasks_per_chunk (int): number of tasks converted at a time
+
+    Returns:
+    - AnnotationSet
+    '''
+    return AnnotationSet.concatenate(tasks_to_annotation_set(tasks, image_size) for tasks in iter_task_chunks(json_path, tasks_per_chunk))
+
+
+def task_signature(task):
+    '''
+    What identifies a version of a task: its updated_at and the id and updated_at of its annotations.
+    '''
+    return {
+        'updated_at': task.get('updated_at'),
+        'annotations': [[annotation.get('id'), annotation.get('updated_at')] for annotation in task.get('annotations') or []],
+    }
+
+
+def convert_json_to_obb_format_incremental(json_path, destination_path, manifest_path=None, image_size=(256,256), tasks_per_chunk=1000):
+    '''
+    Same as convert_json_to_obb_format but only the tasks that changed since the previous run are converted.
+    A manifest of the converted tasks (see conversion_manifest.py) is kept in the destination directory,
+    the labels of the tasks that are not in the export anymore, or that lost all their boxes, are deleted.
+
+    Parameters:
+    - json_path (str): path to the label-studio json file
+    - destination_path (str) : path to the destination directory
+    - manifest_path (str): path of the manifest, defaults to <destination_path>/.label_studio_manifest.json
+    - image_size (tuple) : (image_height, image_width) used when a result has no original size
+    - tasks_per_chunk (int): number of changed tasks converted at a time
+
+    Returns: 
+    True (bool): if successful
+    False (bool): if unsuccessful
+    '''
+    if not path_valid(json_path) or not path_valid(destination_path):
+        print(f'The path for json_path or destination_path is invalid.')
+        return False
+    destination_path_obj = Path(destination_path)
+    if manifest_path is None:
+        manifest_path = destination_path_obj / '.label_studio_manifest.json'
+    entries = load_manifest(manifest_path)
+
+    def convert(tasks):
+        written, _ = write_obb_labels_of_tasks(tasks, destination_path_obj, image_size)
+        for task in tasks:
+            key = str(task['id'])
+            label = written.get(task.get('file_upload'))
+            previous_label = entries.get(key, {}).get('label')
+            if previous_label and previous_label != label:
+                try:
+                    os.remove(destination_path_obj / previous_label)
+                except FileNotFoundError:
+                    pass
+            entries[key] = {'signature': task_signature(task), 'label': label}
+
+    seen = set()
+    pending = []
+    converted = 0
+    for task in iter_label_studio_tasks(json_path):
+        key = str(task['id'])
+        seen.add(key)
+        entry = entries.get(key)
+        if entry is not None and entry['signature'] == task_signature(task):
+            continue
+        pending.append(task)
+        converted += 1
+        if len(pending) == tasks_per_chunk:
+            convert(pending)
+            pending = []
+    convert(pending)
+
+    removed = remove_stale_labels(entries, seen, destination_path_obj)
+    save_manifest(manifest_path, entries)
+    print(f'{len(seen)} tasks: {converted} converted, {len(seen) - converted} unchanged, {len(removed)} labels removed')
     return True
 
+
+def iter_label_studio_tasks(json_path, chunk_size=1 << 20, max_task_chunks=16):
+    '''
+    Read the tasks of a label-studio json export one by one.
+    Only the task being decoded is kept in memory, not the whole export.
+
+    Parameters:
+    - json_path (str): path to the label-studio json file
+    - chunk_size (int): number of characters read from the file at a time
+    - max_task_chunks (int): number of chunks read for a single task before it is considered malformed,
+      so that an invalid task does not pull the rest of the file into memory
+
+    Yields:
+    - task (dict): a task of the export
+
+    Raises:
+    - ValueError: if the file is not a list of tasks or a task is malformed, with the byte offset of the task
+    '''
+    decoder = json.JSONDecoder()
+    # newline='' keeps the \r of the file so that the byte offsets of the errors are exact
+    with open(json_path, 'r', encoding='utf-8', newline='') as file:
+        buffer = ''
+        position = 0
+        # byte offset in the file of buffer[0]
+        buffer_offset = 0
+        end_of_file = False
+        started = False
+        # chunks read since the last task was decoded
+        chunks_read = 0
+        while True:
+            # skip the separators between two tasks
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer):
+                if not started:
+                    if buffer[position] != '[':
+                        raise ValueError(f"The file '{json_path}' is not a list of tasks.")
+                    started = True
+                    position += 1
+                    continue
+                if buffer[position] == ']':
+                    return
+                try:
+                    task, position = decoder.raw_decode(buffer, position)
+                    chunks_read = 0
+                    yield task
+                    continue
+                except json.JSONDecodeError as e:
+                    if end_of_file or chunks_read >= max_task_chunks:
+                        offset = buffer_offset + len(buffer[:position].encode('utf-8'))
+                        raise ValueError(f"The file '{json_path}' has a malformed task at byte {offset}: {e.msg}") from e
+            elif end_of_file:
+                if started:
+                    raise ValueError(f"The file '{json_path}' ended before the list of tasks.")
+                return
+            # the task is not complete, drop what was already decoded and read more
+            buffer_offset += len(buffer[:position].encode('utf-8'))
+            buffer = buffer[position:]
+            position = 0
+            chunk = file.read(chunk_size)
+            end_of_file = chunk == ''
+            buffer += chunk
+            chunks_read += 1
+
+
+def iter_task_chunks(json_path, tasks_per_chunk=1000):
+    '''
+    Group the tasks of iter_label_studio_tasks in lists of tasks_per_chunk tasks.
+    '''
+    tasks = iter_label_studio_tasks(json_path)
+    while True:
+        chunk = list(islice(tasks, tasks_per_chunk))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_bboxes_from_label_studio_json(json_path):
+    '''
+    Streaming version of get_bboxes_from_label_studio_json, the export is read task by task.
+
+    Parameters:
+    - json_path (str): path to the label-studio json file
+
+    Yields:
+    - (file_name, b_boxes) (tuple): 'file_upload' of the task and the 'value' of every box
+      (x,y,width,height,rotation,rectanglelabels) of its last annotation, tasks without boxes are skipped
+    '''
+    for task in iter_label_studio_tasks(json_path):
+        annotations = task.get('annotations') or []
+        if not annotations:
+            continue
+        b_boxes = [result['value'] for result in annotations[-1]['result']]
+        if b_boxes:
+            yield task['file_upload'], b_boxes
+
+
+def flatten_label_studio_results(tasks, image_size=(256,256)):
+    '''
+    Flatten the rectangles of all the tasks of a label-studio export into one structured array.
+    The boxes of the last annotation of every task are used, tasks without boxes are skipped.
+
+    Parameters:
+    - tasks (iterable): tasks of the label-studio json export
+    - image_size (tuple): (image_height, image_width) used when a result has no original_width/original_height
+
+    Returns:
+    - file_names (list): 'file_upload' of the tasks having boxes
+    - boxes (np.ndarray): structured array of dtype LABEL_STUDIO_BOX_DTYPE, grouped by file
+    - class_labels (list): first 'rectanglelabels' of every box
+    '''
+    default_height, default_width = image_size
+    file_names = []
+    rows = []
+    class_labels = []
+    for task in tasks:
+        annotations = task.get('annotations') or []
+        if not annotations:
+            continue
+        results = [result for result in annotations[-1]['result'] if 'x' in result.get('value', {})]
+        if not results:
+            continue
+        file_index = len(file_names)
+        file_names.append(task['file_upload'])
+        for result in results:
+            value = result['value']
+            rows.append((file_index, value['x'], value['y'], value['width'], value['height'], value.get('rotation', 0),
+                         result.get('original_width', default_width), result.get('original_height', default_height)))
+            labels = value.get('rectanglelabels') or ['']
+            class_labels.append(labels[0])
+    return file_names, np.array(rows, dtype=LABEL_STUDIO_BOX_DTYPE), class_labels
+
+
+def label_studio_boxes_to_corners(boxes):
+    '''
+    Corners of all the label-studio rectangles at once, in pixels (see geometry.label_studio_to_corners).
+
+    Parameters:
+    - boxes (np.ndarray): structured array of dtype LABEL_STUDIO_BOX_DTYPE
+
+    Returns:
+    - np.ndarray: (N, 4, 2) corners
+    '''
+    # float64 so that the rounding of the written coordinates does not change
+    return label_studio_to_corners(boxes['x'], boxes['y'], boxes['width'], boxes['height'], boxes['rotation'],
+                                   boxes['original_width'], boxes['original_height'], dtype=np.float64)
+
+
 def get_bboxes_from_label_studio_json(json_path):    
     '''
     Function to convert label-studio-json-to-yolo-obb
@@ -182,7 +428,7 @@ def get_bboxes_from_label_studio_json(json_path):
     return df
 
 
-def convert_json_to_yolo_with_roataion(json_path, destination_path, image_size):
+def convert_json_to_yolo_with_roataion(json_path, destination_path, image_size, tasks_per_chunk=1000):
     '''
     function that converts the dataframe to yolo_obb format
 
@@ -190,6 +436,7 @@ def convert_json_to_yolo_with_roataion(json_path, destination_path, image_size):
     - json_path (str): path to the label-studio json file
     - destination_path (str) : path to the destination directory
     - image_size (tuple) : image size eg. 256*256 (image_height, image_width)
+    - tasks_per_chunk (int): number of tasks of the export converted at a time
     
     TODO: check the class label also and then put that class label in the files
     '''
@@ -212,51 +459,22 @@ def convert_json_to_yolo_with_roataion(json_path, destination_path, image_size):
         print(f"The path '{destination_path}' is not a directory.")
         return False
     
-    df = get_bboxes_from_label_studio_json(json_path)
-
-    # print(df)
-
-    # convert the b_boxes into yolo_obb format
-    for _, row in df.iterrows():
-        file_name = row['file_name']
-        # file_name needs to be be .txt not .jpg
-        split_file_name = file_name.split('.')
-        file_name = split_file_name[0]
-
-        print(f'filename: {file_name}')
-
-        b_boxes = row['b_boxes']
-        # Get original image dimensions
-        img_height, img_width = image_size
-
-        # Scale factors
-        x_scale = img_width / 100
-        y_scale = img_height / 100
-
-        lines_to_write = []
-        for bbox in b_boxes:
-            x0 = bbox['x'] * x_scale
-            y0 = bbox['y'] * y_scale
-            width = bbox['width'] * x_scale
-            height = bbox['height'] * y_scale
-            angle = bbox['rotation']
-
-            # TODO: convert the class-labels which is in b_boxes['rectangables'] = ['class1', 'class2', 'class3']
-            class_label = 0
-            # normalize the points. 
-            x0, y0 = round(x0/img_width,3), round(y0/img_height,3)
-            width, height = round(width/img_width,3), round(height/img_height,3)
-
-            # TODO: check if we need to normalize the angle as well. 
-
-            # save the files in the yolo_obb format (x1,y1,x2,y2,x3,y3,x4,y4)
-            coordinates = (x0,y0,width,height,angle)
-            print(coordinates)
+    # TODO: convert the class-labels which is in b_boxes['rectangables'] = ['class1', 'class2', 'class3']
+    class_label = 0
+
+    for tasks in iter_task_chunks(json_path, tasks_per_chunk):
+        file_names, boxes, _ = flatten_label_studio_results(tasks, image_size)
+
+        # normalize the points, the label-studio values are already in % of the image. 
+        # TODO: check if we need to normalize the angle as well. 
+        coordinates = np.round(np.stack([boxes['x'], boxes['y'], boxes['width'], boxes['height']], axis=1) / 100, 3)
+        lines = np.char.add(f'{class_label},', format_lines(coordinates, [boxes['rotation']]))
+        for file_index, start, end in group_by_file(boxes['file_index']):
+            # file_name needs to be be .txt not .jpg
+            file_name = file_names[file_index].split('.')[0]
+            print(f'filename: {file_name}')
             new_file_path = destination_path_obj.joinpath(file_name)
-            line = str(class_label) + ',' + ','.join(map(str, coordinates))
-            
-            lines_to_write.append(line)
-        save_to_txt_file(lines_to_write=lines_to_write, destination_path=new_file_path)
+            save_to_txt_file(lines_to_write=lines[start:end], destination_path=new_file_path)
 
 def main():
     # TODO: use parser to make it take cmd args. 
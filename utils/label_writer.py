@@ -0,0 +1,173 @@
+# bulk writer for label files
+#
+# Every label file is written in one call to a temporary file in the same folder and then
+# renamed over the final name, so an interrupted conversion never leaves a half written label.
+# The files are written from a pool of threads, which hides the latency of network filesystems.
+# Instead of loose files the labels can also be packed in one zip archive (written atomically too).
+
+import os
+import zipfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+
+@contextmanager
+def atomic_path(path):
+    '''
+    Temporary path in the folder of path, renamed over path if the block succeeds and removed if it raises.
+
+    Example:
+    >>> with atomic_path('models/best.onnx') as temp_path:
+    >>>     shutil.copyfile(model_path, temp_path)
+
+    Parameters:
+    - path (str): destination file
+    '''
+    path = str(path)
+    # unique per thread, two threads never share a temporary file
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_text_atomic(path, text):
+    '''
+    Write text to path through a temporary file and os.replace.
+
+    Parameters:
+    - path (str): destination file
+    - text (str): whole content of the file
+    '''
+    with atomic_path(path) as temp_path:
+        with open(temp_path, 'w') as file:
+            file.write(text)
+
+
+def lines_to_text(lines):
+    '''
+    Content of a label file from its lines, every line ends with a newline.
+    '''
+    return ''.join(line + '\n' for line in lines)
+
+
+def split_duplicate_names(items):
+    '''
+    Keep the first item of every file name, two items of the same name would overwrite each other.
+
+    Parameters:
+    - items (iterable): (file name, ...) tuples
+
+    Returns:
+    - unique (list): the items whose file name was not seen before
+    - duplicates (list): the other items
+    '''
+    unique, duplicates = [], []
+    seen = set()
+    for item in items:
+        (duplicates if item[0] in seen else unique).append(item)
+        seen.add(item[0])
+    return unique, duplicates
+
+
+def write_label_files(items, destination_folder, num_workers=8):
+    '''
+    Write many label files atomically from a pool of threads. An item whose file name was already
+    given by an earlier item is not written and reported as failed.
+
+    Parameters:
+    - items (iterable): (file name, text) of every label file
+    - destination_folder (str): folder of the label files
+    - num_workers (int): number of threads
+
+    Returns:
+    - written (int): number of files written
+    - failed (list): (file name, error) of the files that could not be written
+    '''
+    os.makedirs(destination_folder, exist_ok=True)
+
+    def write(item):
+        file_name, text = item
+        try:
+            write_text_atomic(os.path.join(destination_folder, file_name), text)
+            return None
+        except Exception as e:
+            return file_name, str(e)
+
+    items, duplicates = split_duplicate_names(items)
+    if num_workers <= 1 or len(items) <= 1:
+        results = [write(item) for item in items]
+    else:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(write, items))
+    failed = [result for result in results if result is not None]
+    failed += [(file_name, 'an earlier item has the same file name') for file_name, _ in duplicates]
+    for file_name, error in failed:
+        print(f"Error writing {file_name}: {error}")
+    return len(items) + len(duplicates) - len(failed), failed
+
+
+class LabelArchiveWriter:
+    '''
+    Pack label files in a single zip archive. The archive is built under a temporary name and
+    only renamed to archive_path by close(), an interrupted run leaves the previous archive untouched.
+
+    Example:
+    >>> with LabelArchiveWriter('dataset/labels.zip') as archive:
+    >>>     archive.add('DJI_20240518124257_0028_V282.txt', text)
+    '''
+
+    def __init__(self, archive_path):
+        self.archive_path = str(archive_path)
+        directory = os.path.dirname(os.path.abspath(self.archive_path))
+        os.makedirs(directory, exist_ok=True)
+        self._temp_path = f'{self.archive_path}.{os.getpid()}.tmp'
+        self._archive = zipfile.ZipFile(self._temp_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+        self.count = 0
+
+    def add(self, file_name, text):
+        self._archive.writestr(file_name, text)
+        self.count += 1
+
+    def add_many(self, items):
+        for file_name, text in items:
+            self.add(file_name, text)
+
+    def close(self):
+        if self._archive is None:
+            return
+        self._archive.close()
+        self._archive = None
+        os.replace(self._temp_path, self.archive_path)
+
+    def abort(self):
+        if self._archive is None:
+            return
+        self._archive.close()
+        self._archive = None
+        os.remove(self._temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_label_archive(archive_path):
+    '''
+    Returns:
+    - dict: file name -> text of every label of the archive
+    '''
+    with zipfile.ZipFile(archive_path, 'r') as archive:
+        return {name: archive.read(name).decode() for name in archive.namelist()}
@@ -1,14 +1,17 @@
 from pathlib import Path
 import os
 import numpy as np
+from functools import reduce
+from label_writer import write_text_atomic, lines_to_text
 
-def save_to_txt_file(lines_to_write, destination_path):
+def save_to_txt_file(lines_to_write, destination_path, verbose=True):
     '''
     function to save line to a text file
 
     Parameters: 
     - lines_to_write (str): list of str(lines)
     - destination_path (str): destination path of the text file to be saved
+    - verbose (bool): print a line once the file is saved
 
     Returns: 
     - True (boolean): if saved sucessfully
@@ -21,10 +24,10 @@ def save_to_txt_file(lines_to_write, destination_path):
         destination_path_obj = destination_path_obj.with_suffix('.txt')
     
     try:
-        with open(destination_path_obj, 'w') as file:
-            for line in lines_to_write:
-                file.write(line + '\n')
-        print(f"Sucessfully saved the lines to the file: {destination_path_obj.name}")
+        # one write to a temporary file renamed over the destination, never a half written label
+        write_text_atomic(destination_path_obj, lines_to_text(lines_to_write))
+        if verbose:
+            print(f"Sucessfully saved the lines to the file: {destination_path_obj.name}")
         return True
     except Exception as e:
         print(f"Error writing to file: {e}")
@@ -90,4 +93,65 @@ def rotate_point(x, y, angle):
     sin_theta = np.sin(angle_rad)
     new_x = x * cos_theta - y * sin_theta
     new_y = x * sin_theta + y * cos_theta
-    return new_x, new_y
\ No newline at end of file
+    return new_x, new_y
+
+
+def read_obb_label_file(label_path):
+    '''
+    Read a label file written by the converters in the 8 corner format
+    x1,y1,x2,y2,x3,y3,x4,y4,class_label,difficulty (pixel coordinates)
+
+    Parameters:
+    - label_path (str): path of the .txt label file
+
+    Returns:
+    - corners (np.ndarray): float array of shape (N, 4, 2)
+    - class_labels (list): class label of every box
+    - difficulties (list): difficulty (int) of every box
+    '''
+    corners = []
+    class_labels = []
+    difficulties = []
+    with open(label_path, 'r') as file:
+        for line in file:
+            data = line.strip().split(',')
+            if len(data) != 10:
+                continue
+            corners.append(list(map(float, data[:8])))
+            class_labels.append(data[8])
+            difficulties.append(int(data[9]))
+    corners = np.array(corners, dtype=np.float64).reshape(-1, 4, 2)
+    return corners, class_labels, difficulties
+
+
+def format_lines(coordinates, extra_columns=()):
+    '''
+    Format rows of numbers as comma separated lines in one vectorized pass.
+
+    Parameters:
+    - coordinates (np.ndarray): (N, K) numbers, written like str(float)
+    - extra_columns (list): arrays of N values appended after the coordinates
+
+    Returns:
+    - np.ndarray: N lines (str)
+    '''
+    columns = [coordinates[:, i].astype(str) for i in range(coordinates.shape[1])]
+    columns += [np.asarray(column).astype(str) for column in extra_columns]
+    if not columns or len(columns[0]) == 0:
+        return np.zeros(0, dtype=str)
+    return reduce(lambda line, column: np.char.add(np.char.add(line, ','), column), columns[1:], columns[0])
+
+
+def group_by_file(file_indices):
+    '''
+    Parameters:
+    - file_indices (np.ndarray): file index of every box, boxes of a file are contiguous
+
+    Returns:
+    - list: (file_index, start, end) of every file, its boxes are [start:end]
+    '''
+    if len(file_indices) == 0:
+        return []
+    starts = np.flatnonzero(np.r_[True, file_indices[1:] != file_indices[:-1]])
+    ends = np.r_[starts[1:], len(file_indices)]
+    return list(zip(file_indices[starts].tolist(), starts.tolist(), ends.tolist()))
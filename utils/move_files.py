@@ -1,49 +1,169 @@
 import os
 import shutil
+import errno
 from pathlib import Path
-from miscellaneous import get_filenames_of_extention
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from dataset_catalog import list_files
+from label_writer import atomic_path
 
-def move_imgs_having_labels(labels_folder, source_folder, destination_folder, extention='.jpg'):
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+# ioctl of linux cloning a file on a copy on write filesystem (btrfs, xfs), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def scan_stems(folder, extention, catalog_path=None):
+    '''
+    List a folder once with os.scandir, or from the dataset catalog (see dataset_catalog.list_files).
+
+    Parameters:
+    - folder (str): path of the folder
+    - extention (str): only the files with this extension (case insensitive)
+    - catalog_path (str): optional dataset catalog
+
+    Returns:
+    - dict: stem -> path of every file with the extension
     '''
-    Function to move all the files having the specified extention to the destination folder
+    return {os.path.basename(path)[:-len(extention)]: path for path in list_files(folder, extention, catalog_path)}
+
+
+def match_labels_and_images(labels_folder, source_folder, extention='.jpg', catalog_path=None):
+    '''
+    Match the label files and the images by their stem, one directory listing (or catalog query) per folder.
+
+    Returns:
+    - matched (list): (stem, image path) of the labels having an image, sorted
+    - labels_without_image (list): stems of the labels without an image
+    - images_without_label (list): stems of the images without a label
+    '''
+    labels = scan_stems(labels_folder, '.txt', catalog_path)
+    images = scan_stems(source_folder, extention, catalog_path)
+    matched = sorted((stem, images[stem]) for stem in labels.keys() & images.keys())
+    return matched, sorted(labels.keys() - images.keys()), sorted(images.keys() - labels.keys())
+
+
+def _reflink(source_path, destination_path):
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+
+
+def link_or_copy(source_path, destination_path):
+    '''
+    Put a file at destination_path without copying its bytes when possible: a hardlink,
+    then a reflink (copy on write clone), and a real copy only across filesystems.
+    An existing destination is replaced. The destination is made under a temporary name and
+    renamed, an interrupted transfer never leaves a partial image.
+    A hardlink shares the data with the source, the images are never edited in place so it is safe here.
+
+    Returns:
+    - str: 'link', 'reflink', 'copy' or 'present' (the destination already is a hardlink of the source)
+    '''
+    # rename() is a no-op between two links of the same file, it would leave the temporary link behind
+    if os.path.exists(destination_path) and os.path.samefile(source_path, destination_path):
+        return 'present'
+    with atomic_path(destination_path) as temp_path:
+        try:
+            os.link(source_path, temp_path)
+            method = 'link'
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EACCES):
+                raise
+            method = None
+        if method is None and fcntl is not None:
+            try:
+                _reflink(source_path, temp_path)
+                method = 'reflink'
+            except OSError:
+                # the clone may fail before it created the temporary file
+                try:
+                    os.remove(temp_path)
+                except FileNotFoundError:
+                    pass
+        if method is None:
+            shutil.copy(source_path, temp_path)
+            method = 'copy'
+    return method
+
+
+def transfer_files(pairs, num_workers=8):
+    '''
+    Transfer files with link_or_copy from a pool of threads.
+
+    Parameters:
+    - pairs (list): (source path, destination path)
+    - num_workers (int): number of threads
+
+    Returns:
+    - methods (Counter): number of files per method of link_or_copy
+    - failed (list): (source path, error)
+    '''
+    def transfer(pair):
+        try:
+            return link_or_copy(*pair), None
+        except Exception as e:
+            return None, (pair[0], str(e))
+
+    methods = Counter()
+    failed = []
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for method, error in executor.map(transfer, pairs):
+            if error is not None:
+                failed.append(error)
+            else:
+                methods[method] += 1
+    return methods, failed
+
+
+def move_imgs_having_labels(labels_folder, source_folder, destination_folder, extention='.jpg', num_workers=8, verbose=False,
+                            catalog_path=None):
+    '''
+    Function to move all the files having the specified extention to the destination folder.
+    The images are hardlinked (or reflinked) when source and destination are on the same filesystem,
+    they are only copied across filesystems.
 
     Parameters: 
     - labels_folder (str): path of the folder that has the labels
     - source_folder (str): path to the source folder
     - destination_folder (str): path to the destination folder (where the files are to be moved)
     - extention: move all the files with this extension
+    - num_workers (int): number of threads transferring the files
+    - verbose (bool): list every unmatched label and image instead of only counting them
+    - catalog_path (str): list the two folders from this dataset catalog (dataset_catalog.py) instead of the disk
 
     Returns: 
     - True: if successful
     - False: if unsuccessful
     '''
-    status_label, filenames_with_ext = get_filenames_of_extention(labels_folder, extention='.txt')
-
-    # Remove the extension of the file name
-    if status_label:
-        lablenames_without_ext = [Path(filename).stem for filename in filenames_with_ext]
-    else:
-        print(f'Error in getting filenames of labels from {labels_folder}')
+    if not os.path.isdir(labels_folder) or not os.path.isdir(source_folder):
+        print(f'Error in getting filenames of labels from {labels_folder} or images from {source_folder}')
         return False
 
-    print(f"Label filenames without extension: {lablenames_without_ext}")
+    matched, labels_without_image, images_without_label = match_labels_and_images(labels_folder, source_folder, extention,
+                                                                                  catalog_path)
 
     # Ensure the destination folder exists
     os.makedirs(destination_folder, exist_ok=True)
 
-    # Move image files
-    for labelname in lablenames_without_ext:
-        image_filename = f"{labelname}{extention}"
-        source_path = Path(source_folder) / image_filename
-        destination_path = Path(destination_folder) / image_filename
+    pairs = [(image_path, os.path.join(destination_folder, Path(image_path).name)) for _, image_path in matched]
+    methods, failed = transfer_files(pairs, num_workers)
 
-        if source_path.exists():
-            shutil.copy(str(source_path), str(destination_path))
-            print(f"Copied {image_filename} to {destination_folder}")
-        else:
-            print(f"Image file {image_filename} not found in {source_folder}")
+    print(f"{len(matched)} images having labels: " + ', '.join(f'{count} {method}' for method, count in sorted(methods.items()))
+          + f", {len(failed)} failed")
+    print(f"{len(labels_without_image)} labels without image in {source_folder}")
+    print(f"{len(images_without_label)} images without label in {labels_folder}")
+    if verbose:
+        for stem in labels_without_image:
+            print(f"Image file {stem}{extention} not found in {source_folder}")
+        for stem in images_without_label:
+            print(f"Label file {stem}.txt not found in {labels_folder}")
+    for source_path, error in failed:
+        print(f"Error transferring {source_path}: {error}")
 
-    return True
+    return not failed
 
     
 
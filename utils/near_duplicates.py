@@ -0,0 +1,309 @@
+# near duplicate detection of frames and tiles with perceptual hashes
+#
+# The DJI frames of a flight overlap a lot, so many tiles are almost the same image. Every image
+# gets a 64 bit pHash (sign of the low frequencies of the DCT of a 32*32 grey thumbnail, computed
+# for a whole batch with two matrix products). The hashes go in a BK-tree, which finds all the
+# hashes within a Hamming distance without comparing every pair. The images are grouped around
+# the image kept (star clusters, the one with the most boxes first): every duplicate is within
+# the distance of the kept image. The duplicates are reported or moved out of the dataset
+# (with their labels), the kept image stays.
+#
+# Usage:
+# python near_duplicates.py <image folder> [--labels <labels folder>] [--distance 6] [--report clusters.csv]
+#                           [--exclude-to <folder>] [--catalog catalog.db]
+
+import os
+import csv
+import shutil
+import argparse
+import numpy as np
+from pathlib import Path
+from multiprocessing import Pool
+from PIL import Image
+from dataset_catalog import list_files
+
+HASH_SIZE = 8
+THUMBNAIL_SIZE = 32
+
+
+def dct_matrix(size):
+    '''
+    Orthonormal DCT-II matrix, dct(x) = D @ x.
+    '''
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+def load_grey_thumbnail(image_path, size=THUMBNAIL_SIZE):
+    '''
+    Returns:
+    - np.ndarray: (size, size) float32 grey thumbnail, JPEGs are decoded at a reduced size
+    '''
+    with Image.open(image_path) as image:
+        image.draft('L', (size * 4, size * 4))
+        return np.asarray(image.convert('L').resize((size, size), Image.BILINEAR), dtype=np.float32)
+
+
+def _load_thumbnails_worker(image_paths):
+    '''
+    Load a chunk of thumbnails inside the process pool, never raises.
+
+    Returns:
+    - thumbnails (np.ndarray): (N, 32, 32) float32 of the images that could be read
+    - loaded (list): paths of those images
+    - failed (list): (path, error)
+    '''
+    thumbnails, loaded, failed = [], [], []
+    for image_path in image_paths:
+        try:
+            thumbnails.append(load_grey_thumbnail(image_path))
+            loaded.append(image_path)
+        except Exception as e:
+            failed.append((image_path, str(e)))
+    thumbnails = np.stack(thumbnails) if thumbnails else np.zeros((0, THUMBNAIL_SIZE, THUMBNAIL_SIZE), dtype=np.float32)
+    return thumbnails, loaded, failed
+
+
+def phash_batch(thumbnails):
+    '''
+    Perceptual hash of a batch of grey thumbnails.
+
+    Parameters:
+    - thumbnails (np.ndarray): (N, 32, 32) grey thumbnails
+
+    Returns:
+    - np.ndarray: (N,) uint64 hashes
+    '''
+    thumbnails = np.asarray(thumbnails, dtype=np.float32)
+    matrix = dct_matrix(thumbnails.shape[-1])
+    # 2D DCT of every thumbnail at once: D @ X @ D.T
+    coefficients = (matrix @ thumbnails @ matrix.T)[:, :HASH_SIZE, :HASH_SIZE].reshape(len(thumbnails), -1)
+    # the DC term is left out of the median, it only says how bright the image is
+    median = np.median(coefficients[:, 1:], axis=1, keepdims=True)
+    bits = coefficients > median
+    return np.packbits(bits, axis=1).view('>u8').reshape(-1).astype(np.uint64)
+
+
+def hash_images(image_paths, num_workers=None, chunksize=256):
+    '''
+    pHash of many images, the decoding is done by a pool of processes.
+
+    Returns:
+    - hashes (np.ndarray): (N,) uint64 hashes of the images that could be read
+    - paths (list): the paths of those images, in the order of hashes
+    - failed (list): (path, error)
+    '''
+    chunks = [image_paths[i:i + chunksize] for i in range(0, len(image_paths), chunksize)]
+    hashes, paths, failed = [], [], []
+    with Pool(processes=num_workers) as pool:
+        for thumbnails, loaded, chunk_failed in pool.imap(_load_thumbnails_worker, chunks):
+            hashes.append(phash_batch(thumbnails))
+            paths.extend(loaded)
+            failed.extend(chunk_failed)
+    hashes = np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64)
+    return hashes, paths, failed
+
+
+def hamming_distance(a, b):
+    '''
+    Number of different bits between uint64 hashes (arrays are compared element wise).
+    '''
+    difference = np.bitwise_xor(np.asarray(a, dtype=np.uint64), np.asarray(b, dtype=np.uint64))
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(difference).astype(np.int64)
+    return np.unpackbits(difference.reshape(-1, 1).view(np.uint8), axis=1).sum(axis=1).reshape(difference.shape)
+
+
+class BKTree:
+    '''
+    Burkhard-Keller tree of 64 bit hashes under the Hamming distance. A node keeps its children
+    by their distance to it, the triangle inequality lets a search skip every child whose
+    distance is farther than radius from the distance of the query to the node.
+    '''
+
+    def __init__(self):
+        # node: [hash, index, {distance: child node}]
+        self.root = None
+
+    def add(self, value, index):
+        value = int(value)
+        if self.root is None:
+            self.root = [value, index, {}]
+            return
+        node = self.root
+        while True:
+            distance = bin(value ^ node[0]).count('1')
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, index, {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        '''
+        Returns:
+        - list: (index, distance) of the hashes within radius of value
+        '''
+        value = int(value)
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = bin(value ^ node[0]).count('1')
+            if distance <= radius:
+                found.append((node[1], distance))
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return found
+
+
+def find_clusters(hashes, max_distance=6, order=None):
+    '''
+    Group the near duplicates around the images that are kept. The images are visited in order,
+    an image not in a cluster yet is kept and takes all the images within max_distance of it that
+    are not in a cluster yet. Every member of a cluster is a near duplicate of the kept image,
+    a chain of overlapping frames (A~B, B~C, ...) is not merged into a single cluster.
+
+    Parameters:
+    - hashes (np.ndarray): (N,) uint64 hashes
+    - max_distance (int): largest Hamming distance between two near duplicates (of 64 bits)
+    - order (list): indices of the images from the most to the least worth keeping, defaults to 0..N-1
+
+    Returns:
+    - list: clusters of 2 or more indices into hashes, the kept image first then the duplicates sorted
+    '''
+    # the tree only holds distinct values, identical hashes are grouped by value
+    tree = BKTree()
+    indices_of_value = {}
+    for index, value in enumerate(hashes.tolist()):
+        if value not in indices_of_value:
+            indices_of_value[value] = []
+            tree.add(value, index)
+        indices_of_value[value].append(index)
+
+    assigned = np.zeros(len(hashes), dtype=bool)
+    clusters = []
+    for kept in (range(len(hashes)) if order is None else order):
+        if assigned[kept]:
+            continue
+        assigned[kept] = True
+        duplicates = []
+        for other, _ in tree.search(hashes[kept], max_distance):
+            for index in indices_of_value[int(hashes[other])]:
+                if not assigned[index]:
+                    assigned[index] = True
+                    duplicates.append(index)
+        if duplicates:
+            clusters.append([kept] + sorted(duplicates))
+    return clusters
+
+
+def box_count(label_path):
+    try:
+        with open(label_path, 'r') as file:
+            return sum(1 for line in file if line.strip())
+    except FileNotFoundError:
+        return 0
+
+
+def keep_order(paths, labels_folder=None):
+    '''
+    Order in which the images are preferred as the kept image of a cluster: the most boxes in
+    their label first (when labels_folder is given), then by path.
+
+    Returns:
+    - list: indices into paths
+    '''
+    if labels_folder is None:
+        return sorted(range(len(paths)), key=lambda index: paths[index])
+    counts = [box_count(Path(labels_folder) / (Path(path).stem + '.txt')) for path in paths]
+    return sorted(range(len(paths)), key=lambda index: (-counts[index], paths[index]))
+
+
+def pick_representatives(clusters, paths):
+    '''
+    Returns:
+    - list: (kept path, [duplicate paths]) for every cluster of find_clusters
+    '''
+    return [(paths[members[0]], sorted(paths[index] for index in members[1:])) for members in clusters]
+
+
+def write_report(representatives, report_path):
+    '''
+    csv with one row per image of a cluster: cluster, path, kept (1 for the kept image)
+    '''
+    with open(report_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['cluster', 'path', 'kept'])
+        for cluster, (kept, duplicates) in enumerate(representatives):
+            writer.writerow([cluster, kept, 1])
+            for duplicate in duplicates:
+                writer.writerow([cluster, duplicate, 0])
+
+
+def exclude_duplicates(representatives, excluded_folder, labels_folder=None):
+    '''
+    Move the duplicates (not the kept image) and their labels to excluded_folder,
+    they can be moved back by hand if a cluster was wrong.
+
+    Returns:
+    - int: number of images moved
+    '''
+    os.makedirs(excluded_folder, exist_ok=True)
+    moved = 0
+    for _, duplicates in representatives:
+        for duplicate in duplicates:
+            shutil.move(duplicate, os.path.join(excluded_folder, Path(duplicate).name))
+            moved += 1
+            if labels_folder is not None:
+                label_path = Path(labels_folder) / (Path(duplicate).stem + '.txt')
+                if label_path.exists():
+                    shutil.move(str(label_path), os.path.join(excluded_folder, label_path.name))
+    return moved
+
+
+def find_near_duplicates(image_folder, labels_folder=None, max_distance=6, num_workers=None, extention='.jpg', catalog_path=None):
+    '''
+    Hash every image of a folder (e.g. tiles of crop.py or the images of a label-studio export) and cluster them.
+    The images are listed from the dataset catalog if catalog_path is given (see dataset_catalog.list_files).
+
+    Returns:
+    - representatives (list): (kept path, [duplicate paths]) of every cluster
+    - failed (list): (path, error) of the images that could not be read
+    '''
+    image_paths = list_files(image_folder, extention, catalog_path)
+    hashes, paths, failed = hash_images(image_paths, num_workers)
+    representatives = pick_representatives(find_clusters(hashes, max_distance, keep_order(paths, labels_folder)), paths)
+    duplicate_count = sum(len(duplicates) for _, duplicates in representatives)
+    print(f'{len(paths)} images, {len(representatives)} clusters of near duplicates, '
+          f'{duplicate_count} duplicates, {len(failed)} failed')
+    return representatives, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find near duplicate images with perceptual hashes.')
+    parser.add_argument('image_folder')
+    parser.add_argument('--labels', default=None, help='labels of the images, the image with the most boxes of a cluster is kept')
+    parser.add_argument('--distance', type=int, default=6, help='largest Hamming distance (of 64 bits) between near duplicates')
+    parser.add_argument('--report', default=None, help='csv file listing the clusters')
+    parser.add_argument('--exclude-to', default=None, help='move the duplicates and their labels to this folder')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--catalog', default=None, help='list the images from this dataset catalog (dataset_catalog.py)')
+    args = parser.parse_args()
+
+    representatives, failed = find_near_duplicates(args.image_folder, args.labels, args.distance, args.workers,
+                                                   catalog_path=args.catalog)
+    for image_path, error in failed:
+        print(f'Failed: {image_path}: {error}')
+    if args.report:
+        write_report(representatives, args.report)
+    if args.exclude_to:
+        moved = exclude_duplicates(representatives, args.exclude_to, args.labels)
+        print(f'{moved} duplicates moved to {args.exclude_to}')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,18 @@
 import math
 import pandas as pd
+import numpy as np
 from pathlib import Path
 import os
-from miscellaneous import path_valid, save_to_txt_file
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from miscellaneous import path_valid, save_to_txt_file, format_lines
 import xml.etree.ElementTree as ET
-from miscellaneous import rotate_point, get_filenames_of_extention
+from miscellaneous import get_filenames_of_extention
+from geometry import xyxy_rotation_to_corners
+from conversion_manifest import load_manifest, save_manifest, changed_files, remove_stale_labels
+from annotation_store import AnnotationSet, write_obb_txt_folder
+from label_writer import LabelArchiveWriter
 
 def convert_pascal_voc_xml_to_OBB(source_folder, destination_folder):
     '''
@@ -26,7 +34,7 @@ def convert_pascal_voc_xml_to_OBB(source_folder, destination_folder):
     destination_folder_path_obj = Path(destination_folder)
 
     # get the filename of all the xml files in the folder
-    filenames_xml = get_filenames_of_extention(source_folder, extention='.xml')      
+    _, filenames_xml = get_filenames_of_extention(source_folder, extention='.xml')      
 
 
     failed_lables = []
@@ -51,8 +59,6 @@ def convert_single_pascal_voc_xml_to_yoloObb(xml_path, destination_path):
     - json_path (str): path to the label-studio json file
     - destination_path (str) : path to the destination directory
     - image_size (tuple) : image size eg. 256*256 (image_height, image_width)
-    
-    TODO: check the class label also and then put that class label in the files
 
     Returns: 
     - True (bool): if sucessful
@@ -85,8 +91,8 @@ def convert_single_pascal_voc_xml_to_yoloObb(xml_path, destination_path):
     # print(df)
 
     # check that the df has only a single row. 
-    if df.shape[0] != 1: 
-        print(f'Error in extracting b_boxes form xml_path. Shape: {df.shape}')
+    if len(df) != 1: 
+        print(f'Error in extracting b_boxes form xml_path. Rows: {len(df)}')
         return False
 
 
@@ -100,57 +106,23 @@ def convert_single_pascal_voc_xml_to_yoloObb(xml_path, destination_path):
 
     b_boxes = df['b_boxes'][0]
 
-    lines_to_write = []
     new_file_path = destination_path_obj.joinpath(file_name)
-    num_of_bboxes =0
     round_variable = 3
-    for bbox in b_boxes:
-        xmin = bbox['xmin']
-        ymin = bbox['ymin']
-        xmax = bbox['xmax']
-        ymax = bbox['ymax']
-        rotation_angle = bbox['rotation']
-
-        # Calculate center and dimensions
-        cx = (xmax + xmin) / 2
-        cy = (ymax + ymin) / 2
-        # width = xmax - xmin
-        # height = ymax - ymin
-
-        # Rotate each corner of the rectangle around its center
-        x1, y1 = rotate_point(xmin - cx, ymin - cy, rotation_angle)
-        x2, y2 = rotate_point(xmax - cx, ymin - cy, rotation_angle)
-        x3, y3 = rotate_point(xmax - cx, ymax - cy, rotation_angle)
-        x4, y4 = rotate_point(xmin - cx, ymax - cy, rotation_angle)
-
-        # Translate back to original coordinates
-        x1 += cx
-        y1 += cy
-        x2 += cx
-        y2 += cy
-        x3 += cx
-        y3 += cy
-        x4 += cx
-        y4 += cy
-
-        # Normalize the coordinates
-        x1, x2, x3, x4 = round(x1,round_variable), round(x2,round_variable), round(x3,round_variable),round(x4,round_variable)
-        y1, y2, y3, y4 = round(y1,round_variable), round(y2,round_variable) , round(y3,round_variable), round(y4,round_variable)
-
-        # save the files in the yolo_obb format (x1,y1,x2,y2,x3,y3,x4,y4)
-        coordinates = (x1,y1,x2,y2,x3,y3,x4,y4)
-
-        # TODO: convert the class-labels which is in string class-lables
-        class_label = 'waste'
-
-        # TODO: way to get the difficuulty of finding the class-label
-        difficulty = 0 # default 
-
-        line = ','.join(map(str, coordinates)) + ',' + str(class_label) + ',' + str(difficulty)
-        # print(line)
-    
-        lines_to_write.append(line)
-        num_of_bboxes = num_of_bboxes +1 
+    boxes = np.array([(bbox['xmin'], bbox['ymin'], bbox['xmax'], bbox['ymax'], bbox['rotation']) for bbox in b_boxes],
+                     dtype=np.float64).reshape(-1, 5)
+
+    # Rotate each corner of the rectangle around its center
+    corners = np.round(xyxy_rotation_to_corners(boxes, dtype=np.float64), round_variable).reshape(-1, 8)
+
+    # <name> of every object, the same class labels as convert_pascal_voc_xml_to_OBB_parallel
+    class_labels = [bbox['label'] for bbox in b_boxes]
+
+    # TODO: way to get the difficuulty of finding the class-label
+    difficulty = 0 # default 
+
+    # save the files in the yolo_obb format (x1,y1,x2,y2,x3,y3,x4,y4,class_label,difficulty)
+    lines_to_write = format_lines(corners, [np.array(class_labels, dtype=object), np.full(len(boxes), difficulty)])
+    num_of_bboxes = len(boxes)
     print(f'Number of bboxes: {num_of_bboxes}')
     # print(lines_to_write)
     save_to_txt_file(lines_to_write=lines_to_write, destination_path=new_file_path)
@@ -197,7 +169,7 @@ def extract_b_boxes_and_rotation(file_path):
         ymin = float(obj.find('bndbox/ymin').text)
         xmax = float(obj.find('bndbox/xmax').text)
         ymax = float(obj.find('bndbox/ymax').text)
-        rotation = float(obj.find('attributes/attribute/value').text)
+        rotation = read_rotation_attribute(obj)
         box = {
             'label': name,
             'xmin': xmin,
@@ -217,10 +189,352 @@ def extract_b_boxes_and_rotation(file_path):
         
     return df
 
+def read_rotation_attribute(obj):
+    '''
+    Rotation (degrees) of an <object> exported by CVAT, the value of its attribute named 'rotation',
+    0 if the object has none.
+    '''
+    for attribute in obj.iterfind('attributes/attribute'):
+        if attribute.findtext('name') == 'rotation':
+            return float(attribute.findtext('value'))
+    return 0.0
+
+
+def parse_pascal_voc_xml(xml_path):
+    '''
+    Parse a Pascal VOC xml file exported by CVAT with ElementTree iterparse,
+    without building a DataFrame.
+
+    Parameters:
+    - xml_path (str): path of the xml file
+
+    Returns:
+    - file_name (str): <filename> of the annotation
+    - class_labels (list): <name> of every object
+    - boxes (np.ndarray): (N, 5) float64 xmin, ymin, xmax, ymax, rotation (degrees)
+    - size (tuple): (width, height) of the image, 0 if unknown
+
+    Raises:
+    - ET.ParseError: if the xml is invalid
+    '''
+    file_name = None
+    size = (0, 0)
+    class_labels = []
+    rows = []
+    for _, element in ET.iterparse(xml_path, events=('end',)):
+        if element.tag == 'filename' and file_name is None:
+            file_name = element.text
+        elif element.tag == 'size':
+            size = (int(float(element.findtext('width') or 0)), int(float(element.findtext('height') or 0)))
+        elif element.tag == 'object':
+            rotation = read_rotation_attribute(element)
+            class_labels.append(element.findtext('name'))
+            rows.append((float(element.findtext('bndbox/xmin')), float(element.findtext('bndbox/ymin')),
+                         float(element.findtext('bndbox/xmax')), float(element.findtext('bndbox/ymax')), rotation))
+            element.clear()
+    return file_name, class_labels, np.array(rows, dtype=np.float64).reshape(-1, 5), size
+
+
+def iter_cvat_images_xml(xml_path):
+    '''
+    Parse a "CVAT for images" xml file, where all the images of a task are in one document,
+    one <image> at a time.
+
+    Parameters:
+    - xml_path (str): path of annotations.xml
+
+    Yields:
+    - file_name (str): name attribute of the <image>
+    - class_labels (list): label of every <box>
+    - boxes (np.ndarray): (N, 5) float64 xmin, ymin, xmax, ymax, rotation (degrees)
+    - size (tuple): (width, height) of the image
+    '''
+    for _, element in ET.iterparse(xml_path, events=('end',)):
+        if element.tag != 'image':
+            continue
+        class_labels = []
+        rows = []
+        for box in element.iterfind('box'):
+            class_labels.append(box.get('label'))
+            rows.append((float(box.get('xtl')), float(box.get('ytl')), float(box.get('xbr')), float(box.get('ybr')),
+                         float(box.get('rotation', 0.0))))
+        size = (int(float(element.get('width', 0))), int(float(element.get('height', 0))))
+        yield element.get('name'), class_labels, np.array(rows, dtype=np.float64).reshape(-1, 5), size
+        element.clear()
+
+
+def voc_boxes_to_annotation_set(file_names, class_labels, boxes, file_indices, sizes=None, round_variable=3):
+    '''
+    Convert the boxes of many images at once into an AnnotationSet.
+
+    Parameters:
+    - file_names (list): image file name of every file index
+    - class_labels (list): class label of every box
+    - boxes (np.ndarray): (N, 5) xmin, ymin, xmax, ymax, rotation of all the boxes
+    - file_indices (np.ndarray): (N,) file index of every box, contiguous per file
+    - sizes (list): (width, height) of every file, optional
+    - round_variable (int): number of decimals kept
+
+    Returns:
+    - AnnotationSet
+    '''
+    # rounded in float64 so that the corners written back from float32 keep the same decimals
+    corners = np.round(xyxy_rotation_to_corners(boxes, dtype=np.float64), round_variable)
+    sizes = np.array(sizes, dtype=np.int32).reshape(-1, 2) if sizes else np.zeros((len(file_names), 2), dtype=np.int32)
+    return AnnotationSet.from_boxes(file_names, corners, class_labels, file_indices, widths=sizes[:, 0], heights=sizes[:, 1])
+
+
+def write_voc_boxes(file_names, class_labels, boxes, file_indices, destination_folder, round_variable=3, archive=None):
+    '''
+    Convert the boxes of many images at once and write one label file per image
+    (empty if the image has no boxes) in the yolo_obb format (x1,y1,x2,y2,x3,y3,x4,y4,class_label,difficulty).
+
+    Parameters:
+    - file_names (list): image file name of every file index
+    - class_labels (list): class label of every box
+    - boxes (np.ndarray): (N, 5) xmin, ymin, xmax, ymax, rotation of all the boxes
+    - file_indices (np.ndarray): (N,) file index of every box, contiguous per file
+    - destination_folder (str): folder of the label files
+    - round_variable (int): number of decimals
+    - archive (LabelArchiveWriter): if given the labels are added to this archive instead of destination_folder
+
+    Returns:
+    - int: number of label files written
+    '''
+    annotations = voc_boxes_to_annotation_set(file_names, class_labels, boxes, file_indices, round_variable=round_variable)
+    return len(write_obb_txt_folder(annotations, destination_folder, round_variable, archive=archive))
+
+
+def _parse_voc_files_worker(xml_paths):
+    '''
+    Parse a chunk of xml files inside a worker process, returns compact arrays instead of
+    one object per box so that sending the result back to the main process is cheap.
+    The corners are computed in the main process for the whole chunk at once.
+
+    Returns:
+    - file_names (list), class_labels (list), boxes (np.ndarray (N, 5)), file_indices (np.ndarray (N,)),
+      failed (list of (xml_path, error)), sizes (list of (width, height))
+    '''
+    file_names, class_labels, boxes, file_indices, failed, sizes = [], [], [], [], [], []
+    for xml_path in xml_paths:
+        try:
+            file_name, labels, file_boxes, size = parse_pascal_voc_xml(xml_path)
+            if file_name is None:
+                raise ValueError('no <filename> in the annotation')
+        except Exception as e:
+            failed.append((str(xml_path), str(e)))
+            continue
+        file_indices.append(np.full(len(file_boxes), len(file_names), dtype=np.int64))
+        file_names.append(file_name)
+        sizes.append(size)
+        class_labels.extend(labels)
+        boxes.append(file_boxes)
+    boxes = np.concatenate(boxes) if boxes else np.zeros((0, 5))
+    file_indices = np.concatenate(file_indices) if file_indices else np.zeros(0, dtype=np.int64)
+    return file_names, class_labels, boxes, file_indices, failed, sizes
+
+
+def convert_pascal_voc_xml_to_OBB_parallel(source_folder, destination_folder, num_workers=None, chunksize=64, archive_path=None):
+    '''
+    Convert the Pascal Voc XML files of the source folder to the YOLO_OBB format using a pool of processes.
+    The output is the same as convert_pascal_voc_xml_to_OBB, a file that fails to parse is reported
+    and does not stop the run.
+
+    Parameters: 
+    - source_folder (str): path to source folder
+    - destination_folder (str): path to destination folder
+    - num_workers (int): number of processes, defaults to the number of cpus
+    - chunksize (int): number of xml files parsed by a worker at a time
+    - archive_path (str): if given the labels are packed in this zip archive instead of loose files in destination_folder
+
+    Returns:
+    - True, failed (bool, list): failed is the list of (xml_path, error) of the files that could not be converted
+    - False, [] : if the folders are invalid
+    '''
+    if not path_valid(source_folder) or (archive_path is None and not path_valid(destination_folder)): 
+        print(f'Path of source folder or the destination folder is not correct')
+        return False, []
+
+    _, filenames_xml = get_filenames_of_extention(source_folder, extention='.xml')
+    filenames_xml.sort()
+    xml_paths = [str(Path(source_folder) / filename) for filename in filenames_xml]
+    chunks = [xml_paths[i:i + chunksize] for i in range(0, len(xml_paths), chunksize)]
+
+    start = time.perf_counter()
+    written = 0
+    failed = []
+    # the archive only replaces a previous one once every xml file is converted
+    with ProcessPoolExecutor(max_workers=num_workers) as executor, \
+            LabelArchiveWriter(archive_path) if archive_path is not None else nullcontext() as archive:
+        for file_names, class_labels, boxes, file_indices, chunk_failed, _ in executor.map(_parse_voc_files_worker, chunks):
+            written += write_voc_boxes(file_names, class_labels, boxes, file_indices, destination_folder, archive=archive)
+            failed.extend(chunk_failed)
+
+    print(f'Converted {written} of {len(xml_paths)} xml files in {time.perf_counter() - start:.1f}s, failed: {len(failed)}')
+    for xml_path, error in failed:
+        print(f'Failed: {xml_path}: {error}')
+    return True, failed
+
+
+def convert_pascal_voc_xml_to_OBB_incremental(source_folder, destination_folder, manifest_path=None, num_workers=None, chunksize=64):
+    '''
+    Same as convert_pascal_voc_xml_to_OBB_parallel but only the xml files that changed since the previous
+    run are converted. A manifest with the size, mtime and sha1 of every xml file (see conversion_manifest.py)
+    is kept in the destination folder, the labels of the xml files that disappeared are deleted.
+
+    Parameters: 
+    - source_folder (str): path to source folder
+    - destination_folder (str): path to destination folder
+    - manifest_path (str): path of the manifest, defaults to <destination_folder>/.xml_manifest.json
+    - num_workers (int): number of processes, defaults to the number of cpus
+    - chunksize (int): number of xml files parsed by a worker at a time
+
+    Returns:
+    - True, failed (bool, list): failed is the list of (xml_path, error), they are retried on the next run
+    - False, [] : if the folders are invalid
+    '''
+    if not path_valid(source_folder) or not path_valid(destination_folder): 
+        print(f'Path of source folder or the destination folder is not correct')
+        return False, []
+    if manifest_path is None:
+        manifest_path = Path(destination_folder) / '.xml_manifest.json'
+    entries = load_manifest(manifest_path)
+
+    _, filenames_xml = get_filenames_of_extention(source_folder, extention='.xml')
+    filenames_xml.sort()
+    xml_paths = [str(Path(source_folder) / filename) for filename in filenames_xml]
+    changed, signatures = changed_files(xml_paths, entries)
+    removed = remove_stale_labels(entries, set(signatures), destination_folder)
+    # files touched without being modified only get their new mtime
+    for key, entry in entries.items():
+        entry['signature'] = signatures[key]
+
+    failed = []
+    if changed:
+        chunks = [changed[i:i + chunksize] for i in range(0, len(changed), chunksize)]
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for chunk, result in zip(chunks, executor.map(_parse_voc_files_worker, chunks)):
+                file_names, class_labels, boxes, file_indices, chunk_failed, _ = result
+                write_voc_boxes(file_names, class_labels, boxes, file_indices, destination_folder)
+                failed.extend(chunk_failed)
+                failed_paths = {xml_path for xml_path, _ in chunk_failed}
+                converted = [xml_path for xml_path in chunk if xml_path not in failed_paths]
+                for xml_path, file_name in zip(converted, file_names):
+                    key = Path(xml_path).name
+                    label = file_name.split('.')[0] + '.txt'
+                    previous_label = entries.get(key, {}).get('label')
+                    if previous_label and previous_label != label:
+                        try:
+                            os.remove(Path(destination_folder) / previous_label)
+                        except FileNotFoundError:
+                            pass
+                    entries[key] = {'signature': signatures[key], 'label': label}
+                # a failed file keeps its previous entry (if any) so that it is converted again next time
+                for xml_path in failed_paths:
+                    key = Path(xml_path).name
+                    if key in entries:
+                        entries[key]['signature'] = {}
+
+    save_manifest(manifest_path, entries)
+    print(f'{len(xml_paths)} xml files: {len(changed) - len(failed)} converted, {len(xml_paths) - len(changed)} unchanged, '
+          f'{len(removed)} labels removed, {len(failed)} failed')
+    for xml_path, error in failed:
+        print(f'Failed: {xml_path}: {error}')
+    return True, failed
+
+
+def convert_cvat_images_xml_to_OBB(xml_path, destination_folder, images_per_chunk=1000):
+    '''
+    Convert a "CVAT for images" annotations.xml (all the images in one document) to the YOLO_OBB format,
+    one label file per image.
+
+    Parameters: 
+    - xml_path (str): path of annotations.xml
+    - destination_folder (str): path to destination folder
+    - images_per_chunk (int): number of images whose corners are computed at once
+
+    Returns:
+    - True (bool): if successful
+    - False (bool): if the paths are invalid or the xml can not be parsed
+    '''
+    if not path_valid(xml_path) or not path_valid(destination_folder):
+        print(f'The path for xml_path or destination_folder is invalid.')
+        return False
+
+    def write_chunk():
+        nonlocal written
+        if file_names:
+            written += write_voc_boxes(file_names, class_labels, np.concatenate(boxes), np.concatenate(file_indices), destination_folder)
+
+    written = 0
+    file_names, class_labels, boxes, file_indices = [], [], [], []
+    try:
+        for file_name, labels, image_boxes, _ in iter_cvat_images_xml(xml_path):
+            file_indices.append(np.full(len(image_boxes), len(file_names), dtype=np.int64))
+            file_names.append(file_name)
+            class_labels.extend(labels)
+            boxes.append(image_boxes)
+            if len(file_names) == images_per_chunk:
+                write_chunk()
+                file_names, class_labels, boxes, file_indices = [], [], [], []
+        write_chunk()
+    except ET.ParseError as e:
+        print(f"Error parsing the XML file: {e}")
+        return False
+    print(f'Converted {written} images of {xml_path}')
+    return True
+
+def load_pascal_voc_annotations(source_folder, num_workers=None, chunksize=64):
+    '''
+    Load a folder of Pascal VOC xml files into an AnnotationSet, the files are parsed in a pool of processes.
+
+    Parameters:
+    - source_folder (str): folder of the xml files
+    - num_workers (int): number of processes, defaults to the number of cpus
+    - chunksize (int): number of xml files parsed by a worker at a time
+
+    Returns:
+    - AnnotationSet, failed (list of (xml_path, error)). None, [] if the folder is invalid
+    '''
+    status, filenames_xml = get_filenames_of_extention(source_folder, extention='.xml')
+    if not status:
+        return None, []
+    filenames_xml.sort()
+    xml_paths = [str(Path(source_folder) / filename) for filename in filenames_xml]
+    chunks = [xml_paths[i:i + chunksize] for i in range(0, len(xml_paths), chunksize)]
+
+    annotation_sets = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for file_names, class_labels, boxes, file_indices, chunk_failed, sizes in executor.map(_parse_voc_files_worker, chunks):
+            annotation_sets.append(voc_boxes_to_annotation_set(file_names, class_labels, boxes, file_indices, sizes))
+            failed.extend(chunk_failed)
+    return AnnotationSet.concatenate(annotation_sets), failed
+
+
+def load_cvat_images_annotations(xml_path):
+    '''
+    Load a "CVAT for images" annotations.xml into an AnnotationSet.
+
+    Returns:
+    - AnnotationSet
+    '''
+    file_names, class_labels, boxes, file_indices, sizes = [], [], [], [], []
+    for file_name, labels, image_boxes, size in iter_cvat_images_xml(xml_path):
+        file_indices.append(np.full(len(image_boxes), len(file_names), dtype=np.int64))
+        file_names.append(file_name)
+        sizes.append(size)
+        class_labels.extend(labels)
+        boxes.append(image_boxes)
+    boxes = np.concatenate(boxes) if boxes else np.zeros((0, 5))
+    file_indices = np.concatenate(file_indices) if file_indices else np.zeros(0, dtype=np.int64)
+    return voc_boxes_to_annotation_set(file_names, class_labels, boxes, file_indices, sizes)
+
+
 def main():
     xml_path = "C:\\Users\\HP\\Documents\\py\\Object Detection\\cvat output pascal voc xml\\bagmati-patch1-waste2\\Annotations"
     destination_path = "C:\\Users\\HP\\Documents\\py\\Object Detection\\cvat output pascal voc xml\\bagmati-patch1-waste2\\labels"
-    _ , failed_lables = convert_pascal_voc_xml_to_OBB(xml_path, destination_path)
+    _ , failed_lables = convert_pascal_voc_xml_to_OBB_parallel(xml_path, destination_path)
 
     print(f'Failed lables: {len(failed_lables)}')
 
@@ -3,7 +3,7 @@ import matplotlib.patches as patches
 import numpy as np
 import math
 from matplotlib.patches import Polygon
-from miscellaneous import rotate_point
+from geometry import label_studio_to_corners, xyxy_rotation_to_corners
 
 def plot_oriented_bbox(obb_file, image_file):
     """
@@ -79,7 +79,8 @@ def plot_oriented_bbox(obb_file, image_file):
             # Add the polygon to the plot
             ax.add_patch(rect)
         
-        plt.title(f'{image_file.split('\\')[-1]}, #Bboxes: {num_of_bboxes}')
+        image_name = image_file.split('\\')[-1]
+        plt.title(f'{image_name}, #Bboxes: {num_of_bboxes}')
         plt.show()
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -145,36 +146,18 @@ def plot_rotated_rect_label_stuido_json(bounding_boxes, image_path):
     # Display the image
     ax.imshow(img)
     
-    # Scale factors
-    x_scale = original_width / 100
-    y_scale = original_height / 100
-
-    for i,bbox in enumerate(bounding_boxes):
-        x0 = bbox['x'] * x_scale
-        y0 = bbox['y'] * y_scale
-        width = bbox['width'] * x_scale
-        height = bbox['height'] * y_scale
-        angle = bbox['rotation']
-
-        # Calculate rotated points
-        pt1 = (round(x0, 3), round(y0, 3))
-        pt2 = (round(x0 + width * math.cos(math.radians(angle)), 3), round(y0 + width * math.sin(math.radians(angle))))
-        pt3 = (round(x0 + width * math.cos(math.radians(angle)) - height * math.sin(math.radians(angle)), 3), round(y0 + width * math.sin(math.radians(angle)) + height * math.cos(math.radians(angle)), 3))
-        pt4 = (round(x0 - height * math.sin(math.radians(angle)), 3), round(y0 + height * math.cos(math.radians(angle)), 3))
+    # Calculate rotated points of all the boxes at once
+    corners = label_studio_to_corners([bbox['x'] for bbox in bounding_boxes], [bbox['y'] for bbox in bounding_boxes],
+                                      [bbox['width'] for bbox in bounding_boxes], [bbox['height'] for bbox in bounding_boxes],
+                                      [bbox['rotation'] for bbox in bounding_boxes], original_width, original_height)
 
+    for box_corners in corners:
         # Create a rotated rectangle patch
-        rect = patches.Polygon([pt1,pt2,pt3,pt4],
-                                closed=True, fill=None, edgecolor='b')
+        rect = patches.Polygon(box_corners, closed=True, fill=None, edgecolor='b')
 
         # Add the rectangle patch to the Axes
         ax.add_patch(rect)
 
-        # Plot dots at the corners
-        # ax.plot(x0, y0, 'o', markersize=8, color='red')
-        # ax.plot(x0 + width * math.cos(math.radians(angle)), y0 + width * math.sin(math.radians(angle)), 'o', markersize=8, color='red')
-        # ax.plot(x0 + width * math.cos(math.radians(angle)) - height * math.sin(math.radians(angle)), y0 + width * math.sin(math.radians(angle)) + height * math.cos(math.radians(angle)), 'o', markersize=8, color='red')
-        # ax.plot(x0 - height * math.sin(math.radians(angle)), y0 + height * math.cos(math.radians(angle)), 'o', markersize=8, color='red')
-
     # Display the plot with bounding boxes
     plt.title('Bounding Boxes')
     plt.axis('off')  # Turn off axis numbers and ticks
@@ -241,39 +224,13 @@ def plot_rotated_rectangle_pascal_voc_format(bounding_boxes, image_path):
     # Display the image
     ax.imshow(img)
 
-    num_of_bboxes = 0
-    for bbox in bounding_boxes:
-        num_of_bboxes = num_of_bboxes + 1
-        xmin = bbox['xmin']
-        ymin = bbox['ymin']
-        xmax = bbox['xmax']
-        ymax = bbox['ymax']
-        rotation_angle = bbox['rotation']
-
-        # Calculate center and dimensions
-        cx = (xmax + xmin) / 2
-        cy = (ymax + ymin) / 2
-        width = xmax - xmin
-        height = ymax - ymin
-
-        # Rotate each corner of the rectangle around its center
-        x1, y1 = rotate_point(xmin - cx, ymin - cy, rotation_angle)
-        x2, y2 = rotate_point(xmax - cx, ymin - cy, rotation_angle)
-        x3, y3 = rotate_point(xmax - cx, ymax - cy, rotation_angle)
-        x4, y4 = rotate_point(xmin - cx, ymax - cy, rotation_angle)
-
-        # Translate back to original coordinates
-        x1 += cx
-        y1 += cy
-        x2 += cx
-        y2 += cy
-        x3 += cx
-        y3 += cy
-        x4 += cx
-        y4 += cy
-
+    # Rotate each corner of the rectangles around their center
+    corners = xyxy_rotation_to_corners([(bbox['xmin'], bbox['ymin'], bbox['xmax'], bbox['ymax'], bbox['rotation'])
+                                        for bbox in bounding_boxes])
+    num_of_bboxes = len(corners)
+    for box_corners in corners:
         # Create a rotated rectangle patch
-        rect = Polygon([(x1, y1), (x2, y2), (x3, y3), (x4, y4)], closed=True, fill=None, edgecolor='b')
+        rect = Polygon(box_corners, closed=True, fill=None, edgecolor='b')
 
         # Add the rotated rectangle patch to the Axes
         ax.add_patch(rect)
@@ -285,6 +242,39 @@ def plot_rotated_rectangle_pascal_voc_format(bounding_boxes, image_path):
     plt.axis('off')  # Turn off axis numbers and ticks
     plt.show()
 
+def plot_annotation_set(annotations, index, image_folder):
+    """
+    Plots the boxes of one image of an AnnotationSet (see annotation_store.py).
+
+    Parameters:
+    -----------
+    annotations : AnnotationSet
+        The annotations, e.g. from load_label_studio_annotations or load_pascal_voc_annotations.
+
+    index : int
+        Index of the image in the set.
+
+    image_folder : str
+        Folder of the images named like annotations.file_names.
+
+    Returns:
+    --------
+    None
+        Displays the image with the bounding boxes plotted.
+    """
+    file_name = annotations.file_names[index]
+    img = plt.imread(f'{image_folder}/{file_name}')
+    corners, _ = annotations.boxes(index)
+
+    fig, ax = plt.subplots(1)
+    ax.imshow(img)
+    for box_corners in corners:
+        ax.add_patch(Polygon(box_corners, closed=True, fill=None, edgecolor='b'))
+
+    plt.title(f'{file_name}, #Bboxes: {len(corners)}')
+    plt.axis('off')  # Turn off axis numbers and ticks
+    plt.show()
+
 def main():
     yol0_obb_file = "C:\\Users\\HP\\Documents\\py\\Object Detection\\cvat output pascal voc xml\\bagmati-patch1-waste2\\labels\\DJI_20240518124257_0028_V282.txt"
     image_file = "C:\\Users\\HP\\Documents\\py\\Object Detection\\dataset\\bagmati\\Bagmati-patch-1-cropped\\Bagmati patch 1-waste2\\bagmati patch 1 waste 2 batch_1_to_5\\DJI_20240518124257_0028_V282.jpg"
@@ -0,0 +1,289 @@
+# headless rendering of oriented boxes, to QA a whole dataset without a display
+#
+# The boxes are drawn straight onto the image with PIL ImageDraw instead of one matplotlib
+# figure per image (see plot_bboxes_in_img.py for the interactive version). The images are
+# rendered in a pool of processes and written either as one overlay per image or as contact
+# sheets of columns*rows thumbnails, every image captioned with its number of boxes.
+#
+# Usage:
+# python render_overlays.py <image folder> <labels folder> <output folder> [--sheet 4x4] [--catalog catalog.db]
+
+import os
+import time
+import zlib
+import argparse
+import numpy as np
+from pathlib import Path
+from multiprocessing import Pool
+from PIL import Image, ImageDraw, ImageFont
+from miscellaneous import read_obb_label_file
+from dataset_catalog import list_files
+
+# colour of a class, picked from the crc32 of its name so that it is the same in every process
+PALETTE = [
+    (230, 25, 75), (60, 180, 75), (255, 225, 25), (0, 130, 200), (245, 130, 48),
+    (145, 30, 180), (70, 240, 240), (240, 50, 230), (210, 245, 60), (250, 190, 212),
+]
+
+
+def class_color(class_label):
+    return PALETTE[zlib.crc32(str(class_label).encode()) % len(PALETTE)]
+
+
+def load_boxes(boxes_source):
+    '''
+    Parameters:
+    - boxes_source: path of a label file in the 8 corner format, (corners, class_labels) or None (no boxes)
+
+    Returns:
+    - corners (np.ndarray): (N, 4, 2) corners in pixels
+    - class_labels (list): class label of every box
+    '''
+    if boxes_source is None:
+        return np.zeros((0, 4, 2)), []
+    if isinstance(boxes_source, (str, Path)):
+        corners, class_labels, _ = read_obb_label_file(boxes_source)
+        return corners, class_labels
+    corners, class_labels = boxes_source
+    return np.asarray(corners, dtype=np.float64).reshape(-1, 4, 2), list(class_labels)
+
+
+def draw_boxes(image, corners, class_labels, scale=1.0, width=2, caption=None):
+    '''
+    Draw oriented boxes on a PIL image in place.
+
+    Parameters:
+    - image (PIL.Image): RGB image
+    - corners (np.ndarray): (N, 4, 2) corners in pixels of the original image
+    - class_labels (list): class label of every box, written next to its first corner
+    - scale (float): factor from the original image to image (when drawing on a thumbnail)
+    - width (int): width of the outline in pixels
+    - caption (str): text written on a dark band at the top left, e.g. the number of boxes
+
+    Returns:
+    - PIL.Image: the same image
+    '''
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    points = np.asarray(corners, dtype=np.float64).reshape(-1, 4, 2) * scale
+    for box, class_label in zip(points, class_labels):
+        color = class_color(class_label)
+        draw.polygon([tuple(point) for point in box.tolist()], outline=color, width=width)
+        if scale >= 0.5:
+            draw.text(tuple(box[0].tolist()), str(class_label), fill=color, font=font)
+    if caption:
+        left, top, right, bottom = draw.textbbox((2, 2), caption, font=font)
+        draw.rectangle((0, 0, right + 2, bottom + 2), fill=(0, 0, 0))
+        draw.text((2, 2), caption, fill=(255, 255, 255), font=font)
+    return image
+
+
+def render_boxes(image_path, boxes_source, max_size=None, width=2, caption=True):
+    '''
+    Open an image and draw its boxes. With max_size the image is downscaled before drawing
+    (JPEGs are decoded directly at a reduced size), which is what makes thumbnails cheap.
+
+    Parameters:
+    - image_path (str): path of the image
+    - boxes_source: see load_boxes
+    - max_size (int): longest side of the rendered image, None keeps the full resolution
+    - width (int): width of the outline in pixels
+    - caption (bool): write '<N> boxes <file name>' on the image, the count first so thumbnails keep it
+
+    Returns:
+    - image (PIL.Image): the rendered RGB image
+    - box_count (int): number of boxes drawn
+    '''
+    corners, class_labels = load_boxes(boxes_source)
+    with Image.open(image_path) as image:
+        original_width = image.width
+        if max_size is not None:
+            image.draft('RGB', (max_size, max_size))
+            image = image.convert('RGB')
+            image.thumbnail((max_size, max_size))
+        else:
+            image = image.convert('RGB')
+    text = f'{len(corners)} boxes {Path(image_path).name}' if caption else None
+    draw_boxes(image, corners, class_labels, image.width / original_width, width, text)
+    return image, len(corners)
+
+
+def overlay_tasks_from_folder(image_folder, labels_folder, extention='.jpg', catalog_path=None):
+    '''
+    Pair every image of a folder with the label file of the same stem (None if it has no label file).
+    Both folders are listed from the dataset catalog if catalog_path is given (see dataset_catalog.list_files).
+
+    Returns:
+    - list: (image_path, label_path or None)
+    '''
+    label_paths = {}
+    if labels_folder is not None and os.path.isdir(labels_folder):
+        label_paths = {Path(path).stem: path for path in list_files(labels_folder, '.txt', catalog_path)}
+    image_paths = list_files(image_folder, extention, catalog_path)
+    return [(image_path, label_paths.get(Path(image_path).stem)) for image_path in image_paths]
+
+
+def overlay_tasks_from_annotation_set(annotations, image_folder):
+    '''
+    Returns:
+    - list: (image_path, (corners, class_labels)) of every image of an AnnotationSet (see annotation_store.py)
+    '''
+    tasks = []
+    for i, file_name in enumerate(annotations.file_names.tolist()):
+        corners, _ = annotations.boxes(i)
+        tasks.append((os.path.join(image_folder, file_name), (np.asarray(corners), annotations.class_labels(i))))
+    return tasks
+
+
+def _render_overlay_worker(task):
+    '''
+    Worker run inside the process pool, never raises.
+
+    Returns:
+    - (image_path, box_count, error) (tuple): error is None if successful
+    '''
+    image_path, boxes_source, output_folder, max_size = task
+    try:
+        image, box_count = render_boxes(image_path, boxes_source, max_size)
+        image.save(os.path.join(output_folder, Path(image_path).stem + '.jpg'), quality=90)
+        return image_path, box_count, None
+    except Exception as e:
+        return image_path, 0, str(e)
+
+
+def _render_contact_sheet_worker(task):
+    '''
+    Render one page of thumbnails inside the process pool, never raises.
+
+    Returns:
+    - (output_path, image_count, box_count, failed) (tuple): image_count counts the rendered images,
+      failed is a list of (image_path, error)
+    '''
+    entries, output_path, columns, rows, cell_size = task
+    sheet = Image.new('RGB', (columns * cell_size, rows * cell_size), (32, 32, 32))
+    box_total = 0
+    failed = []
+    for position, (image_path, boxes_source) in enumerate(entries):
+        try:
+            thumbnail, box_count = render_boxes(image_path, boxes_source, max_size=cell_size, width=1)
+        except Exception as e:
+            failed.append((image_path, str(e)))
+            continue
+        box_total += box_count
+        row, column = divmod(position, columns)
+        sheet.paste(thumbnail, (column * cell_size, row * cell_size))
+    sheet.save(output_path, quality=90)
+    return output_path, len(entries) - len(failed), box_total, failed
+
+
+def _run_pool(worker, tasks, num_workers, chunksize, report_every, unit):
+    '''
+    Run worker over tasks with imap_unordered and print the progress, returns the results.
+    '''
+    total = len(tasks)
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(1, min(num_workers, total)) if total else 1
+    if chunksize is None:
+        chunksize = max(1, total // (num_workers * 4))
+
+    results = []
+    start = time.perf_counter()
+    with Pool(processes=num_workers) as pool:
+        for done, result in enumerate(pool.imap_unordered(worker, tasks, chunksize=chunksize), start=1):
+            results.append(result)
+            if done % report_every == 0 or done == total:
+                print(f"[{done}/{total}] {unit}, {time.perf_counter() - start:.1f}s")
+    return results, time.perf_counter() - start
+
+
+def render_overlays_parallel(tasks, output_folder, max_size=None, num_workers=None, chunksize=None, report_every=100):
+    '''
+    Write one overlay image per task using a pool of processes.
+
+    Parameters:
+    - tasks (list): (image_path, boxes_source), e.g. from overlay_tasks_from_folder
+    - output_folder (str): folder of the overlays, named <image stem>.jpg
+    - max_size (int): longest side of the overlays, None keeps the full resolution
+    - num_workers (int): number of processes, defaults to the number of cpus
+    - chunksize (int): number of images handed to a worker at a time
+    - report_every (int): print the progress after this many images
+
+    Returns:
+    - summary (dict): 'images', 'boxes', 'empty' (images without boxes), 'failed' (list of (path, error)), 'seconds'
+    '''
+    os.makedirs(output_folder, exist_ok=True)
+    tasks = [(image_path, boxes_source, output_folder, max_size) for image_path, boxes_source in tasks]
+    results, seconds = _run_pool(_render_overlay_worker, tasks, num_workers, chunksize, report_every, 'images')
+
+    failed = [(image_path, error) for image_path, _, error in results if error is not None]
+    summary = {
+        'images': len(tasks),
+        'boxes': sum(box_count for _, box_count, _ in results),
+        'empty': sum(1 for _, box_count, error in results if box_count == 0 and error is None),
+        'failed': failed,
+        'seconds': seconds,
+    }
+    print(f"{summary['images']} overlays, {summary['boxes']} boxes, {summary['empty']} without boxes, "
+          f"{len(failed)} failed in {seconds:.1f}s")
+    return summary
+
+
+def render_contact_sheets_parallel(tasks, output_folder, columns=4, rows=4, cell_size=256, num_workers=None, report_every=10):
+    '''
+    Write contact sheets of columns*rows thumbnails with their boxes, one page per process task.
+
+    Parameters:
+    - tasks (list): (image_path, boxes_source), e.g. from overlay_tasks_from_folder
+    - output_folder (str): folder of the sheets, named sheet_<page>.jpg
+    - columns, rows (int): thumbnails per row and per column of a sheet
+    - cell_size (int): side of a thumbnail in pixels
+    - num_workers (int): number of processes, defaults to the number of cpus
+    - report_every (int): print the progress after this many sheets
+
+    Returns:
+    - summary (dict): 'sheets', 'images', 'boxes', 'failed' (list of (path, error)), 'seconds'
+    '''
+    os.makedirs(output_folder, exist_ok=True)
+    per_sheet = columns * rows
+    pages = [(tasks[i:i + per_sheet], os.path.join(output_folder, f'sheet_{i // per_sheet:05d}.jpg'), columns, rows, cell_size)
+             for i in range(0, len(tasks), per_sheet)]
+    results, seconds = _run_pool(_render_contact_sheet_worker, pages, num_workers, 1, report_every, 'sheets')
+
+    failed = [item for _, _, _, page_failed in results for item in page_failed]
+    summary = {
+        'sheets': len(pages),
+        'images': sum(image_count for _, image_count, _, _ in results),
+        'boxes': sum(box_count for _, _, box_count, _ in results),
+        'failed': failed,
+        'seconds': seconds,
+    }
+    print(f"{summary['sheets']} sheets, {summary['images']} images, {summary['boxes']} boxes, "
+          f"{len(failed)} failed in {seconds:.1f}s")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Draw the oriented boxes of a dataset on its images, without a display.')
+    parser.add_argument('image_folder')
+    parser.add_argument('labels_folder', help='label files in the 8 corner format of the converters')
+    parser.add_argument('output_folder')
+    parser.add_argument('--sheet', default=None, help='write contact sheets of COLUMNSxROWS thumbnails, e.g. 4x4')
+    parser.add_argument('--cell-size', type=int, default=256, help='side of a thumbnail of a contact sheet')
+    parser.add_argument('--max-size', type=int, default=None, help='longest side of the overlays')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--catalog', default=None, help='list the folders from this dataset catalog (dataset_catalog.py)')
+    args = parser.parse_args()
+
+    tasks = overlay_tasks_from_folder(args.image_folder, args.labels_folder, catalog_path=args.catalog)
+    if args.sheet:
+        columns, rows = map(int, args.sheet.lower().split('x'))
+        summary = render_contact_sheets_parallel(tasks, args.output_folder, columns, rows, args.cell_size, args.workers)
+    else:
+        summary = render_overlays_parallel(tasks, args.output_folder, args.max_size, args.workers)
+    for image_path, error in summary['failed']:
+        print(f'Failed: {image_path}: {error}')
+
+
+if __name__ == "__main__":
+    main()
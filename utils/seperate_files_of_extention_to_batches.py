@@ -1,57 +1,313 @@
-# this is a script to arrange the images in different folders 
+# this is a script to arrange the images in different folders
+#
+# The whole assignment of the files to batch folders is planned first and written to a journal
+# in the destination folder, then the files are moved by a pool of threads and every finished
+# move is appended to a second file. A run that was interrupted is resumed from the journal,
+# and the journal can undo the batches (move every file back to the source folder).
+# A new run starts after the highest existing batch and the finished journal of the previous
+# run is archived, so every run can be undone, the latest first.
+#
+# dest_folder_base/
+#     .batch_journal.json     {"version": 1, "source_folder": ..., "moves": [[file_name, batch folder], ...]}
+#     .batch_journal.done     one file name per finished move
+#     .batch_journal.1.json   .batch_journal.1.done     journal of the first run, once a second run started
+#     batch_1/ batch_2/ ...
 
 import os
+import re
+import json
 import shutil
-import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from label_writer import write_text_atomic
 
-from miscellaneous import get_filenames_of_extention
+JOURNAL_VERSION = 1
+JOURNAL_NAME = '.batch_journal.json'
+DONE_NAME = '.batch_journal.done'
+ARCHIVE_PATTERN = re.compile(r'^\.batch_journal\.(\d+)\.json$')
+BATCH_PATTERN = re.compile(r'^batch_(\d+)$')
 
-def move_files_to_batches(extention, source_folder, dest_folder_base, batch_size=100):
+
+def plan_batches(extention, source_folder, batch_size=100, batch_bytes=None, first_batch=1):
+    '''
+    Assign every file of the source folder with the extension to a batch folder, in the order of the file names.
+
+    Parameters:
+    - extention (str): extension of the files, e.g. '.jpg'
+    - source_folder (str): folder of the files
+    - batch_size (int): number of files per batch, used when batch_bytes is None
+    - batch_bytes (int): maximum size of a batch in bytes (a single bigger file gets its own batch)
+    - first_batch (int): number of the first batch folder
+
+    Returns:
+    - list: (file_name, batch folder name) of every file
+    '''
+    with os.scandir(source_folder) as entries:
+        files = sorted((entry.name, entry.stat().st_size) for entry in entries
+                       if entry.name.lower().endswith(extention.lower()) and entry.is_file())
+
+    moves = []
+    if batch_bytes is None:
+        for i, (file_name, _) in enumerate(files):
+            moves.append((file_name, f'batch_{i // batch_size + first_batch}'))
+        return moves
+
+    batch, used = first_batch, 0
+    for file_name, size in files:
+        if used and used + size > batch_bytes:
+            batch, used = batch + 1, 0
+        moves.append((file_name, f'batch_{batch}'))
+        used += size
+    return moves
+
+
+def next_batch_number(dest_folder_base):
+    '''
+    Number following the highest batch_<n> folder of dest_folder_base, 1 if there is none.
+    '''
+    numbers = [0]
+    with os.scandir(dest_folder_base) as entries:
+        for entry in entries:
+            match = BATCH_PATTERN.match(entry.name)
+            if match and entry.is_dir():
+                numbers.append(int(match.group(1)))
+    return max(numbers) + 1
+
+
+def _archived_journals(dest_folder_base):
+    '''
+    Numbers of the archived journals of dest_folder_base, in increasing order.
+    '''
+    return sorted(int(match.group(1)) for match in map(ARCHIVE_PATTERN.match, os.listdir(dest_folder_base)) if match)
+
+
+def archive_journal(dest_folder_base):
+    '''
+    Rename the journal and its list of finished moves to .batch_journal.<n>.json/.done, n following the last archive.
+    '''
+    archived = _archived_journals(dest_folder_base)
+    number = archived[-1] + 1 if archived else 1
+    os.replace(os.path.join(dest_folder_base, DONE_NAME), os.path.join(dest_folder_base, f'.batch_journal.{number}.done'))
+    os.replace(os.path.join(dest_folder_base, JOURNAL_NAME), os.path.join(dest_folder_base, f'.batch_journal.{number}.json'))
+
+
+def _restore_latest_archive(dest_folder_base):
+    '''
+    Make the latest archived journal the current one again, returns False if there is none.
+    '''
+    archived = _archived_journals(dest_folder_base)
+    if not archived:
+        return False
+    os.replace(os.path.join(dest_folder_base, f'.batch_journal.{archived[-1]}.json'), os.path.join(dest_folder_base, JOURNAL_NAME))
+    os.replace(os.path.join(dest_folder_base, f'.batch_journal.{archived[-1]}.done'), os.path.join(dest_folder_base, DONE_NAME))
+    return True
+
+
+def write_journal(dest_folder_base, source_folder, moves):
+    '''
+    Write the plan atomically and start an empty list of finished moves.
+    '''
+    write_text_atomic(os.path.join(dest_folder_base, JOURNAL_NAME),
+                      json.dumps({'version': JOURNAL_VERSION, 'source_folder': os.path.abspath(source_folder), 'moves': moves}))
+    open(os.path.join(dest_folder_base, DONE_NAME), 'w').close()
+
+
+def load_journal(dest_folder_base):
+    '''
+    Returns:
+    - journal (dict): 'source_folder', 'moves' (list of [file_name, batch]), None if there is no journal
+    - done (set): names of the files already moved
+    '''
+    try:
+        with open(os.path.join(dest_folder_base, JOURNAL_NAME), 'r') as file:
+            journal = json.load(file)
+    except FileNotFoundError:
+        return None, set()
+    if journal.get('version') != JOURNAL_VERSION:
+        return None, set()
+    try:
+        with open(os.path.join(dest_folder_base, DONE_NAME), 'r') as file:
+            done = {line.rstrip('\n') for line in file if line.strip()}
+    except FileNotFoundError:
+        done = set()
+    return journal, done
+
+
+def _move(task):
+    source_path, dest_path = task
+    try:
+        # os.replace is a rename on the same filesystem, shutil.move copies across filesystems
+        shutil.move(source_path, dest_path)
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def _run_moves(moves, num_workers, done_file=None):
+    '''
+    Move (file_name, source_path, dest_path) with a pool of threads, the name of every finished
+    move is appended to done_file right away.
+
+    Returns:
+    - moved (int), failed (list of (file_name, error))
+    '''
+    moved = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        tasks = [(source_path, dest_path) for _, source_path, dest_path in moves]
+        for (file_name, _, _), error in zip(moves, executor.map(_move, tasks)):
+            if error is not None:
+                failed.append((file_name, error))
+                continue
+            moved += 1
+            if done_file is not None:
+                done_file.write(file_name + '\n')
+                done_file.flush()
+    return moved, failed
+
+
+def execute_journal(dest_folder_base, num_workers=8):
+    '''
+    Do (or finish) the moves of the journal of dest_folder_base.
+
+    A planned file that is neither in the source folder nor in its batch (deleted or renamed after
+    the planning) is written down as done and reported as skipped, so the journal can be finished.
+
+    Returns:
+    - summary (dict): 'planned', 'already_done', 'moved', 'skipped' (list of file names),
+      'failed' (list of (file_name, error))
+    '''
+    journal, done = load_journal(dest_folder_base)
+    if journal is None:
+        print(f'No journal in {dest_folder_base}')
+        return None
+    source_folder = journal['source_folder']
+
+    pending = []
+    skipped = []
+    for file_name, batch in journal['moves']:
+        if file_name in done:
+            continue
+        source_path = os.path.join(source_folder, file_name)
+        dest_path = os.path.join(dest_folder_base, batch, file_name)
+        # interrupted after the move but before it was written down
+        if not os.path.exists(source_path) and os.path.exists(dest_path):
+            done.add(file_name)
+            continue
+        if not os.path.exists(source_path):
+            skipped.append(file_name)
+            continue
+        pending.append((file_name, source_path, dest_path))
+
+    for batch in sorted({batch for _, batch in journal['moves']}):
+        os.makedirs(os.path.join(dest_folder_base, batch), exist_ok=True)
+
+    with open(os.path.join(dest_folder_base, DONE_NAME), 'a') as done_file:
+        for file_name in skipped:
+            done_file.write(file_name + '\n')
+        done_file.flush()
+        moved, failed = _run_moves(pending, num_workers, done_file)
+
+    summary = {'planned': len(journal['moves']), 'already_done': len(done), 'moved': moved, 'skipped': skipped, 'failed': failed}
+    print(f"{summary['planned']} files planned, {summary['already_done']} already moved, {moved} moved, "
+          f"{len(skipped)} skipped, {len(failed)} failed")
+    for file_name in skipped:
+        print(f'Skipped {file_name}: not in the source folder anymore')
+    for file_name, error in failed:
+        print(f'Error moving {file_name}: {error}')
+    return summary
+
+
+def move_files_to_batches(extention, source_folder, dest_folder_base, batch_size=100, batch_bytes=None, num_workers=8, dry_run=False):
+    '''
+    Move the files with the extension of source_folder into dest_folder_base/batch_<n> folders.
+    An unfinished journal in dest_folder_base (from an interrupted run) is resumed instead of planning again,
+    a finished one is archived and the new batches are numbered after the existing ones.
+
+    Parameters:
+    - extention (str): extension of the files, e.g. '.jpg'
+    - source_folder (str): folder of the files
+    - dest_folder_base (str): folder where the batch folders are created
+    - batch_size (int): number of files per batch
+    - batch_bytes (int): maximum size of a batch in bytes, replaces batch_size if given
+    - num_workers (int): number of threads moving the files
+    - dry_run (bool): only print the plan, nothing is moved and no journal is written
+
+    Returns:
+    - summary (dict): see execute_journal, None if there was nothing to do
+    '''
     # Ensure the destination base folder exists
-    if not os.path.exists(dest_folder_base):
-        os.makedirs(dest_folder_base)
-    
-    # Get a list of all files in the source folder
-    files = get_filenames_of_extention(source_folder, extention)
-    
-    # Sort files to maintain a consistent order
-    files.sort()
-    
-    for file in files: 
-        print(file)
-
-    total_number_of_files = len(files)
-    print(f'{type(total_number_of_files)} total_number_of_files, size={total_number_of_files}')
-    print(type(batch_size))
-
-    # Process files in batches
-    for i in range(0, total_number_of_files, batch_size):
-        batch_files = files[i:i+batch_size]
-        batch_folder = os.path.join(dest_folder_base, f'batch_{i//batch_size + 1}')
-        
-        # Create batch folder if it does not exist
-        if not os.path.exists(batch_folder):
-            os.makedirs(batch_folder)
-        
-
-        error_occured = False
-        # Move each file in the batch to the new batch folder
-        for file_name in batch_files:
-            source_path = os.path.join(source_folder, file_name)
-            dest_path = os.path.join(batch_folder, file_name)
-            try:
-                shutil.move(source_path, dest_path)
-                print(f'Moved {file_name} to {batch_folder}')
-            except Exception as e:
-                print(f'Error moving {file_name} to {batch_folder}: {e}')
-                error_occured = False
-                
-        
-        if not error_occured:
-            print(f'Moved {len(batch_files)} files to {batch_folder}')
+    os.makedirs(dest_folder_base, exist_ok=True)
+
+    journal, done = load_journal(dest_folder_base)
+    if journal is not None and len(done) < len(journal['moves']):
+        if journal['source_folder'] != os.path.abspath(source_folder):
+            print(f"{dest_folder_base} has an unfinished journal of {journal['source_folder']}, resume or undo it first")
+            return None
+        print(f"Resuming the journal of {dest_folder_base}: {len(done)} of {len(journal['moves'])} files already moved")
+        if dry_run:
+            return None
+        return execute_journal(dest_folder_base, num_workers)
+
+    moves = plan_batches(extention, source_folder, batch_size, batch_bytes, next_batch_number(dest_folder_base))
+    batches = {}
+    for _, batch in moves:
+        batches[batch] = batches.get(batch, 0) + 1
+    print(f'{len(moves)} files in {len(batches)} batches')
+    if dry_run:
+        for batch, count in batches.items():
+            print(f'{batch}: {count} files')
+        return None
+    if not moves:
+        return None
+
+    if journal is not None:
+        archive_journal(dest_folder_base)
+    write_journal(dest_folder_base, source_folder, moves)
+    return execute_journal(dest_folder_base, num_workers)
+
+
+def undo_batches(dest_folder_base, num_workers=8, dry_run=False):
+    '''
+    Move every file of the journal back to the source folder, then delete the empty batch folders and the journal.
+    The journal of the previous run (if any) becomes the current one, so calling it again undoes that run.
+
+    Returns:
+    - summary (dict): 'moved' (int), 'failed' (list of (file_name, error)), None if there is no journal
+    '''
+    journal, _ = load_journal(dest_folder_base)
+    if journal is None:
+        print(f'No journal in {dest_folder_base}')
+        return None
+    source_folder = journal['source_folder']
+
+    # every file found in its batch is moved back, whether or not its move was written down
+    moves = [(file_name, os.path.join(dest_folder_base, batch, file_name), os.path.join(source_folder, file_name))
+             for file_name, batch in journal['moves']
+             if os.path.exists(os.path.join(dest_folder_base, batch, file_name))]
+    print(f'{len(moves)} files to move back to {source_folder}')
+    if dry_run:
+        return None
+
+    moved, failed = _run_moves(moves, num_workers)
+    for batch in sorted({batch for _, batch in journal['moves']}):
+        try:
+            os.rmdir(os.path.join(dest_folder_base, batch))
+        except OSError:
+            pass
+    if not failed:
+        os.remove(os.path.join(dest_folder_base, JOURNAL_NAME))
+        os.remove(os.path.join(dest_folder_base, DONE_NAME))
+        if _restore_latest_archive(dest_folder_base):
+            print(f'The journal of the previous run of {dest_folder_base} can be undone next')
+    print(f'{moved} files moved back, {len(failed)} failed')
+    for file_name, error in failed:
+        print(f'Error moving {file_name}: {error}')
+    return {'moved': moved, 'failed': failed}
+
 
 def move_jpgs_to_batches(source_folder, dest_folder_base, batch_size=100):
-    move_files_to_batches('.jpg', source_folder=source_folder, dest_folder_base=dest_folder_base, batch_size=batch_size)
+    return move_files_to_batches('.jpg', source_folder=source_folder, dest_folder_base=dest_folder_base, batch_size=batch_size)
 
 def get_script_directory():
     # Get the absolute path of the script
@@ -61,16 +317,24 @@ def get_script_directory():
     return script_directory
 
 def main():
-    print("Arguments you entered are: ")
-    for index, arg in enumerate(sys.argv):
-        print(f'{index+1}: {arg}')
     # moving_files_of_extention '.jpg' 'source_path' 'destination_path' 'batchsize'
-    if len(sys.argv)!=5:
-        print("number of args should be 5.")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description='Move the files of an extension into batch folders, resumable from a journal.')
+    parser.add_argument('extention', help="e.g. '.jpg'")
+    parser.add_argument('source_folder')
+    parser.add_argument('dest_folder_base')
+    parser.add_argument('batch_size', type=int, nargs='?', default=100, help='number of files per batch')
+    parser.add_argument('--batch-mb', type=float, default=None, help='size of a batch in MB instead of a number of files')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--dry-run', action='store_true', help='print the plan without moving anything')
+    parser.add_argument('--undo', action='store_true', help='move the files of the journal back to the source folder')
+    args = parser.parse_args()
 
-    # Call the function
-    move_files_to_batches(extention=sys.argv[1], source_folder=sys.argv[2], dest_folder_base=sys.argv[3], batch_size=int(sys.argv[4]))
+    if args.undo:
+        undo_batches(args.dest_folder_base, args.workers, args.dry_run)
+        return
+    batch_bytes = int(args.batch_mb * (1 << 20)) if args.batch_mb is not None else None
+    move_files_to_batches(args.extention, args.source_folder, args.dest_folder_base, args.batch_size, batch_bytes,
+                          args.workers, args.dry_run)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,281 @@
+# script to pack many small tiles into a single memory mappable shard
+#
+# A shard '<shard_path>' is made of:
+# - <shard_path>.tiles       raw uint8 tiles (N, tile_size, tile_size, 3) one after the other
+# - <shard_path>.index.npy   one record per tile (see INDEX_DTYPE)
+# - <shard_path>.labels.npy  float32 (M, 8) corners x1,y1,...,x4,y4 of the boxes relative to the tile
+# - <shard_path>.classes.npy int32 (M,) class id of every box
+# - <shard_path>.json        tile_size, number of tiles, source image names and class names
+
+import os
+import sys
+import json
+import numpy as np
+from pathlib import Path
+from PIL import Image
+from miscellaneous import get_filenames_of_extention, read_obb_label_file
+from crop import iter_windows, reproject_obb_to_window
+
+INDEX_DTYPE = np.dtype([
+    ('source_id', np.int32),     # index in the 'sources' list of the metadata
+    ('offset', np.int64),        # byte offset of the tile in the .tiles file
+    ('x', np.int32),             # top left corner of the tile in the source image, -1 if unknown
+    ('y', np.int32),
+    ('label_offset', np.int64),  # first row of the tile in .labels.npy/.classes.npy
+    ('label_count', np.int32),   # number of boxes of the tile
+])
+
+
+class TileShardWriter:
+    '''
+    Append tiles (and their boxes) to a shard.
+
+    Example:
+    >>> with TileShardWriter('dataset/shards/bagmati-0', tile_size=256) as writer:
+    >>>     writer.add(tile, (x, y), 'DJI_20240518124257_0028_V.jpg', corners, ['waste'])
+    '''
+
+    def __init__(self, shard_path, tile_size=256):
+        self.shard_path = str(shard_path)
+        self.tile_size = tile_size
+        self.tile_bytes = tile_size * tile_size * 3
+        os.makedirs(os.path.dirname(os.path.abspath(self.shard_path)), exist_ok=True)
+        # a shard written again is incomplete until it is closed
+        try:
+            os.remove(self.shard_path + '.json')
+        except FileNotFoundError:
+            pass
+        self._tiles_file = open(self.shard_path + '.tiles', 'wb')
+        self._index = []
+        self._labels = []
+        self._classes = []
+        self._label_count = 0
+        self._sources = {}
+        self._class_names = {}
+
+    def add(self, tile, origin=(-1, -1), source='', corners=None, class_labels=None):
+        '''
+        Parameters:
+        - tile (np.ndarray): uint8 array of shape (tile_size, tile_size, 3)
+        - origin (tuple): (x, y) of the tile in the source image
+        - source (str): name of the source image
+        - corners (np.ndarray): (K, 4, 2) or (K, 8) corners relative to the tile
+        - class_labels (list): class label (str) of every box
+
+        Returns:
+        - index (int): position of the tile in the shard
+        '''
+        tile = np.ascontiguousarray(tile, dtype=np.uint8)
+        if tile.shape != (self.tile_size, self.tile_size, 3):
+            raise ValueError(f'Tile of shape {tile.shape} does not fit a shard of tile_size {self.tile_size}')
+
+        source_id = self._sources.setdefault(source, len(self._sources))
+        label_count = 0
+        if corners is not None and len(corners):
+            corners = np.asarray(corners, dtype=np.float32).reshape(-1, 8)
+            label_count = len(corners)
+            self._labels.append(corners)
+            self._classes.append(np.array([self._class_names.setdefault(label, len(self._class_names))
+                                           for label in class_labels], dtype=np.int32))
+
+        index = len(self._index)
+        self._tiles_file.write(tile.tobytes())
+        self._index.append((source_id, index * self.tile_bytes, origin[0], origin[1], self._label_count, label_count))
+        self._label_count += label_count
+        return index
+
+    def close(self):
+        if self._tiles_file.closed:
+            return
+        self._tiles_file.close()
+        np.save(self.shard_path + '.index.npy', np.array(self._index, dtype=INDEX_DTYPE))
+        labels = np.concatenate(self._labels) if self._labels else np.zeros((0, 8), dtype=np.float32)
+        classes = np.concatenate(self._classes) if self._classes else np.zeros(0, dtype=np.int32)
+        np.save(self.shard_path + '.labels.npy', labels)
+        np.save(self.shard_path + '.classes.npy', classes)
+        # the metadata is written last, a shard without it is incomplete
+        metadata = {
+            'tile_size': self.tile_size,
+            'count': len(self._index),
+            'sources': list(self._sources),
+            'class_names': list(self._class_names),
+        }
+        with open(self.shard_path + '.json', 'w') as file:
+            json.dump(metadata, file)
+
+    def abort(self):
+        '''
+        Remove the tiles written so far and what was left of a previous shard of the same path.
+        '''
+        if self._tiles_file.closed:
+            return
+        self._tiles_file.close()
+        for suffix in ('.tiles', '.index.npy', '.labels.npy', '.classes.npy'):
+            try:
+                os.remove(self.shard_path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def __len__(self):
+        return len(self._index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class TileShardReader:
+    '''
+    Random access to the tiles of a shard through np.memmap, nothing is read until a tile is used.
+
+    Example:
+    >>> shard = TileShardReader('dataset/shards/bagmati-0')
+    >>> tile = shard[10]                        # (256, 256, 3) uint8 memmap view
+    >>> corners, class_ids = shard.labels(10)   # (K, 8) float32, (K,) int32
+    '''
+
+    def __init__(self, shard_path):
+        self.shard_path = str(shard_path)
+        with open(self.shard_path + '.json', 'r') as file:
+            metadata = json.load(file)
+        self.tile_size = metadata['tile_size']
+        self.sources = metadata['sources']
+        self.class_names = metadata['class_names']
+        self.index = np.load(self.shard_path + '.index.npy', mmap_mode='r')
+        self._labels = np.load(self.shard_path + '.labels.npy', mmap_mode='r')
+        self._classes = np.load(self.shard_path + '.classes.npy', mmap_mode='r')
+        count = metadata['count']
+        if count:
+            self.tiles = np.memmap(self.shard_path + '.tiles', dtype=np.uint8, mode='r',
+                                   shape=(count, self.tile_size, self.tile_size, 3))
+        else:
+            self.tiles = np.zeros((0, self.tile_size, self.tile_size, 3), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        return self.tiles[i]
+
+    def labels(self, i):
+        '''
+        Returns:
+        - corners (np.ndarray): (K, 8) float32 corners of the boxes relative to the tile
+        - class_ids (np.ndarray): (K,) int32, names are in self.class_names
+        '''
+        record = self.index[i]
+        start = int(record['label_offset'])
+        end = start + int(record['label_count'])
+        return self._labels[start:end], self._classes[start:end]
+
+    def origin(self, i):
+        record = self.index[i]
+        return int(record['x']), int(record['y'])
+
+    def source(self, i):
+        return self.sources[int(self.index[i]['source_id'])]
+
+
+def write_shard_from_images(image_paths, shard_path, window_size=256, stride=None, pad=False,
+                            labels_folder=None, min_visibility=0.5):
+    '''
+    Crop images straight into a shard, without writing any jpg.
+
+    Parameters:
+    - image_paths (list): paths of the full frame images
+    - shard_path (str): path of the shard without extension
+    - window_size (int): side of the square window in pixels
+    - stride (int): step between two windows, defaults to window_size
+    - pad (bool): keep the remainder strip by padding with black
+    - labels_folder (str): optional folder with the full frame labels (8 corner format),
+      the boxes are reprojected into every tile
+    - min_visibility (float): boxes with less than this fraction inside a tile are dropped
+
+    Returns:
+    - count (int): number of tiles written
+    '''
+    image_paths = list(image_paths)
+    frame_labels = {}
+    with TileShardWriter(shard_path, window_size) as writer:
+        for tile, (x, y), source_id in iter_windows(image_paths, window_size, stride, pad):
+            image_path = image_paths[source_id]
+            corners, class_labels = None, None
+            if labels_folder is not None:
+                if source_id not in frame_labels:
+                    # keep only the labels of the current frame
+                    frame_labels.clear()
+                    label_path = Path(labels_folder) / (Path(image_path).stem + '.txt')
+                    frame_labels[source_id] = read_obb_label_file(label_path)[:2] if label_path.exists() else (np.zeros((0, 4, 2)), [])
+                frame_corners, frame_class_labels = frame_labels[source_id]
+                keep, corners = reproject_obb_to_window(frame_corners, x, y, window_size, min_visibility)
+                class_labels = [frame_class_labels[k] for k in keep]
+            writer.add(tile, (x, y), Path(image_path).name, corners, class_labels)
+        count = len(writer)
+    print(f'Wrote {count} tiles to the shard {shard_path}')
+    return count
+
+
+def convert_tile_folder_to_shard(tile_folder, shard_path, labels_folder=None, tile_size=256, extention='.jpg'):
+    '''
+    Pack an existing folder of tiles (e.g. the output of crop.py or of
+    seperate_files_of_extention_to_batches.py) into a shard.
+    The origin of the tiles is not known from the folder and is stored as (-1, -1).
+
+    Parameters:
+    - tile_folder (str): folder with the tiles
+    - shard_path (str): path of the shard without extension
+    - labels_folder (str): optional folder with the labels of the tiles (8 corner format)
+    - tile_size (int): size of the tiles, tiles of another size are skipped
+    - extention (str): extention of the tiles
+
+    Returns:
+    - True, skipped (bool, list): if successful, skipped is the list of the tiles not packed
+    - False, [] : if the tile folder is invalid
+    '''
+    status, filenames = get_filenames_of_extention(tile_folder, extention)
+    if not status:
+        print(f'Error in getting the tiles from {tile_folder}')
+        return False, []
+    filenames.sort()
+
+    skipped = []
+    with TileShardWriter(shard_path, tile_size) as writer:
+        for filename in filenames:
+            try:
+                with Image.open(os.path.join(tile_folder, filename)) as image:
+                    tile = np.asarray(image.convert('RGB'))
+            except Exception as e:
+                print(f'Error reading {filename}: {e}')
+                skipped.append(filename)
+                continue
+            if tile.shape[:2] != (tile_size, tile_size):
+                skipped.append(filename)
+                continue
+            corners, class_labels = None, None
+            if labels_folder is not None:
+                label_path = Path(labels_folder) / (Path(filename).stem + '.txt')
+                if label_path.exists():
+                    corners, class_labels, _ = read_obb_label_file(label_path)
+            writer.add(tile, (-1, -1), filename, corners, class_labels)
+        count = len(writer)
+
+    print(f'Packed {count} tiles of {tile_folder} into {shard_path}, skipped {len(skipped)}')
+    return True, skipped
+
+
+def main():
+    # tile_shards.py 'tile_folder' 'shard_path' ['labels_folder']
+    if len(sys.argv) not in (3, 4):
+        print("usage: python tile_shards.py <tile_folder> <shard_path> [labels_folder]")
+        sys.exit(1)
+    labels_folder = sys.argv[3] if len(sys.argv) == 4 else None
+    convert_tile_folder_to_shard(sys.argv[1], sys.argv[2], labels_folder)
+
+
+if __name__ == "__main__":
+    main()